@@ -27,6 +27,210 @@ class Config(BaseModel):
         default="gpt-4o",
         description="Модель для запросов с изображениями"
     )
+    llm_timeout: float = Field(
+        default=30.0,
+        description="Таймаут запроса к LLM (секунды)"
+    )
+    llm_http2: bool = Field(
+        default=True,
+        description="Использовать HTTP/2 для запросов к LLM"
+    )
+    llm_max_connections: int = Field(
+        default=20,
+        description="Максимальное количество соединений в пуле HTTP-клиента"
+    )
+    llm_max_keepalive_connections: int = Field(
+        default=10,
+        description="Максимальное количество keep-alive соединений в пуле"
+    )
+    llm_keepalive_expiry: float = Field(
+        default=60.0,
+        description="Время жизни простаивающего keep-alive соединения (секунды)"
+    )
+    llm_streaming: bool = Field(
+        default=True,
+        description="Показывать ответ LLM по мере генерации"
+    )
+    stream_edit_interval: float = Field(
+        default=1.5,
+        description="Минимальный интервал между редактированиями сообщения при стриминге (секунды)"
+    )
+    
+    # Планировщик запросов к LLM
+    llm_max_concurrency: int = Field(
+        default=8,
+        description="Максимальное количество одновременных запросов к LLM"
+    )
+    llm_rpm_limit: int = Field(
+        default=500,
+        description="Лимит запросов к LLM в минуту"
+    )
+    llm_tpm_limit: int = Field(
+        default=200000,
+        description="Лимит токенов LLM в минуту (по оценке)"
+    )
+    llm_queue_timeout: float = Field(
+        default=60.0,
+        description="Максимальное время ожидания в очереди к LLM (секунды)"
+    )
+    llm_expected_completion_tokens: int = Field(
+        default=800,
+        description="Ожидаемая длина ответа в токенах для оценки TPM"
+    )
+    
+    # Повторы, выключатель и запасные модели
+    llm_max_retries: int = Field(
+        default=2,
+        description="Количество повторов запроса к одной модели при временных ошибках"
+    )
+    llm_retry_base_delay: float = Field(
+        default=0.5,
+        description="Базовая задержка экспоненциального повтора (секунды)"
+    )
+    llm_retry_max_delay: float = Field(
+        default=20.0,
+        description="Максимальная задержка перед повтором; дольше — переход к запасной модели"
+    )
+    llm_breaker_failures: int = Field(
+        default=5,
+        description="Ошибок подряд до размыкания выключателя"
+    )
+    llm_breaker_reset_timeout: float = Field(
+        default=30.0,
+        description="Через сколько секунд пробовать разомкнутую цель снова"
+    )
+    llm_fallback_models: str = Field(
+        default="",
+        description="Запасные модели для текста: \"model\", \"base_url|model\" или \"base_url|model|ENV_VAR\" через запятую"
+    )
+    llm_fallback_models_vision: str = Field(
+        default="",
+        description="Запасные модели для изображений в том же формате"
+    )
+    llm_hedge_enabled: bool = Field(
+        default=False,
+        description="Отправлять дублирующий запрос, если ответ (при потоковом ответе — первый фрагмент) задерживается"
+    )
+    llm_hedge_percentile: float = Field(
+        default=0.95,
+        description="Перцентиль задержки, после которого отправляется дублирующий запрос"
+    )
+    
+    # Контекст диалога
+    context_max_messages: int = Field(
+        default=20,
+        description="Сколько последних сообщений диалога загружать из базы"
+    )
+    llm_context_budget: int = Field(
+        default=2000,
+        description="Бюджет токенов истории диалога для текстовых запросов"
+    )
+    llm_context_budget_vision: int = Field(
+        default=800,
+        description="Бюджет токенов истории диалога для запросов с изображением"
+    )
+    llm_context_budgets: str = Field(
+        default="",
+        description="Бюджеты по моделям: \"model:tokens\" через запятую"
+    )
+    llm_context_summarize: bool = Field(
+        default=True,
+        description="Заменять старые ответы ассистента краткими пересказами"
+    )
+    llm_context_summary_tokens: int = Field(
+        default=150,
+        description="Максимальный размер краткого пересказа ответа (токены)"
+    )
+    context_cache_enabled: bool = Field(
+        default=True,
+        description="Держать последние сообщения диалогов в памяти"
+    )
+    context_cache_max_conversations: int = Field(
+        default=10000,
+        description="Сколько диалогов держать в памяти"
+    )
+    context_cache_max_mb: int = Field(
+        default=64,
+        description="Предел памяти под сообщения диалогов, МБ"
+    )
+    known_users_cache_size: int = Field(
+        default=100000,
+        description="Сколько пользователей с отпечатком профиля помнить (повторный /start без записи)"
+    )
+    
+    # Обработка изображений
+    image_min_side: int = Field(
+        default=1000,
+        description="Минимальная длинная сторона фото, достаточная для распознавания"
+    )
+    image_max_side: int = Field(
+        default=1280,
+        description="Длинная сторона, до которой уменьшается фото перед отправкой в LLM"
+    )
+    image_jpeg_quality: int = Field(
+        default=80,
+        description="Качество JPEG при пережатии фото"
+    )
+    image_workers: int = Field(
+        default=2,
+        description="Количество потоков для обработки изображений"
+    )
+    
+    # Повторные фото (те же байты и подпись)
+    image_dedup_enabled: bool = Field(
+        default=True,
+        description="Переиспользовать ответы для повторно присланных фото (те же байты и подпись)"
+    )
+    image_dedup_max_entries: int = Field(
+        default=20000,
+        description="Максимальное количество фото в индексе"
+    )
+    image_dedup_ttl_hours: int = Field(
+        default=168,
+        description="Сколько часов хранить ответы на фото"
+    )
+    
+    # Маршрутизация по уровням моделей
+    llm_tiers: str = Field(
+        default="",
+        description="Уровни моделей: имя=цепочка:max_tokens через ';'"
+    )
+    llm_routes: str = Field(
+        default="",
+        description="Правила выбора уровня: условия->уровень через ';'"
+    )
+    
+    # Обученный классификатор предметов
+    subject_model_path: str = Field(
+        default="data/subject_model.npz",
+        description="Файл модели предметов (train_subject_model.py)"
+    )
+    subject_model_min_confidence: float = Field(
+        default=0.6,
+        description="Ниже этой уверенности модели используются ключевые слова"
+    )
+    subject_model_reload_interval: float = Field(
+        default=30.0,
+        description="Как часто проверять, не обновился ли файл модели (секунды)"
+    )
+    
+    # Кэш ответов
+    answer_cache_enabled: bool = Field(
+        default=True,
+        description="Кэшировать ответы на повторяющиеся задачи"
+    )
+    answer_cache_memory_size: int = Field(
+        default=1000,
+        description="Количество ответов в LRU-кэше в памяти"
+    )
+    answer_cache_ttl_hours: int = Field(
+        default=168,
+        description="Время жизни ответа в кэше (часы)"
+    )
+    answer_cache_max_rows: int = Field(
+        default=50000,
+        description="Максимальное количество ответов в таблице кэша"
+    )
     
     # Администраторы
     admin_ids: List[int] = Field(default_factory=list, description="ID администраторов")
@@ -34,13 +238,93 @@ class Config(BaseModel):
     # Лимиты
     rate_limit_per_hour: int = Field(
         default=10,
-        description="Максимальное количество запросов в час на пользователя"
+        description="Максимальное количество запросов в час на пользователя (0 — без лимита)"
+    )
+    rate_limit_per_hour_subscriber: int = Field(
+        default=60,
+        description="Максимальное количество запросов в час для подписчиков (0 — без лимита)"
+    )
+    rate_limit_max_users: int = Field(
+        default=100000,
+        description="Сколько пользователей limiter держит в памяти"
+    )
+    rate_limit_snapshot_interval: int = Field(
+        default=60,
+        description="Как часто сохранять состояние лимитов в базу, сек (0 — не сохранять)"
     )
     
     # База данных
     database_url: str = Field(
         default="data/schoolbot.db",
-        description="Путь к SQLite базе данных"
+        description="Путь к SQLite базе данных или postgresql://... для PostgreSQL"
+    )
+    db_pool_size: int = Field(
+        default=10,
+        description="Максимум соединений в пуле PostgreSQL"
+    )
+    db_reader_connections: int = Field(
+        default=4,
+        description="Соединений только для чтения (запись идет через одно соединение)"
+    )
+    db_synchronous: str = Field(
+        default="NORMAL",
+        description="PRAGMA synchronous: OFF, NORMAL, FULL или EXTRA"
+    )
+    db_cache_size_mb: int = Field(
+        default=16,
+        description="Кэш страниц SQLite на соединение, МБ"
+    )
+    db_mmap_size_mb: int = Field(
+        default=128,
+        description="Размер отображения файла базы в память, МБ (0 — выключено)"
+    )
+    db_busy_timeout_ms: int = Field(
+        default=5000,
+        description="Сколько ждать освобождения блокировки базы, мс"
+    )
+    db_write_batch_size: int = Field(
+        default=200,
+        description="Максимум отложенных записей в одной транзакции"
+    )
+    db_write_flush_interval_ms: int = Field(
+        default=50,
+        description="Сколько копить отложенные записи перед фиксацией, мс"
+    )
+    db_write_queue_size: int = Field(
+        default=10000,
+        description="Размер очереди записи; при переполнении обработчики ждут"
+    )
+    
+    # Очистка старых данных
+    retention_batch_size: int = Field(
+        default=500,
+        description="Строк в одной пачке удаления"
+    )
+    retention_batch_pause_ms: int = Field(
+        default=50,
+        description="Пауза между пачками, мс (записи обработчиков проходят без ожидания)"
+    )
+    retention_time_budget: float = Field(
+        default=30.0,
+        description="Бюджет времени одного прохода очистки, сек"
+    )
+    retention_vacuum_pages: int = Field(
+        default=256,
+        description="Страниц за один шаг incremental_vacuum"
+    )
+    archive_dir: str = Field(
+        default="data/archive",
+        description="Каталог архива старых запросов и контекста (пусто — удалять без архива)"
+    )
+    
+    # Дневные агрегаты запросов
+    rollup_batch_size: int = Field(
+        default=5000,
+        description="Строк requests за один шаг пересчета агрегатов"
+    )
+    rollup_interval: int = Field(
+        default=300,
+        description="Период обновления агрегатов, сек"
     )
     
     # Логирование
@@ -96,9 +380,75 @@ def load_config() -> Config:
         llm_base_url=os.getenv("LLM_BASE_URL", "https://api.openai.com/v1"),
         llm_model_text=os.getenv("LLM_MODEL_TEXT", "gpt-4o-mini"),
         llm_model_vision=os.getenv("LLM_MODEL_VISION", "gpt-4o-mini"),
+        llm_timeout=float(os.getenv("LLM_TIMEOUT", "30")),
+        llm_http2=os.getenv("LLM_HTTP2", "true").lower() in ("1", "true", "yes"),
+        llm_max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "20")),
+        llm_max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "10")),
+        llm_keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60")),
+        llm_streaming=os.getenv("LLM_STREAMING", "true").lower() in ("1", "true", "yes"),
+        stream_edit_interval=float(os.getenv("STREAM_EDIT_INTERVAL", "1.5")),
+        llm_max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "8")),
+        llm_rpm_limit=int(os.getenv("LLM_RPM_LIMIT", "500")),
+        llm_tpm_limit=int(os.getenv("LLM_TPM_LIMIT", "200000")),
+        llm_queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", "60")),
+        llm_expected_completion_tokens=int(os.getenv("LLM_EXPECTED_COMPLETION_TOKENS", "800")),
+        llm_max_retries=int(os.getenv("LLM_MAX_RETRIES", "2")),
+        llm_retry_base_delay=float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5")),
+        llm_retry_max_delay=float(os.getenv("LLM_RETRY_MAX_DELAY", "20")),
+        llm_breaker_failures=int(os.getenv("LLM_BREAKER_FAILURES", "5")),
+        llm_breaker_reset_timeout=float(os.getenv("LLM_BREAKER_RESET_TIMEOUT", "30")),
+        llm_fallback_models=os.getenv("LLM_FALLBACK_MODELS", ""),
+        llm_fallback_models_vision=os.getenv("LLM_FALLBACK_MODELS_VISION", ""),
+        llm_hedge_enabled=os.getenv("LLM_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes"),
+        llm_hedge_percentile=float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95")),
+        context_max_messages=int(os.getenv("CONTEXT_MAX_MESSAGES", "20")),
+        llm_context_budget=int(os.getenv("LLM_CONTEXT_BUDGET", "2000")),
+        llm_context_budget_vision=int(os.getenv("LLM_CONTEXT_BUDGET_VISION", "800")),
+        llm_context_budgets=os.getenv("LLM_CONTEXT_BUDGETS", ""),
+        llm_context_summarize=os.getenv("LLM_CONTEXT_SUMMARIZE", "true").lower() in ("1", "true", "yes"),
+        llm_context_summary_tokens=int(os.getenv("LLM_CONTEXT_SUMMARY_TOKENS", "150")),
+        context_cache_enabled=os.getenv("CONTEXT_CACHE_ENABLED", "true").lower() in ("1", "true", "yes"),
+        context_cache_max_conversations=int(os.getenv("CONTEXT_CACHE_MAX_CONVERSATIONS", "10000")),
+        context_cache_max_mb=int(os.getenv("CONTEXT_CACHE_MAX_MB", "64")),
+        known_users_cache_size=int(os.getenv("KNOWN_USERS_CACHE_SIZE", "100000")),
+        image_min_side=int(os.getenv("IMAGE_MIN_SIDE", "1000")),
+        image_max_side=int(os.getenv("IMAGE_MAX_SIDE", "1280")),
+        image_jpeg_quality=int(os.getenv("IMAGE_JPEG_QUALITY", "80")),
+        image_workers=int(os.getenv("IMAGE_WORKERS", "2")),
+        image_dedup_enabled=os.getenv("IMAGE_DEDUP_ENABLED", "true").lower() in ("1", "true", "yes"),
+        image_dedup_max_entries=int(os.getenv("IMAGE_DEDUP_MAX_ENTRIES", "20000")),
+        image_dedup_ttl_hours=int(os.getenv("IMAGE_DEDUP_TTL_HOURS", "168")),
+        llm_tiers=os.getenv("LLM_TIERS", ""),
+        llm_routes=os.getenv("LLM_ROUTES", ""),
+        subject_model_path=os.getenv("SUBJECT_MODEL_PATH", "data/subject_model.npz"),
+        subject_model_min_confidence=float(os.getenv("SUBJECT_MODEL_MIN_CONFIDENCE", "0.6")),
+        subject_model_reload_interval=float(os.getenv("SUBJECT_MODEL_RELOAD_INTERVAL", "30")),
+        answer_cache_enabled=os.getenv("ANSWER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes"),
+        answer_cache_memory_size=int(os.getenv("ANSWER_CACHE_MEMORY_SIZE", "1000")),
+        answer_cache_ttl_hours=int(os.getenv("ANSWER_CACHE_TTL_HOURS", "168")),
+        answer_cache_max_rows=int(os.getenv("ANSWER_CACHE_MAX_ROWS", "50000")),
         admin_ids=admin_ids,
         rate_limit_per_hour=int(os.getenv("RATE_LIMIT_PER_HOUR", "10")),
+        rate_limit_per_hour_subscriber=int(os.getenv("RATE_LIMIT_PER_HOUR_SUBSCRIBER", "60")),
+        rate_limit_max_users=int(os.getenv("RATE_LIMIT_MAX_USERS", "100000")),
+        rate_limit_snapshot_interval=int(os.getenv("RATE_LIMIT_SNAPSHOT_INTERVAL", "60")),
         database_url=os.getenv("DATABASE_URL", "data/schoolbot.db"),
+        db_pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+        db_reader_connections=int(os.getenv("DB_READER_CONNECTIONS", "4")),
+        db_synchronous=os.getenv("DB_SYNCHRONOUS", "NORMAL"),
+        db_cache_size_mb=int(os.getenv("DB_CACHE_SIZE_MB", "16")),
+        db_mmap_size_mb=int(os.getenv("DB_MMAP_SIZE_MB", "128")),
+        db_busy_timeout_ms=int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000")),
+        db_write_batch_size=int(os.getenv("DB_WRITE_BATCH_SIZE", "200")),
+        db_write_flush_interval_ms=int(os.getenv("DB_WRITE_FLUSH_INTERVAL_MS", "50")),
+        db_write_queue_size=int(os.getenv("DB_WRITE_QUEUE_SIZE", "10000")),
+        retention_batch_size=int(os.getenv("RETENTION_BATCH_SIZE", "500")),
+        retention_batch_pause_ms=int(os.getenv("RETENTION_BATCH_PAUSE_MS", "50")),
+        retention_time_budget=float(os.getenv("RETENTION_TIME_BUDGET", "30")),
+        retention_vacuum_pages=int(os.getenv("RETENTION_VACUUM_PAGES", "256")),
+        archive_dir=os.getenv("ARCHIVE_DIR", "data/archive"),
+        rollup_batch_size=int(os.getenv("ROLLUP_BATCH_SIZE", "5000")),
+        rollup_interval=int(os.getenv("ROLLUP_INTERVAL", "300")),
         log_level=os.getenv("LOG_LEVEL", "INFO"),
         log_file=os.getenv("LOG_FILE", "logs/schoolbot.log"),
         subscription_pay_url=os.getenv("SUBSCRIPTION_PAY_URL", "")
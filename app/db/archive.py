@@ -0,0 +1,151 @@
+"""
+Архив устаревших запросов и контекста: сжатые JSONL-файлы по дням
+
+    archive_dir/requests/2024-01-05/000000001234.jsonl.gz
+    archive_dir/conversation_context/2024-01-05/...
+
+Очистка берет из базы пачку старых строк (по времени), раскладывает ее по
+дням и пишет каждый день пачки в отдельный файл (имя — первый id в нем).
+Файл сначала пишется во временный и сбрасывается на диск, затем
+переименовывается, и только после этого строки удаляются из базы. Если
+процесс упал между записью и удалением, следующий проход возьмет ту же
+пачку и перезапишет тот же файл. В памяти — одна пачка, сколько бы
+строк ни накопилось.
+"""
+import asyncio
+import gzip
+import json
+import os
+from datetime import date, datetime
+from itertools import chain, groupby
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from ..config import config
+from .base import StorageBackend
+from .repo import db_repo
+
+
+CONTEXT_TABLE = "conversation_context"
+REQUESTS_TABLE = "requests"
+
+# Поля записей архива в порядке колонок get_old_context / get_old_requests
+ARCHIVE_FIELDS = {
+    CONTEXT_TABLE: ("id", "user_id", "conversation_id", "role", "content", "tokens", "timestamp"),
+    REQUESTS_TABLE: ("id", "user_id", "request_text", "request_type", "subject", "response_text", "timestamp"),
+}
+
+COMPRESSION_LEVEL = 6
+FILE_SUFFIX = ".jsonl.gz"
+
+
+def _format_timestamp(value: Any) -> str:
+    """Время строки как 'YYYY-MM-DD HH:MM:SS' (SQLite отдает строку, PostgreSQL — datetime)"""
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return str(value or "")[:19]
+
+
+def _records(rows: Iterable[Tuple], fields: Sequence[str]) -> Iterator[Dict[str, Any]]:
+    for row in rows:
+        record = dict(zip(fields, row))
+        record["timestamp"] = _format_timestamp(record["timestamp"])
+        yield record
+
+
+def _by_day(records: Iterable[Dict[str, Any]]) -> Iterator[Tuple[str, Iterator[Dict[str, Any]]]]:
+    """Группы записей по дню (записи идут по времени, поэтому день — одна группа)"""
+    return groupby(records, key=lambda record: record["timestamp"][:10] or "unknown")
+
+
+class Archiver:
+    """Перенос устаревших строк из базы в архив и чтение архива по датам"""
+
+    def __init__(self, repo: StorageBackend, root: str):
+        self.repo = repo
+        self.root = Path(root)
+
+        # Счетчики
+        self.batches = 0
+        self.rows_archived = 0
+        self.files_written = 0
+        self.bytes_written = 0
+
+    def _write_day(self, table: str, day: str, records: Iterator[Dict[str, Any]]):
+        first = next(records)
+        directory = self.root / table / day
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"{first['id']:012d}{FILE_SUFFIX}"
+        tmp_path = directory / f".{path.name}.tmp"
+
+        with open(tmp_path, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=COMPRESSION_LEVEL) as gz:
+                for record in chain([first], records):
+                    gz.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp_path, path)
+
+        self.files_written += 1
+        self.bytes_written += path.stat().st_size
+
+    def _write_batch(self, table: str, rows: List[Tuple]):
+        for day, records in _by_day(_records(rows, ARCHIVE_FIELDS[table])):
+            self._write_day(table, day, records)
+
+    async def archive_context(self, cutoff: datetime, limit: int) -> int:
+        """Переносит в архив до limit сообщений контекста старше cutoff"""
+        rows = await self.repo.get_old_context(cutoff, limit)
+        if not rows:
+            return 0
+        await asyncio.to_thread(self._write_batch, CONTEXT_TABLE, rows)
+        return self._archived(await self.repo.delete_context_rows([row[0] for row in rows]))
+
+    async def archive_requests(self, cutoff: datetime, limit: int, max_id: int) -> int:
+        """Переносит в архив до limit запросов старше cutoff с id <= max_id"""
+        rows = await self.repo.get_old_requests(cutoff, limit, max_id)
+        if not rows:
+            return 0
+        await asyncio.to_thread(self._write_batch, REQUESTS_TABLE, rows)
+        return self._archived(await self.repo.delete_request_rows([row[0] for row in rows]))
+
+    def _archived(self, count: int) -> int:
+        self.batches += 1
+        self.rows_archived += count
+        return count
+
+    def days(self, table: str) -> List[str]:
+        """Дни, за которые в архиве есть файлы таблицы"""
+        directory = self.root / table
+        if not directory.is_dir():
+            return []
+        return sorted(path.name for path in directory.iterdir() if path.is_dir())
+
+    def scan(self, table: str, start: date, end: Optional[date] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Записи архива таблицы за дни с start по end включительно (UTC)
+
+        Генератор: файлы читаются по одному и построчно, по дням и внутри
+        дня по id пачек. Запрос, пойманный между записью файла и удалением
+        из базы, может встретиться дважды — ключом служит поле id.
+        """
+        first_day = start.isoformat()
+        last_day = (end or start).isoformat()
+        for day in self.days(table):
+            if not first_day <= day <= last_day:
+                continue
+            for path in sorted((self.root / table / day).glob(f"*{FILE_SUFFIX}")):
+                with gzip.open(path, "rt", encoding="utf-8") as f:
+                    for line in f:
+                        yield json.loads(line)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "rows_archived": self.rows_archived,
+            "files_written": self.files_written,
+            "bytes_written": self.bytes_written,
+        }
+
+
+# Глобальный экземпляр (пустой ARCHIVE_DIR — старые строки удаляются без архива)
+archiver = Archiver(db_repo, config.archive_dir) if config.archive_dir else None
@@ -0,0 +1,98 @@
+"""
+Общий интерфейс хранилища
+
+DatabaseRepo (SQLite, app/db/repo.py) и PostgresRepo (asyncpg,
+app/db/postgres.py) реализуют StorageBackend; какой из них используется,
+решает схема DATABASE_URL (см. create_repo в repo.py).
+"""
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Protocol, Tuple
+from .context_cache import ConversationCache
+from ..utils.hll import HyperLogLog
+
+
+# Таблицы, для которых ведутся счетчики строк (/stats)
+COUNTED_TABLES = ("users", "requests", "conversation_context", "subscriptions")
+# Таблицы с разбивкой числа строк по дням timestamp
+AGE_BUCKET_TABLES = ("requests", "conversation_context")
+
+POSTGRES_SCHEMES = ("postgres://", "postgresql://")
+SQLITE_SCHEME = "sqlite:///"
+
+
+class StorageBackend(Protocol):
+    """Методы репозитория, которыми пользуются обработчики, очистка и агрегаты"""
+
+    context_cache: ConversationCache
+
+    async def init_db(self): ...
+    async def close(self): ...
+    async def flush(self): ...
+    def get_stats(self) -> Dict[str, Any]: ...
+
+    # Пользователи
+    async def create_user(self, user_id: int, username: str = None,
+                          first_name: str = None, last_name: str = None): ...
+    async def register_user(self, user_id: int, username: str = None,
+                            first_name: str = None, last_name: str = None): ...
+    async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]: ...
+
+    # Запросы и контекст диалогов
+    async def save_request(self, user_id: int, request_text: str = None,
+                           request_type: str = "text", subject: str = None,
+                           response_text: str = None, subject_source: str = None,
+                           subject_confidence: float = None): ...
+    async def get_subject_samples(self, limit: int = 200000,
+                                  min_confidence: float = 0.0) -> List[Tuple[str, str]]: ...
+    async def save_message(self, user_id: int, conversation_id: str, role: str, content: str): ...
+    async def get_conversation_context(self, user_id: int, conversation_id: str,
+                                       limit: int = 10) -> List[Dict[str, Any]]: ...
+    async def create_conversation_id(self) -> str: ...
+    async def cleanup_old_context(self, days: int = 7): ...
+
+    # Кэш ответов
+    async def get_cached_answer(self, cache_key: str, ttl_hours: int) -> Optional[Tuple[str, float]]: ...
+    async def save_cached_answer(self, cache_key: str, subject: str, model: str,
+                                 response_text: str): ...
+    async def evict_cached_answers(self, ttl_hours: int, max_rows: int) -> int: ...
+    async def get_image_answer(self, digest: bytes, caption_key: str, ttl_hours: int) -> Optional[str]: ...
+    async def save_image_answer(self, digest: bytes, caption_key: str, subject: str,
+                                response_text: str): ...
+    async def evict_image_answers(self, ttl_hours: int, max_rows: int) -> int: ...
+
+    # Подписки
+    async def set_subscription(self, user_id: int, is_active: bool = True,
+                               expires_at: datetime = None): ...
+    async def get_subscription(self, user_id: int) -> Optional[Dict[str, Any]]: ...
+    async def has_active_subscription(self, user_id: int, cache_ttl: float = 60.0) -> bool: ...
+
+    # Статистика и дневные агрегаты
+    async def get_user_stats(self, user_id: int) -> Dict[str, Any]: ...
+    async def get_database_stats(self) -> Dict[str, Any]: ...
+    async def recount_table_stats(self) -> Dict[str, int]: ...
+    async def get_rollup_watermark(self, name: str) -> int: ...
+    async def get_max_request_id(self) -> int: ...
+    async def get_requests_after(self, after_id: int, limit: int) -> List[Tuple[int, str, str, str, int]]: ...
+    async def apply_daily_rollup(self, name: str, counts: Dict[Tuple[str, str, str], int],
+                                 sketches: Dict[str, HyperLogLog], after_id: int, last_id: int) -> bool: ...
+    async def get_daily_rollup(self, days: int) -> List[Tuple[str, str, str, int]]: ...
+    async def get_daily_user_sketches(self, days: int) -> Dict[str, HyperLogLog]: ...
+
+    # Лимиты частоты заданий
+    async def load_rate_limits(self, now: float) -> List[Tuple[int, float]]: ...
+    async def save_rate_limits(self, states: List[Tuple[int, float]], now: float): ...
+
+    # Очистка (RetentionEngine)
+    async def delete_old_context(self, cutoff: datetime, limit: int) -> int: ...
+    async def delete_old_requests(self, cutoff: datetime, limit: int, max_id: int) -> int: ...
+    async def get_old_context(self, cutoff: datetime, limit: int) -> List[Tuple]: ...
+    async def get_old_requests(self, cutoff: datetime, limit: int, max_id: int) -> List[Tuple]: ...
+    async def delete_context_rows(self, row_ids: List[int]) -> int: ...
+    async def delete_request_rows(self, row_ids: List[int]) -> int: ...
+    async def get_max_user_row_id(self) -> int: ...
+    async def delete_inactive_users(self, cutoff: datetime, after_id: int, until_id: int) -> int: ...
+    async def delete_expired_subscriptions(self, cutoff: datetime, limit: int) -> int: ...
+    async def delete_unreferenced_blobs(self, limit: int) -> int: ...
+    async def incremental_vacuum(self, pages: int) -> int: ...
+    async def vacuum_database(self): ...
+    async def delete_user_data(self, user_id: int): ...
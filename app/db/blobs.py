@@ -0,0 +1,37 @@
+import hashlib
+import zlib
+from functools import lru_cache
+from typing import NamedTuple, Optional
+
+
+# Более короткие тексты остаются в строке таблицы: сжатие и ссылка не окупаются
+BLOB_MIN_LENGTH = 200
+COMPRESSION_LEVEL = 6
+
+
+class PackedText(NamedTuple):
+    """Текст для answer_blobs: ключ содержимого и сжатые данные"""
+    key: bytes
+    data: bytes
+    size: int
+
+
+def should_pack(text: Optional[str]) -> bool:
+    return text is not None and len(text) >= BLOB_MIN_LENGTH
+
+
+@lru_cache(maxsize=256)
+def pack_text(text: str) -> PackedText:
+    """
+    Сжимает текст (zlib), ключ — blake2b-128 от исходных байт
+
+    Один и тот же ответ обычно сохраняется подряд в контекст и в запросы,
+    поэтому последние результаты кэшируются.
+    """
+    raw = text.encode("utf-8")
+    return PackedText(hashlib.blake2b(raw, digest_size=16).digest(),
+                      zlib.compress(raw, COMPRESSION_LEVEL), len(raw))
+
+
+def unpack_text(data: bytes) -> str:
+    return zlib.decompress(data).decode("utf-8")
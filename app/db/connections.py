@@ -0,0 +1,339 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+import aiosqlite
+from loguru import logger
+from ..config import config
+
+
+WriteJob = Callable[[aiosqlite.Connection], Awaitable[Any]]
+
+# (функция, future результата); без future — отложенная запись, идет в пачку
+WriteItem = Tuple[WriteJob, Optional[asyncio.Future]]
+
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+
+class SQLiteConnections:
+    """
+    Соединения с SQLite: один писатель и несколько читателей
+
+    База работает в режиме WAL: читатели не ждут писателя и видят последнее
+    зафиксированное состояние. Все изменения выполняет одна задача-писатель
+    на своем соединении, по одной транзакции на вызов write(), поэтому откат
+    одной операции не задевает чужие незафиксированные вставки. Запросы на
+    чтение идут через небольшой пул соединений в режиме query_only.
+
+    Мелкие вставки, результат которых не нужен сразу, ставятся в очередь
+    через write_behind() и фиксируются пачкой: одна транзакция (и один fsync)
+    на config.db_write_batch_size операций или раз в
+    config.db_write_flush_interval_ms. Очередь ограничена, при переполнении
+    вызывающий ждет (backpressure). write_behind() возвращает номер записи:
+    wait_written() дожидается фиксации именно ее (и всего, что было в очереди
+    раньше), не ставя в очередь барьер, как flush().
+
+    Соединения открываются при первом обращении.
+    """
+
+    def __init__(self, db_path: str, readers: int = None):
+        self.db_path = db_path
+        self.in_memory = db_path == ":memory:" or db_path.startswith("file::memory:")
+        # Базу в памяти видит только открывшее ее соединение
+        self.reader_count = 0 if self.in_memory else max(1, config.db_reader_connections
+                                                          if readers is None else readers)
+
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._readers: List[aiosqlite.Connection] = []
+        self._idle: Optional[asyncio.Queue] = None
+        self._start_lock: Optional[asyncio.Lock] = None
+        self._deferred: Optional[WriteItem] = None
+        # Номера отложенных записей: поставленных в очередь и уже обработанных
+        self._behind_queued = 0
+        self._behind_done = 0
+        self._batch_done: Optional[asyncio.Event] = None
+
+        # Счетчики
+        self.writes = 0
+        self.write_errors = 0
+        self.peak_pending_writes = 0
+        self.write_seconds = 0.0
+        self.batches = 0
+        self.batched_writes = 0
+        self.backpressure_waits = 0
+        self.reads = 0
+        self.read_waits = 0
+
+    def _pragmas(self) -> List[str]:
+        """Профиль настроек соединения (config.db_*)"""
+        synchronous = config.db_synchronous.upper()
+        if synchronous not in SYNCHRONOUS_MODES:
+            logger.warning(f"DB_SYNCHRONOUS={config.db_synchronous!r} не поддерживается, используем NORMAL")
+            synchronous = "NORMAL"
+        return [
+            # В WAL режим NORMAL не теряет целостность, только последние транзакции при сбое питания
+            f"PRAGMA synchronous = {synchronous}",
+            f"PRAGMA cache_size = -{config.db_cache_size_mb * 1024}",
+            f"PRAGMA mmap_size = {config.db_mmap_size_mb * 1024 * 1024}",
+            "PRAGMA temp_store = MEMORY",
+            f"PRAGMA busy_timeout = {config.db_busy_timeout_ms}",
+            "PRAGMA foreign_keys = ON",
+            # Триггеры счетчиков срабатывают и на удаление при INSERT OR REPLACE
+            "PRAGMA recursive_triggers = ON",
+        ]
+
+    async def _open(self, read_only: bool) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.db_path)
+        if not read_only and not self.in_memory:
+            cursor = await conn.execute("PRAGMA journal_mode = WAL")
+            mode = (await cursor.fetchone())[0]
+            if mode.lower() != "wal":
+                logger.warning(f"SQLite не перешла в режим WAL (journal_mode={mode})")
+        for pragma in self._pragmas():
+            await conn.execute(pragma)
+        if read_only:
+            await conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    async def start(self):
+        """Открывает соединения и запускает задачу-писателя (повторный вызов ничего не делает)"""
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if self._writer_task is not None:
+                return
+            # Писатель открывается первым: он переводит базу в WAL
+            self._writer = await self._open(read_only=False)
+            self._readers = [await self._open(read_only=True) for _ in range(self.reader_count)]
+            self._idle = asyncio.Queue()
+            for conn in self._readers:
+                self._idle.put_nowait(conn)
+            self._queue = asyncio.Queue(maxsize=max(1, config.db_write_queue_size))
+            self._batch_done = asyncio.Event()
+            self._writer_task = asyncio.create_task(self._writer_loop())
+
+    async def _next_item(self, timeout: float = None) -> Optional[WriteItem]:
+        if self._deferred is not None:
+            item, self._deferred = self._deferred, None
+            return item
+        if timeout is None:
+            return await self._queue.get()
+        return await asyncio.wait_for(self._queue.get(), timeout)
+
+    async def _writer_loop(self):
+        """Выполняет изменения по очереди: отдельные — каждое в своей транзакции, отложенные — пачками"""
+        while True:
+            item = await self._next_item()
+            if item is None:
+                return
+            if item[1] is not None:
+                await self._run_single(item)
+                continue
+
+            # Собираем пачку, пока не наберется batch_size или не выйдет время
+            batch = [item]
+            deadline = time.monotonic() + config.db_write_flush_interval_ms / 1000
+            stop = False
+            while len(batch) < config.db_write_batch_size:
+                try:
+                    if not self._queue.empty():
+                        next_item = self._queue.get_nowait()
+                    else:
+                        next_item = await self._next_item(max(0.0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    break
+                if next_item is None:
+                    stop = True
+                    break
+                if next_item[1] is not None:
+                    # Срочная запись выполнится сразу после пачки, порядок сохраняется
+                    self._deferred = next_item
+                    break
+                batch.append(next_item)
+
+            await self._run_batch(batch)
+            if stop:
+                return
+
+    async def _run_single(self, item: WriteItem):
+        fn, future = item
+        if future.done():
+            # Вызывающий уже отменил ожидание
+            return
+        started = time.perf_counter()
+        try:
+            result = await fn(self._writer)
+            await self._writer.commit()
+            if not future.done():
+                future.set_result(result)
+        except BaseException as e:
+            self.write_errors += 1
+            await self._rollback()
+            if not future.done():
+                future.set_exception(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            self.writes += 1
+            self.write_seconds += time.perf_counter() - started
+
+    async def _run_batch(self, batch: List[WriteItem]):
+        """
+        Одна транзакция на всю пачку
+
+        Каждая операция выполняется в своей точке сохранения: ошибка одной
+        (например, нарушение внешнего ключа) откатывает только ее.
+        """
+        started = time.perf_counter()
+        try:
+            await self._writer.execute("BEGIN")
+            for fn, _ in batch:
+                await self._writer.execute("SAVEPOINT write_behind")
+                try:
+                    await fn(self._writer)
+                except Exception as e:
+                    self.write_errors += 1
+                    logger.error(f"Отложенная запись в БД не выполнена: {e}")
+                    await self._writer.execute("ROLLBACK TO write_behind")
+                await self._writer.execute("RELEASE write_behind")
+            await self._writer.commit()
+        except BaseException as e:
+            self.write_errors += len(batch)
+            logger.error(f"Пачка из {len(batch)} записей не зафиксирована: {e}")
+            await self._rollback()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            self.writes += len(batch)
+            self.batches += 1
+            self.batched_writes += len(batch)
+            self.write_seconds += time.perf_counter() - started
+            # Пачки идут в порядке очереди: обработаны все номера до текущего
+            self._behind_done += len(batch)
+            batch_done, self._batch_done = self._batch_done, asyncio.Event()
+            batch_done.set()
+
+    async def _rollback(self):
+        try:
+            await self._writer.rollback()
+        except Exception as rollback_error:
+            logger.error(f"Не удалось откатить транзакцию: {rollback_error}")
+
+    async def _put(self, item: Optional[WriteItem]):
+        if self._queue.full():
+            self.backpressure_waits += 1
+        await self._queue.put(item)
+        self.peak_pending_writes = max(self.peak_pending_writes, self._queue.qsize())
+
+    async def write(self, fn: WriteJob) -> Any:
+        """
+        Выполняет fn(conn) на соединении писателя и фиксирует транзакцию
+
+        При исключении транзакция откатывается, исключение пробрасывается.
+        """
+        if self._writer_task is None:
+            await self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._put((fn, future))
+        return await future
+
+    async def write_behind(self, fn: WriteJob) -> int:
+        """
+        Ставит fn(conn) в очередь и возвращается, не дожидаясь фиксации
+
+        Ждет только при переполненной очереди. Ошибки пишутся в лог.
+        Возвращает номер записи для wait_written().
+        """
+        if self._writer_task is None:
+            await self.start()
+        await self._put((fn, None))
+        # Между вставкой в очередь и этой строкой переключения нет: номера
+        # идут в том же порядке, что и записи в очереди
+        self._behind_queued += 1
+        return self._behind_queued
+
+    def is_written(self, ticket: int) -> bool:
+        """Обработана ли отложенная запись с номером ticket (зафиксирована или ушла в лог ошибок)"""
+        return ticket <= self._behind_done
+
+    async def wait_written(self, ticket: int):
+        """Дожидается пачки с отложенной записью ticket; более поздние записи не ждет"""
+        while not self.is_written(ticket):
+            await self._batch_done.wait()
+
+    async def flush(self):
+        """Дожидается фиксации всего, что уже стоит в очереди"""
+        if self._writer_task is None:
+            return
+
+        async def barrier(conn: aiosqlite.Connection):
+            return None
+
+        await self.write(barrier)
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Выдает соединение для чтения из пула"""
+        if self._writer_task is None:
+            await self.start()
+        self.reads += 1
+        if not self._readers:
+            yield self._writer
+            return
+
+        if self._idle.empty():
+            self.read_waits += 1
+        conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+
+    async def set_trace_callback(self, callback: Optional[Callable[[str], None]]):
+        """Передает каждый выполняемый SQL (с подставленными параметрами) в callback"""
+        if self._writer_task is None:
+            await self.start()
+        for conn in [self._writer] + self._readers:
+            await conn.set_trace_callback(callback)
+
+    async def close(self):
+        """Дожидается очереди записи и закрывает все соединения"""
+        if self._writer_task is not None:
+            await self._put(None)
+            try:
+                await self._writer_task
+            except Exception as e:
+                logger.error(f"Задача записи в БД завершилась с ошибкой: {e}")
+            self._writer_task = None
+
+        for conn in self._readers:
+            await conn.close()
+        self._readers = []
+
+        if self._writer is not None:
+            if not self.in_memory:
+                # Переносим WAL в основной файл, чтобы он не рос между перезапусками
+                try:
+                    await self._writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                except Exception as e:
+                    logger.warning(f"Контрольная точка WAL не выполнена: {e}")
+            await self._writer.close()
+            self._writer = None
+
+    def get_stats(self) -> dict:
+        return {
+            "readers": len(self._readers),
+            "idle_readers": self._idle.qsize() if self._idle else 0,
+            "reads": self.reads,
+            "read_waits": self.read_waits,
+            "writes": self.writes,
+            "write_errors": self.write_errors,
+            "pending_writes": self._queue.qsize() if self._queue else 0,
+            "peak_pending_writes": self.peak_pending_writes,
+            "backpressure_waits": self.backpressure_waits,
+            "batches": self.batches,
+            "avg_batch_size": round(self.batched_writes / self.batches, 1) if self.batches else 0.0,
+            "avg_write_ms": round(self.write_seconds / self.writes * 1000, 2) if self.writes else 0.0,
+        }
@@ -0,0 +1,163 @@
+import sys
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from ..config import config
+
+
+# Сообщение в буфере: (роль, текст, время, токены) — кортеж вместо словаря
+ContextEntry = Tuple[str, str, str, Optional[int]]
+ConversationKey = Tuple[int, str]
+
+# Приблизительные накладные расходы: кортеж, строка времени, int, слот deque
+ENTRY_OVERHEAD = 200
+# Буфер: deque, ключ, узел OrderedDict
+BUFFER_OVERHEAD = 800
+
+
+def entry_size(entry: ContextEntry) -> int:
+    """Оценка памяти одного сообщения, байт"""
+    return ENTRY_OVERHEAD + sys.getsizeof(entry[1])
+
+
+class ConversationBuffer:
+    """
+    Последние сообщения одного диалога — кольцевой буфер фиксированной длины
+    """
+
+    __slots__ = ("entries", "nbytes")
+
+    def __init__(self, capacity: int, entries: List[ContextEntry]):
+        self.entries: Deque[ContextEntry] = deque(entries[-capacity:], maxlen=capacity)
+        self.nbytes = BUFFER_OVERHEAD + sum(entry_size(e) for e in self.entries)
+
+    def append(self, entry: ContextEntry) -> int:
+        """Добавляет сообщение, возвращает изменение занятой памяти"""
+        delta = entry_size(entry)
+        if len(self.entries) == self.entries.maxlen:
+            # Самое старое сообщение вытесняется
+            delta -= entry_size(self.entries[0])
+        self.entries.append(entry)
+        self.nbytes += delta
+        return delta
+
+
+class ConversationCache:
+    """
+    LRU последних сообщений по (пользователь, диалог) со сквозной записью
+
+    Буфер загружается из SQLite при первом чтении, дальше новые сообщения
+    дописываются в него одновременно с записью в базу, и чтение контекста
+    не ходит в базу. Вытеснение — по числу диалогов и по занятой памяти.
+    """
+
+    def __init__(self, capacity: int = None, max_conversations: int = None,
+                 max_bytes: int = None):
+        self.capacity = capacity or config.context_max_messages
+        self.max_conversations = max_conversations or config.context_cache_max_conversations
+        self.max_bytes = max_bytes or config.context_cache_max_mb * 1024 * 1024
+        self.enabled = config.context_cache_enabled
+
+        self._buffers: "OrderedDict[ConversationKey, ConversationBuffer]" = OrderedDict()
+        # Загрузки, идущие сейчас: True, если за время загрузки пришло новое сообщение
+        self._loading: Dict[ConversationKey, bool] = {}
+        self.resident_bytes = 0
+
+        # Счетчики
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    @staticmethod
+    def to_dicts(entries: List[ContextEntry]) -> List[Dict[str, Any]]:
+        return [
+            {"role": role, "content": content, "timestamp": timestamp, "tokens": tokens}
+            for role, content, timestamp, tokens in entries
+        ]
+
+    def get(self, key: ConversationKey, limit: int) -> Optional[List[Dict[str, Any]]]:
+        """Последние limit сообщений из буфера (None — нужно читать из базы)"""
+        if not self.enabled:
+            return None
+        if limit > self.capacity:
+            self.bypassed += 1
+            return None
+
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            self.misses += 1
+            return None
+
+        self._buffers.move_to_end(key)
+        self.hits += 1
+        entries = list(buffer.entries)
+        return self.to_dicts(entries[-limit:] if limit > 0 else [])
+
+    def begin_load(self, key: ConversationKey):
+        """Отмечает начало загрузки диалога из базы"""
+        if self.enabled:
+            self._loading[key] = False
+
+    def finish_load(self, key: ConversationKey, entries: List[ContextEntry]):
+        """
+        Кладет прочитанные из базы сообщения (от старых к новым) в буфер
+
+        Если во время загрузки в диалог что-то записали, результат мог это
+        пропустить — такой буфер не сохраняем, следующий запрос прочитает заново.
+        """
+        stale = self._loading.pop(key, True)
+        if not self.enabled or stale or key in self._buffers:
+            return
+
+        buffer = ConversationBuffer(self.capacity, entries)
+        self._buffers[key] = buffer
+        self.resident_bytes += buffer.nbytes
+        self._evict()
+
+    def abort_load(self, key: ConversationKey):
+        """Загрузка не удалась — буфер не создается"""
+        self._loading.pop(key, None)
+
+    def append(self, key: ConversationKey, role: str, content: str, tokens: Optional[int]):
+        """Дописывает новое сообщение в буфер диалога, если он в памяти"""
+        if not self.enabled:
+            return
+        if key in self._loading:
+            self._loading[key] = True
+
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            return
+        timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        self.resident_bytes += buffer.append((role, content, timestamp, tokens))
+        self._buffers.move_to_end(key)
+        self._evict()
+
+    def invalidate(self, user_id: int = None):
+        """Сбрасывает буферы пользователя (или все) после удаления данных в базе"""
+        for key in list(self._buffers):
+            if user_id is None or key[0] == user_id:
+                self.resident_bytes -= self._buffers.pop(key).nbytes
+        for key in self._loading:
+            if user_id is None or key[0] == user_id:
+                self._loading[key] = True
+
+    def _evict(self):
+        while self._buffers and (len(self._buffers) > self.max_conversations
+                                 or self.resident_bytes > self.max_bytes):
+            _, buffer = self._buffers.popitem(last=False)
+            self.resident_bytes -= buffer.nbytes
+            self.evictions += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            "conversations": len(self._buffers),
+            "resident_mb": round(self.resident_bytes / (1024 * 1024), 2),
+        }
@@ -0,0 +1,882 @@
+"""
+Репозиторий PostgreSQL (asyncpg) — для нескольких процессов бота с общей базой
+"""
+import asyncio
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+import asyncpg
+from loguru import logger
+
+from ..config import config
+from .base import COUNTED_TABLES
+from .blobs import PackedText, pack_text, should_pack, unpack_text
+from .context_cache import ConversationCache
+from .user_cache import KnownUsers
+from ..utils.tokens import count_tokens
+from ..utils.hll import HyperLogLog
+
+
+# Ключ pg_advisory_xact_lock: схему применяет один процесс за раз
+SCHEMA_LOCK_ID = 7_310_245_001
+
+# Запросы, вставленные меньше этого назад, агрегаты пока не читают: id из
+# последовательности выдаются до фиксации, и строка с меньшим id может
+# появиться позже (транзакция с ней должна уложиться в это время)
+ROLLUP_LAG = timedelta(minutes=1)
+
+CONTEXT_COLUMNS = ("user_id", "conversation_id", "message_role", "message_content",
+                   "content_hash", "token_count", "timestamp")
+REQUEST_COLUMNS = ("user_id", "request_text", "request_type", "subject",
+                   "response_text", "response_hash", "timestamp",
+                   "subject_source", "subject_confidence")
+
+# Новый пользователь или изменившийся профиль; неизменную строку не трогает
+UPSERT_USER_SQL = """
+    INSERT INTO users (user_id, username, first_name, last_name, updated_at)
+    VALUES ($1, $2, $3, $4, LOCALTIMESTAMP)
+    ON CONFLICT (user_id) DO UPDATE SET
+        username = EXCLUDED.username,
+        first_name = EXCLUDED.first_name,
+        last_name = EXCLUDED.last_name,
+        updated_at = EXCLUDED.updated_at
+    WHERE users.username IS DISTINCT FROM EXCLUDED.username
+       OR users.first_name IS DISTINCT FROM EXCLUDED.first_name
+       OR users.last_name IS DISTINCT FROM EXCLUDED.last_name
+"""
+
+
+def _utcnow() -> datetime:
+    """Текущее время UTC без часового пояса (формат колонок TIMESTAMP)"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _rowcount(status: str) -> int:
+    """Число строк из статуса команды ("DELETE 42")"""
+    try:
+        return int(status.split()[-1])
+    except (ValueError, IndexError):
+        return 0
+
+
+class PostgresRepo:
+    """
+    Репозиторий для работы с базой данных PostgreSQL (реализация StorageBackend)
+
+    Соединения — пул asyncpg; каждый текст запроса asyncpg готовит один раз
+    на соединение и дальше выполняет как prepared statement (кэш
+    statement_cache_size). Сообщения контекста и запросы, как и в SQLite,
+    пишутся отложенно: копятся в памяти и раз в
+    config.db_write_flush_interval_ms (или по config.db_write_batch_size)
+    уходят в базу одной транзакцией через COPY.
+
+    Буфер контекста в памяти отключен: другой процесс бота мог дописать
+    диалог, и буфер этого процесса об этом не узнает.
+    """
+
+    def __init__(self, dsn: str, pool_size: int = None):
+        self.dsn = dsn
+        self.pool_size = pool_size or config.db_pool_size
+        self.pool: Optional[asyncpg.Pool] = None
+
+        self.context_cache = ConversationCache()
+        self.context_cache.enabled = False
+
+        # Пользователи, уже записанные в users (повторный /start не пишет в базу)
+        self.known_users = KnownUsers()
+
+        # Кэш статуса подписки: user_id -> (активна, момент проверки)
+        self._subscription_cache: Dict[int, Tuple[bool, float]] = {}
+
+        # Отложенные записи: регистрации пользователей, строки для COPY и сжатые тексты к ним
+        self._pending_users: Dict[int, tuple] = {}
+        self._pending_context: List[tuple] = []
+        self._pending_requests: List[tuple] = []
+        self._pending_blobs: Dict[bytes, PackedText] = {}
+        self._flush_lock = asyncio.Lock()
+        # Нечетное — пачка пишется, четное — буфер и база согласованы (см. get_conversation_context)
+        self._flush_epoch = 0
+        self._flush_wakeup = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+
+        # Счетчики
+        self.writes = 0
+        self.write_errors = 0
+        self.batches = 0
+        self.batched_writes = 0
+        self.backpressure_waits = 0
+        self.write_seconds = 0.0
+
+    async def _get_pool(self) -> asyncpg.Pool:
+        if self.pool is None:
+            self.pool = await asyncpg.create_pool(
+                self.dsn,
+                min_size=1,
+                max_size=self.pool_size,
+                statement_cache_size=100,
+                server_settings={"timezone": "UTC"},
+            )
+        return self.pool
+
+    async def init_db(self):
+        """Создает пул и применяет схему (повторный запуск ничего не ломает)"""
+        try:
+            schema_path = Path(__file__).parent / "schema_postgres.sql"
+            with open(schema_path, 'r', encoding='utf-8') as f:
+                schema_sql = f.read()
+
+            pool = await self._get_pool()
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    # Процессы, стартующие одновременно, применяют схему по очереди
+                    await conn.execute("SELECT pg_advisory_xact_lock($1)", SCHEMA_LOCK_ID)
+                    await conn.execute(schema_sql)
+
+            if self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush_loop())
+
+        except Exception as e:
+            print(f"Ошибка инициализации БД: {e}")
+            raise
+
+    async def close(self):
+        """Дописывает отложенные записи и закрывает пул"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+
+        if self.pool is not None:
+            await self.flush()
+            await self.pool.close()
+            self.pool = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика пула, отложенной записи и кэша контекста"""
+        return {
+            "connections": {
+                "pool_size": self.pool.get_size() if self.pool else 0,
+                "idle_connections": self.pool.get_idle_size() if self.pool else 0,
+                "writes": self.writes,
+                "write_errors": self.write_errors,
+                "pending_writes": len(self._pending_context) + len(self._pending_requests),
+                "backpressure_waits": self.backpressure_waits,
+                "batches": self.batches,
+                "avg_batch_size": round(self.batched_writes / self.batches, 1) if self.batches else 0.0,
+                "avg_write_ms": round(self.write_seconds / self.writes * 1000, 2) if self.writes else 0.0,
+            },
+            "context_cache": self.context_cache.get_stats(),
+            "known_users": self.known_users.get_stats(),
+        }
+
+    # === ОТЛОЖЕННАЯ ЗАПИСЬ ===
+
+    async def _flush_loop(self):
+        interval = config.db_write_flush_interval_ms / 1000
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка отложенной записи в БД: {e}")
+
+    async def _enqueue(self, pending: List[tuple], record: tuple, blob: Optional[PackedText]):
+        if blob is not None:
+            self._pending_blobs[blob.key] = blob
+        pending.append(record)
+
+        queued = len(self._pending_context) + len(self._pending_requests)
+        if queued >= config.db_write_queue_size:
+            # Очередь переполнена: обработчик ждет записи (backpressure)
+            self.backpressure_waits += 1
+            await self.flush()
+        elif queued >= config.db_write_batch_size:
+            self._flush_wakeup.set()
+
+    async def flush(self):
+        """Записывает все накопленное одной транзакцией (COPY)"""
+        async with self._flush_lock:
+            context, self._pending_context = self._pending_context, []
+            requests, self._pending_requests = self._pending_requests, []
+            blobs, self._pending_blobs = self._pending_blobs, {}
+            users, self._pending_users = self._pending_users, {}
+            if not context and not requests and not users:
+                return
+
+            self._flush_epoch += 1
+            started = time.perf_counter()
+            count = len(context) + len(requests) + len(users)
+            try:
+                await self._write_batch(users, context, requests, blobs, count)
+            finally:
+                self._flush_epoch += 1
+            self.writes += count
+            self.batches += 1
+            self.batched_writes += count
+            self.write_seconds += time.perf_counter() - started
+
+    async def _write_batch(self, users: Dict[int, tuple], context: List[tuple],
+                           requests: List[tuple], blobs: Dict[bytes, PackedText], count: int):
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            try:
+                async with conn.transaction():
+                    # Пользователи — раньше их сообщений и запросов (внешние ключи)
+                    if users:
+                        await conn.executemany(UPSERT_USER_SQL, list(users.values()))
+                    await self._save_blobs(conn, blobs.values())
+                    if context:
+                        await conn.copy_records_to_table(
+                            "conversation_context", records=context, columns=CONTEXT_COLUMNS)
+                    if requests:
+                        await conn.copy_records_to_table(
+                            "requests", records=requests, columns=REQUEST_COLUMNS)
+            except Exception as e:
+                # COPY атомарен: одна плохая строка (например, нарушение внешнего
+                # ключа) отменяет всю пачку — тогда пишем по одной
+                logger.warning(f"Пачка из {count} записей не прошла COPY ({e}), пишем по одной")
+                await self._insert_one_by_one(conn, users, context, requests, blobs)
+
+    async def _insert_one_by_one(self, conn: asyncpg.Connection, users: Dict[int, tuple],
+                                 context: List[tuple], requests: List[tuple],
+                                 blobs: Dict[bytes, PackedText]):
+        for record in users.values():
+            try:
+                await conn.execute(UPSERT_USER_SQL, *record)
+            except Exception as e:
+                self.write_errors += 1
+                self.known_users.forget(record[0])
+                logger.error(f"Отложенная регистрация пользователя {record[0]} не выполнена: {e}")
+        for table, columns, records, hash_index in (
+                ("conversation_context", CONTEXT_COLUMNS, context, 4),
+                ("requests", REQUEST_COLUMNS, requests, 5)):
+            placeholders = ", ".join(f"${i}" for i in range(1, len(columns) + 1))
+            sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
+            for record in records:
+                try:
+                    async with conn.transaction():
+                        blob = blobs.get(record[hash_index])
+                        if blob is not None:
+                            await self._save_blobs(conn, [blob])
+                        await conn.execute(sql, *record)
+                except Exception as e:
+                    self.write_errors += 1
+                    logger.error(f"Отложенная запись в БД не выполнена: {e}")
+
+    async def _save_blobs(self, conn: asyncpg.Connection, blobs):
+        """
+        Кладет сжатые тексты в answer_blobs (ссылки считает триггер)
+
+        DO UPDATE вместо DO NOTHING блокирует существующую строку до конца
+        транзакции, чтобы параллельная очистка не удалила ее между вставкой
+        и появлением ссылки.
+        """
+        blobs = list(blobs)
+        if not blobs:
+            return
+        await conn.executemany("""
+            INSERT INTO answer_blobs (hash, data, size) VALUES ($1, $2, $3)
+            ON CONFLICT (hash) DO UPDATE SET refs = answer_blobs.refs
+        """, [(blob.key, blob.data, blob.size) for blob in blobs])
+
+    # === ПОЛЬЗОВАТЕЛИ ===
+
+    async def create_user(self, user_id: int, username: str = None,
+                          first_name: str = None, last_name: str = None):
+        """Создает или обновляет пользователя (без записи, если профиль не менялся)"""
+        fingerprint = KnownUsers.fingerprint(username, first_name, last_name)
+        if self.known_users.is_current(user_id, fingerprint):
+            return
+
+        pool = await self._get_pool()
+        await pool.execute(UPSERT_USER_SQL, user_id, username, first_name, last_name)
+        self.known_users.remember(user_id, fingerprint)
+
+    async def register_user(self, user_id: int, username: str = None,
+                            first_name: str = None, last_name: str = None):
+        """
+        Регистрирует автора сообщения, если его еще нет (запись отложенная)
+
+        Регистрации уходят в той же транзакции, что и пачка сообщений и
+        запросов, и раньше них.
+        """
+        fingerprint = KnownUsers.fingerprint(username, first_name, last_name)
+        if self.known_users.is_current(user_id, fingerprint):
+            return
+        self._pending_users[user_id] = (user_id, username, first_name, last_name)
+        self.known_users.remember(user_id, fingerprint)
+
+    async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Получает пользователя по ID"""
+        pool = await self._get_pool()
+        row = await pool.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
+        return dict(row) if row else None
+
+    # === ХРАНИЛИЩЕ ТЕКСТОВ ===
+
+    async def delete_unreferenced_blobs(self, limit: int) -> int:
+        """Удаляет до limit текстов, на которые больше нет ссылок"""
+        pool = await self._get_pool()
+        status = await pool.execute("""
+            DELETE FROM answer_blobs WHERE id IN (
+                SELECT id FROM answer_blobs
+                WHERE refs <= 0
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+        """, limit)
+        return _rowcount(status)
+
+    # === ЗАПРОСЫ ===
+
+    async def save_request(self, user_id: int, request_text: str = None,
+                           request_type: str = "text", subject: str = None,
+                           response_text: str = None, subject_source: str = None,
+                           subject_confidence: float = None):
+        """Сохраняет запрос пользователя (запись отложенная, фиксируется пачкой)"""
+        blob = pack_text(response_text) if should_pack(response_text) else None
+        await self._enqueue(self._pending_requests, (
+            user_id, request_text, request_type, subject,
+            None if blob else response_text, blob.key if blob else None, _utcnow(),
+            subject_source, subject_confidence,
+        ), blob)
+
+    async def get_subject_samples(self, limit: int = 200000,
+                                  min_confidence: float = 0.0) -> List[Tuple[str, str]]:
+        """Тексты задач с предметом по ключевым словам для обучения классификатора (новые первыми)"""
+        pool = await self._get_pool()
+        rows = await pool.fetch("""
+            SELECT request_text, subject FROM requests
+            WHERE request_type = 'text' AND subject_source = 'keywords'
+              AND subject_confidence >= $1
+              AND request_text IS NOT NULL AND request_text != ''
+            ORDER BY id DESC
+            LIMIT $2
+        """, min_confidence, limit)
+        return [(row[0], row[1]) for row in rows]
+
+    # === КОНТЕКСТ ДИАЛОГОВ ===
+
+    async def save_message(self, user_id: int, conversation_id: str,
+                           role: str, content: str):
+        """Сохраняет сообщение в контекст диалога (запись отложенная, фиксируется пачкой)"""
+        blob = pack_text(content) if should_pack(content) else None
+        await self._enqueue(self._pending_context, (
+            user_id, conversation_id, role, "" if blob else content,
+            blob.key if blob else None, count_tokens(content), _utcnow(),
+        ), blob)
+
+    async def get_conversation_context(self, user_id: int, conversation_id: str,
+                                       limit: int = 10) -> List[Dict[str, Any]]:
+        """
+        Получает контекст диалога
+
+        Отложенные сообщения этого диалога берутся из буфера, а не
+        выталкиваются в базу общим flush(). Чтение годится, только если за
+        время запроса не начиналась и не шла запись пачки (_flush_epoch не
+        изменилась и четная): иначе строки могли попасть и в базу, и в
+        буфер — тогда дожидаемся пачки и читаем еще раз.
+        """
+        pool = await self._get_pool()
+        while True:
+            epoch = self._flush_epoch
+            if epoch % 2:
+                # Пачка пишется: ждем ее конца
+                async with self._flush_lock:
+                    pass
+                continue
+            pending = [
+                (record[2], self._pending_blobs[record[4]].data if record[4] else None,
+                 record[3], record[6], record[5])
+                for record in self._pending_context
+                if record[0] == user_id and record[1] == conversation_id
+            ]
+            rows = await pool.fetch("""
+                SELECT c.message_role, c.message_content, c.timestamp, c.token_count, b.data
+                FROM conversation_context c
+                LEFT JOIN answer_blobs b ON b.hash = c.content_hash
+                WHERE c.user_id = $1 AND c.conversation_id = $2
+                ORDER BY c.timestamp DESC, c.id DESC
+                LIMIT $3
+            """, user_id, conversation_id, limit)
+            if self._flush_epoch == epoch:
+                break
+
+        # В хронологическом порядке, время — строкой, как из SQLite; буфер новее базы
+        merged = [(row[0], row[4], row[1], row[2], row[3]) for row in reversed(rows)] + pending
+        return [
+            {
+                "role": role,
+                "content": unpack_text(data) if data is not None else content,
+                "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S") if timestamp else None,
+                "tokens": tokens,
+            }
+            for role, data, content, timestamp, tokens in (merged[-limit:] if limit > 0 else [])
+        ]
+
+    async def create_conversation_id(self) -> str:
+        """Создает уникальный ID для диалога"""
+        return str(uuid.uuid4())
+
+    async def cleanup_old_context(self, days: int = 7):
+        """Удаляет старый контекст диалогов"""
+        pool = await self._get_pool()
+        await pool.execute("DELETE FROM conversation_context WHERE timestamp < $1",
+                           datetime.now() - timedelta(days=days))
+        self.context_cache.invalidate()
+
+    # === КЭШ ОТВЕТОВ ===
+
+    async def get_cached_answer(self, cache_key: str, ttl_hours: int) -> Optional[Tuple[str, float]]:
+        """Получает ответ из кэша и его возраст в секундах, если он не старше ttl_hours"""
+        pool = await self._get_pool()
+        row = await pool.fetchrow("""
+            UPDATE answer_cache SET hits = hits + 1, last_hit_at = LOCALTIMESTAMP
+            WHERE cache_key = $1 AND created_at > LOCALTIMESTAMP - make_interval(hours => $2)
+            RETURNING response_text, EXTRACT(EPOCH FROM LOCALTIMESTAMP - created_at)::float8
+        """, cache_key, ttl_hours)
+        return (row[0], row[1]) if row else None
+
+    async def save_cached_answer(self, cache_key: str, subject: str, model: str,
+                                 response_text: str):
+        """Сохраняет ответ в кэш"""
+        pool = await self._get_pool()
+        await pool.execute("""
+            INSERT INTO answer_cache (cache_key, subject, model, response_text)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (cache_key) DO UPDATE SET
+                subject = EXCLUDED.subject,
+                model = EXCLUDED.model,
+                response_text = EXCLUDED.response_text,
+                hits = 0,
+                created_at = LOCALTIMESTAMP,
+                last_hit_at = LOCALTIMESTAMP
+        """, cache_key, subject, model, response_text)
+
+    async def evict_cached_answers(self, ttl_hours: int, max_rows: int) -> int:
+        """Удаляет устаревшие записи кэша и самые давно использованные сверх лимита"""
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                status = await conn.execute("""
+                    DELETE FROM answer_cache WHERE created_at < LOCALTIMESTAMP - make_interval(hours => $1)
+                """, ttl_hours)
+                deleted = _rowcount(status)
+
+                status = await conn.execute("""
+                    DELETE FROM answer_cache WHERE cache_key IN (
+                        SELECT cache_key FROM answer_cache
+                        ORDER BY last_hit_at DESC
+                        OFFSET $1
+                    )
+                """, max_rows)
+                return deleted + _rowcount(status)
+
+    # === КЭШ ОТВЕТОВ ПО ФОТО ===
+
+    async def get_image_answer(self, digest: bytes, caption_key: str, ttl_hours: int) -> Optional[str]:
+        """Получает ответ на то же фото с той же подписью, если он не старше ttl_hours"""
+        pool = await self._get_pool()
+        return await pool.fetchval("""
+            SELECT response_text FROM image_answers
+            WHERE digest = $1 AND caption_key = $2
+              AND created_at > LOCALTIMESTAMP - make_interval(hours => $3)
+        """, digest, caption_key, ttl_hours)
+
+    async def save_image_answer(self, digest: bytes, caption_key: str, subject: str,
+                                response_text: str):
+        """Сохраняет ответ на фото (прежний ответ для того же фото и подписи заменяется)"""
+        pool = await self._get_pool()
+        await pool.execute("""
+            INSERT INTO image_answers (digest, caption_key, subject, response_text)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (digest, caption_key) DO UPDATE SET
+                subject = EXCLUDED.subject,
+                response_text = EXCLUDED.response_text,
+                created_at = LOCALTIMESTAMP
+        """, digest, caption_key, subject, response_text)
+
+    async def evict_image_answers(self, ttl_hours: int, max_rows: int) -> int:
+        """Удаляет устаревшие ответы на фото и самые старые сверх лимита"""
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                status = await conn.execute("""
+                    DELETE FROM image_answers WHERE created_at < LOCALTIMESTAMP - make_interval(hours => $1)
+                """, ttl_hours)
+                deleted = _rowcount(status)
+
+                status = await conn.execute("""
+                    DELETE FROM image_answers WHERE id IN (
+                        SELECT id FROM image_answers
+                        ORDER BY created_at DESC
+                        OFFSET $1
+                    )
+                """, max_rows)
+                return deleted + _rowcount(status)
+
+    # === ПОДПИСКИ ===
+
+    async def set_subscription(self, user_id: int, is_active: bool = True,
+                               expires_at: datetime = None):
+        """Устанавливает подписку пользователя"""
+        self._subscription_cache.pop(user_id, None)
+
+        pool = await self._get_pool()
+        await pool.execute("""
+            INSERT INTO subscriptions (user_id, is_active, expires_at)
+            VALUES ($1, $2, $3)
+        """, user_id, is_active, expires_at)
+
+    async def get_subscription(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Получает информацию о подписке (последнюю запись)"""
+        pool = await self._get_pool()
+        row = await pool.fetchrow("""
+            SELECT * FROM subscriptions WHERE user_id = $1 ORDER BY id DESC LIMIT 1
+        """, user_id)
+        return dict(row) if row else None
+
+    async def has_active_subscription(self, user_id: int, cache_ttl: float = 60.0) -> bool:
+        """Проверяет, есть ли у пользователя действующая подписка (с кэшем на cache_ttl секунд)"""
+        cached = self._subscription_cache.get(user_id)
+        if cached and time.monotonic() - cached[1] < cache_ttl:
+            return cached[0]
+
+        pool = await self._get_pool()
+        active = await pool.fetchval("""
+            SELECT 1 FROM subscriptions
+            WHERE user_id = $1 AND is_active = TRUE
+              AND (expires_at IS NULL OR expires_at > LOCALTIMESTAMP)
+            LIMIT 1
+        """, user_id) is not None
+
+        if len(self._subscription_cache) > 10000:
+            self._subscription_cache.clear()
+        self._subscription_cache[user_id] = (active, time.monotonic())
+        return active
+
+    # === СТАТИСТИКА ===
+
+    async def get_user_stats(self, user_id: int) -> Dict[str, Any]:
+        """Получает статистику пользователя"""
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            total_requests = await conn.fetchval("SELECT COUNT(*) FROM requests WHERE user_id = $1", user_id)
+            recent_requests = await conn.fetchval("""
+                SELECT COUNT(*) FROM requests
+                WHERE user_id = $1 AND timestamp > LOCALTIMESTAMP - interval '7 days'
+            """, user_id)
+            rows = await conn.fetch("""
+                SELECT subject, COUNT(*) as count
+                FROM requests
+                WHERE user_id = $1 AND subject IS NOT NULL
+                GROUP BY subject
+                ORDER BY count DESC
+                LIMIT 3
+            """, user_id)
+
+        return {
+            "total_requests": total_requests,
+            "recent_requests": recent_requests,
+            "favorite_subjects": [{"subject": row[0], "count": row[1]} for row in rows]
+        }
+
+    async def get_database_stats(self) -> Dict[str, Any]:
+        """
+        Получает статистику базы данных
+
+        Число строк — оценка из pg_stat_user_tables, без COUNT(*); старые
+        данные считаются по индексам timestamp.
+        """
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT relname, n_live_tup FROM pg_stat_user_tables WHERE relname = ANY($1::text[])
+            """, list(COUNTED_TABLES))
+            estimates = {row[0]: row[1] for row in rows}
+            stats = {f"{table}_count": estimates.get(table, 0) for table in COUNTED_TABLES}
+
+            stats["database_size_bytes"] = await conn.fetchval("SELECT pg_database_size(current_database())")
+            stats["database_size_mb"] = round(stats["database_size_bytes"] / (1024 * 1024), 2)
+
+            stats["old_context_messages"] = await conn.fetchval("""
+                SELECT COUNT(*) FROM conversation_context WHERE timestamp < $1
+            """, datetime.now() - timedelta(days=7))
+            stats["old_requests"] = await conn.fetchval("""
+                SELECT COUNT(*) FROM requests WHERE timestamp < $1
+            """, datetime.now() - timedelta(days=30))
+        return stats
+
+    async def recount_table_stats(self) -> Dict[str, int]:
+        """Точный COUNT(*) по таблицам, возвращает расхождение оценки (оценка - точное)"""
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT relname, n_live_tup FROM pg_stat_user_tables WHERE relname = ANY($1::text[])
+            """, list(COUNTED_TABLES))
+            estimates = {row[0]: row[1] for row in rows}
+            drift = {}
+            for table in COUNTED_TABLES:
+                count = await conn.fetchval(f"SELECT COUNT(*) FROM {table}")
+                drift[table] = estimates.get(table, 0) - count
+        return drift
+
+    # === ДНЕВНЫЕ АГРЕГАТЫ ===
+
+    async def get_rollup_watermark(self, name: str) -> int:
+        """Последний id исходной таблицы, уже учтенный в агрегатах name"""
+        pool = await self._get_pool()
+        return await pool.fetchval("SELECT last_id FROM rollup_state WHERE name = $1", name) or 0
+
+    async def get_max_request_id(self) -> int:
+        """Наибольший requests.id (отставание агрегатов от водяного знака)"""
+        pool = await self._get_pool()
+        return await pool.fetchval("SELECT MAX(id) FROM requests") or 0
+
+    async def get_requests_after(self, after_id: int, limit: int) -> List[Tuple[int, str, str, str, int]]:
+        """
+        Запросы с id > after_id по порядку: (id, день, предмет, тип, user_id)
+
+        Останавливается на первом запросе, вставленном меньше ROLLUP_LAG
+        назад, чтобы водяной знак не обогнал еще не зафиксированные строки с
+        меньшим id. Сравнивается inserted_at — время сервера в момент
+        выдачи id, а не timestamp клиента: медленная пачка COPY получает id
+        позже, чем ставилась в очередь.
+        """
+        pool = await self._get_pool()
+        rows = await pool.fetch("""
+            SELECT id, COALESCE(to_char(timestamp, 'YYYY-MM-DD'), ''), COALESCE(subject, ''),
+                   COALESCE(request_type, ''), user_id,
+                   COALESCE(inserted_at >= clock_timestamp() - $3::interval, FALSE)
+            FROM requests
+            WHERE id > $1
+            ORDER BY id
+            LIMIT $2
+        """, after_id, limit, ROLLUP_LAG)
+
+        result = []
+        for row in rows:
+            if row[5]:
+                break
+            result.append((row[0], row[1], row[2], row[3], row[4]))
+        return result
+
+    async def apply_daily_rollup(self, name: str, counts: Dict[Tuple[str, str, str], int],
+                                 sketches: Dict[str, HyperLogLog], after_id: int, last_id: int) -> bool:
+        """
+        Добавляет порцию (after_id, last_id] к дневным агрегатам и сдвигает водяной знак
+
+        Строка rollup_state блокируется до конца транзакции: процессы бота
+        применяют порции по очереди, и каждая учитывается ровно один раз.
+        """
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    INSERT INTO rollup_state (name, last_id) VALUES ($1, 0)
+                    ON CONFLICT (name) DO NOTHING
+                """, name)
+                current = await conn.fetchval("""
+                    SELECT last_id FROM rollup_state WHERE name = $1 FOR UPDATE
+                """, name)
+                if current != after_id:
+                    return False
+
+                await conn.executemany("""
+                    INSERT INTO daily_rollup (day, subject, request_type, requests)
+                    VALUES ($1, $2, $3, $4)
+                    ON CONFLICT (day, subject, request_type)
+                    DO UPDATE SET requests = daily_rollup.requests + EXCLUDED.requests
+                """, [(day, subject, request_type, count)
+                      for (day, subject, request_type), count in counts.items()])
+
+                for day, sketch in sketches.items():
+                    data = await conn.fetchval("SELECT users_hll FROM daily_users WHERE day = $1", day)
+                    if data is not None:
+                        sketch.merge(HyperLogLog.from_bytes(data))
+                    await conn.execute("""
+                        INSERT INTO daily_users (day, users_hll) VALUES ($1, $2)
+                        ON CONFLICT (day) DO UPDATE SET users_hll = EXCLUDED.users_hll
+                    """, day, sketch.to_bytes())
+
+                await conn.execute("UPDATE rollup_state SET last_id = $2 WHERE name = $1", name, last_id)
+                return True
+
+    async def get_daily_rollup(self, days: int) -> List[Tuple[str, str, str, int]]:
+        """Агрегаты за последние days дней (UTC): (день, предмет, тип, запросов)"""
+        pool = await self._get_pool()
+        rows = await pool.fetch("""
+            SELECT day, subject, request_type, requests FROM daily_rollup
+            WHERE day >= to_char(LOCALTIMESTAMP - make_interval(days => $1), 'YYYY-MM-DD')
+            ORDER BY day
+        """, days - 1)
+        return [(row[0], row[1], row[2], row[3]) for row in rows]
+
+    async def get_daily_user_sketches(self, days: int) -> Dict[str, HyperLogLog]:
+        """Скетчи уникальных пользователей за последние days дней (UTC)"""
+        pool = await self._get_pool()
+        rows = await pool.fetch("""
+            SELECT day, users_hll FROM daily_users
+            WHERE day >= to_char(LOCALTIMESTAMP - make_interval(days => $1), 'YYYY-MM-DD')
+        """, days - 1)
+        return {row[0]: HyperLogLog.from_bytes(row[1]) for row in rows}
+
+    # === ЛИМИТЫ ЧАСТОТЫ ===
+
+    async def load_rate_limits(self, now: float) -> List[Tuple[int, float]]:
+        """Сохраненные состояния лимитов, еще не истекшие к now: [(user_id, TAT)]"""
+        pool = await self._get_pool()
+        rows = await pool.fetch("SELECT user_id, tat FROM rate_limits WHERE tat > $1", now)
+        return [(row[0], row[1]) for row in rows]
+
+    async def save_rate_limits(self, states: List[Tuple[int, float]], now: float):
+        """Сохраняет состояния лимитов (более поздний TAT побеждает) и удаляет истекшие"""
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("DELETE FROM rate_limits WHERE tat <= $1", now)
+                await conn.executemany("""
+                    INSERT INTO rate_limits (user_id, tat) VALUES ($1, $2)
+                    ON CONFLICT (user_id) DO UPDATE SET tat = GREATEST(rate_limits.tat, EXCLUDED.tat)
+                """, states)
+
+    # === ОЧИСТКА ДАННЫХ ===
+
+    async def delete_old_context(self, cutoff: datetime, limit: int) -> int:
+        """Удаляет до limit сообщений контекста старше cutoff"""
+        pool = await self._get_pool()
+        status = await pool.execute("""
+            DELETE FROM conversation_context WHERE id IN (
+                SELECT id FROM conversation_context
+                WHERE timestamp < $1
+                LIMIT $2
+            )
+        """, cutoff, limit)
+        deleted = _rowcount(status)
+        if deleted:
+            # Буфер контекста отключен, но сбрасывается как в DatabaseRepo
+            self.context_cache.invalidate()
+        return deleted
+
+    async def delete_old_requests(self, cutoff: datetime, limit: int, max_id: int) -> int:
+        """Удаляет до limit запросов старше cutoff с id <= max_id (уже учтенных в агрегатах)"""
+        pool = await self._get_pool()
+        status = await pool.execute("""
+            DELETE FROM requests WHERE id IN (
+                SELECT id FROM requests
+                WHERE timestamp < $1 AND id <= $2
+                LIMIT $3
+            )
+        """, cutoff, max_id, limit)
+        return _rowcount(status)
+
+    async def get_old_context(self, cutoff: datetime, limit: int) -> List[Tuple]:
+        """До limit сообщений контекста старше cutoff для архива, по времени (см. DatabaseRepo)"""
+        pool = await self._get_pool()
+        rows = await pool.fetch("""
+            SELECT c.id, c.user_id, c.conversation_id, c.message_role, c.message_content,
+                   c.token_count, c.timestamp, b.data
+            FROM conversation_context c
+            LEFT JOIN answer_blobs b ON b.hash = c.content_hash
+            WHERE c.timestamp < $1
+            ORDER BY c.timestamp
+            LIMIT $2
+        """, cutoff, limit)
+        return [(*row[:4], unpack_text(row[7]) if row[7] is not None else row[4], row[5], row[6])
+                for row in rows]
+
+    async def get_old_requests(self, cutoff: datetime, limit: int, max_id: int) -> List[Tuple]:
+        """До limit запросов старше cutoff с id <= max_id для архива, по времени (см. DatabaseRepo)"""
+        pool = await self._get_pool()
+        rows = await pool.fetch("""
+            SELECT r.id, r.user_id, r.request_text, r.request_type, r.subject,
+                   r.response_text, r.timestamp, b.data
+            FROM requests r
+            LEFT JOIN answer_blobs b ON b.hash = r.response_hash
+            WHERE r.timestamp < $1 AND r.id <= $2
+            ORDER BY r.timestamp
+            LIMIT $3
+        """, cutoff, max_id, limit)
+        return [(*row[:5], unpack_text(row[7]) if row[7] is not None else row[5], row[6])
+                for row in rows]
+
+    async def delete_context_rows(self, row_ids: List[int]) -> int:
+        """Удаляет сообщения контекста по id (после записи в архив)"""
+        pool = await self._get_pool()
+        status = await pool.execute("DELETE FROM conversation_context WHERE id = ANY($1::bigint[])", row_ids)
+        deleted = _rowcount(status)
+        if deleted:
+            self.context_cache.invalidate()
+        return deleted
+
+    async def delete_request_rows(self, row_ids: List[int]) -> int:
+        """Удаляет запросы по id (после записи в архив)"""
+        pool = await self._get_pool()
+        status = await pool.execute("DELETE FROM requests WHERE id = ANY($1::bigint[])", row_ids)
+        return _rowcount(status)
+
+    async def get_max_user_row_id(self) -> int:
+        """Наибольший users.id (граница обхода пользователей по диапазонам)"""
+        pool = await self._get_pool()
+        return await pool.fetchval("SELECT MAX(id) FROM users") or 0
+
+    async def delete_inactive_users(self, cutoff: datetime, after_id: int, until_id: int) -> int:
+        """Удаляет неактивных пользователей с id в (after_id, until_id] (см. DatabaseRepo)"""
+        pool = await self._get_pool()
+        status = await pool.execute("""
+            DELETE FROM users WHERE id IN (
+                SELECT u.id FROM users u
+                WHERE u.id > $1 AND u.id <= $2 AND u.updated_at < $3
+                  AND NOT EXISTS (SELECT 1 FROM requests r WHERE r.user_id = u.user_id)
+                  AND NOT EXISTS (SELECT 1 FROM conversation_context c WHERE c.user_id = u.user_id)
+                  AND NOT EXISTS (SELECT 1 FROM subscriptions s WHERE s.user_id = u.user_id)
+            )
+        """, after_id, until_id, cutoff)
+        if _rowcount(status):
+            self.known_users.forget()
+        return _rowcount(status)
+
+    async def delete_expired_subscriptions(self, cutoff: datetime, limit: int) -> int:
+        """Удаляет до limit неактивных подписок, истекших раньше cutoff"""
+        pool = await self._get_pool()
+        status = await pool.execute("""
+            DELETE FROM subscriptions WHERE id IN (
+                SELECT id FROM subscriptions
+                WHERE expires_at < $1 AND is_active = FALSE
+                LIMIT $2
+            )
+        """, cutoff, limit)
+        return _rowcount(status)
+
+    async def incremental_vacuum(self, pages: int) -> int:
+        """Место после удалений в PostgreSQL переиспользует autovacuum"""
+        return 0
+
+    async def vacuum_database(self):
+        """VACUUM ANALYZE всей базы (не блокирует чтение и запись)"""
+        pool = await self._get_pool()
+        await pool.execute("VACUUM (ANALYZE)")
+
+    async def delete_user_data(self, user_id: int):
+        """Полностью удаляет все данные пользователя (GDPR compliance)"""
+        await self.flush()
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("DELETE FROM conversation_context WHERE user_id = $1", user_id)
+                await conn.execute("DELETE FROM requests WHERE user_id = $1", user_id)
+                await conn.execute("DELETE FROM subscriptions WHERE user_id = $1", user_id)
+                await conn.execute("DELETE FROM users WHERE user_id = $1", user_id)
+        self._subscription_cache.pop(user_id, None)
+        self.known_users.forget(user_id)
+        self.context_cache.invalidate(user_id)
+        return True
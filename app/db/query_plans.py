@@ -0,0 +1,176 @@
+"""
+Проверка планов запросов DatabaseRepo
+
+Каждый метод репозитория выполняется на временной базе с включенной
+трассировкой SQL, для каждого выполненного запроса строится
+EXPLAIN QUERY PLAN. Горячие запросы (путь обработки сообщения) не должны
+читать таблицу или индекс целиком.
+"""
+import asyncio
+import inspect
+import sqlite3
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Set
+from ..utils.hll import HyperLogLog
+from .repo import DatabaseRepo
+
+
+USER_ID = 1001
+CONVERSATION_ID = f"user_{USER_ID}_main"
+
+
+class RepoCall(NamedTuple):
+    """Вызов метода репозитория для проверки"""
+    method: str
+    call: Callable[[DatabaseRepo], Awaitable[Any]]
+    hot: bool = True
+    # Почему полный проход допустим (для hot=False)
+    note: str = ""
+
+
+class StatementPlan(NamedTuple):
+    method: str
+    hot: bool
+    sql: str
+    plan: List[str]
+    scans: List[str]
+
+
+# Методы, которые не обращаются к таблицам или обслуживают саму базу
+NOT_QUERIES = {
+    "close", "flush", "init_db", "get_stats", "create_conversation_id",
+    "vacuum_database", "incremental_vacuum",
+}
+
+REPO_CALLS: List[RepoCall] = [
+    RepoCall("create_user", lambda r: r.create_user(USER_ID, "student", "Иван", "Петров")),
+    RepoCall("register_user", lambda r: r.register_user(USER_ID + 2, "newcomer", "Анна", None)),
+    RepoCall("get_user", lambda r: r.get_user(USER_ID)),
+    RepoCall("save_request", lambda r: r.save_request(USER_ID, "2+2", "text", "математика", "4")),
+    RepoCall("get_subject_samples", lambda r: r.get_subject_samples(1000), hot=False,
+             note="выгрузка для обучения, читает последние строки по id"),
+    RepoCall("save_message", lambda r: r.save_message(USER_ID, CONVERSATION_ID, "user", "2+2")),
+    RepoCall("get_conversation_context", lambda r: r.get_conversation_context(USER_ID, CONVERSATION_ID, 20)),
+    RepoCall("cleanup_old_context", lambda r: r.cleanup_old_context(7)),
+    RepoCall("get_cached_answer", lambda r: r.get_cached_answer("key-1", 168)),
+    RepoCall("save_cached_answer", lambda r: r.save_cached_answer("key-2", "математика", "gpt-4o-mini", "4")),
+    RepoCall("evict_cached_answers", lambda r: r.evict_cached_answers(168, 50000), hot=False,
+             note="вытеснение сверх лимита проходит индекс last_hit_at по порядку"),
+    RepoCall("get_image_answer", lambda r: r.get_image_answer(b"digest", "", 168)),
+    RepoCall("save_image_answer", lambda r: r.save_image_answer(b"digest-2", "", "математика", "ответ")),
+    RepoCall("evict_image_answers", lambda r: r.evict_image_answers(168, 20000), hot=False,
+             note="вытеснение сверх лимита проходит индекс created_at по порядку"),
+    RepoCall("set_subscription", lambda r: r.set_subscription(USER_ID, True, datetime.now() + timedelta(days=30))),
+    RepoCall("get_subscription", lambda r: r.get_subscription(USER_ID)),
+    RepoCall("has_active_subscription", lambda r: r.has_active_subscription(USER_ID, cache_ttl=0)),
+    RepoCall("get_user_stats", lambda r: r.get_user_stats(USER_ID)),
+    RepoCall("delete_unreferenced_blobs", lambda r: r.delete_unreferenced_blobs(500)),
+    RepoCall("delete_old_context", lambda r: r.delete_old_context(datetime.now() - timedelta(days=7), 500)),
+    RepoCall("delete_old_requests", lambda r: r.delete_old_requests(datetime.now() - timedelta(days=30), 500, 1000)),
+    RepoCall("get_old_context", lambda r: r.get_old_context(datetime.now() - timedelta(days=7), 500)),
+    RepoCall("get_old_requests", lambda r: r.get_old_requests(datetime.now() - timedelta(days=30), 500, 1000)),
+    RepoCall("delete_context_rows", lambda r: r.delete_context_rows([1, 2])),
+    RepoCall("delete_request_rows", lambda r: r.delete_request_rows([1, 2])),
+    RepoCall("get_max_user_row_id", lambda r: r.get_max_user_row_id()),
+    RepoCall("delete_inactive_users", lambda r: r.delete_inactive_users(datetime.now() - timedelta(days=90), 0, 500)),
+    RepoCall("delete_expired_subscriptions",
+             lambda r: r.delete_expired_subscriptions(datetime.now() - timedelta(days=30), 500), hot=False,
+             note="таблица подписок маленькая, условие по сроку и флагу"),
+    RepoCall("get_rollup_watermark", lambda r: r.get_rollup_watermark("requests")),
+    RepoCall("get_max_request_id", lambda r: r.get_max_request_id()),
+    RepoCall("get_requests_after", lambda r: r.get_requests_after(0, 5000)),
+    RepoCall("apply_daily_rollup", lambda r: r.apply_daily_rollup(
+        "requests", {("2024-01-01", "математика", "text"): 1}, {"2024-01-01": HyperLogLog()}, 0, 1)),
+    RepoCall("get_daily_rollup", lambda r: r.get_daily_rollup(7)),
+    RepoCall("get_daily_user_sketches", lambda r: r.get_daily_user_sketches(7)),
+    RepoCall("load_rate_limits", lambda r: r.load_rate_limits(0.0), hot=False,
+             note="загрузка состояния лимитов при старте"),
+    RepoCall("save_rate_limits", lambda r: r.save_rate_limits([(USER_ID, 2e9)], 1e9), hot=False,
+             note="периодический снимок, таблица — только активные за последний час"),
+    RepoCall("get_database_stats", lambda r: r.get_database_stats()),
+    RepoCall("recount_table_stats", lambda r: r.recount_table_stats(), hot=False,
+             note="сверка счетчиков по запросу (/stats exact), COUNT(*) по таблицам"),
+    RepoCall("delete_user_data", lambda r: r.delete_user_data(USER_ID + 1)),
+]
+
+
+def uncovered_methods() -> Set[str]:
+    """Публичные методы репозитория, для которых нет проверки"""
+    methods = {
+        name for name, fn in inspect.getmembers(DatabaseRepo, inspect.iscoroutinefunction)
+        if not name.startswith("_")
+    }
+    return methods - NOT_QUERIES - {c.method for c in REPO_CALLS}
+
+
+def full_scans(plan: List[str], tables: Set[str]) -> List[str]:
+    """
+    Шаги плана, читающие таблицу целиком
+
+    "SCAN t" и "SCAN t USING [COVERING] INDEX i" — полный проход, "SEARCH" —
+    поиск по индексу. Виртуальные таблицы (pragma_*) и подзапросы не считаются.
+    """
+    scans = []
+    for detail in plan:
+        words = detail.split()
+        if len(words) >= 2 and words[0] == "SCAN" and words[1] in tables:
+            scans.append(detail)
+    return scans
+
+
+async def seed(repo: DatabaseRepo):
+    """Несколько строк в каждой таблице, чтобы запросы шли по реальным путям"""
+    for user_id in (USER_ID, USER_ID + 1):
+        await repo.create_user(user_id, f"user{user_id}")
+        await repo.save_message(user_id, f"user_{user_id}_main", "user", "Реши 2+2")
+        await repo.save_message(user_id, f"user_{user_id}_main", "assistant", "4")
+        await repo.save_request(user_id, "Реши 2+2", "text", "математика", "4")
+        # Длинный ответ уходит в answer_blobs
+        await repo.save_message(user_id, f"user_{user_id}_main", "assistant", "Решение: 2+2=4. " * 20)
+        await repo.set_subscription(user_id, True)
+    await repo.save_cached_answer("key-1", "математика", "gpt-4o-mini", "4")
+    await repo.save_image_answer(b"digest", "", "математика", "ответ")
+    await repo.flush()
+
+
+async def collect_plans(db_path: str) -> List[StatementPlan]:
+    """Выполняет REPO_CALLS на базе db_path и возвращает планы всех запросов"""
+    repo = DatabaseRepo(db_path)
+    captured: Dict[int, List[str]] = {}
+    try:
+        await repo.init_db()
+        await seed(repo)
+
+        statements: List[str] = []
+        await repo.db.set_trace_callback(statements.append)
+        for index, check in enumerate(REPO_CALLS):
+            # Кэши репозитория не должны скрыть запрос к базе
+            repo.context_cache.invalidate()
+            repo.known_users.forget()
+            statements.clear()
+            await check.call(repo)
+            await repo.flush()
+            captured[index] = list(dict.fromkeys(statements))
+        await repo.db.set_trace_callback(None)
+    finally:
+        await repo.close()
+
+    conn = sqlite3.connect(db_path)
+    try:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        plans = []
+        for index, check in enumerate(REPO_CALLS):
+            for sql in captured[index]:
+                if not sql.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")):
+                    continue
+                plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+                plans.append(StatementPlan(check.method, check.hot, " ".join(sql.split()),
+                                           plan, full_scans(plan, tables)))
+        return plans
+    finally:
+        conn.close()
+
+
+def check_plans(db_path: str) -> List[StatementPlan]:
+    """Синхронная обертка над collect_plans"""
+    return asyncio.run(collect_plans(db_path))
@@ -4,136 +4,434 @@
 import aiosqlite
 import asyncio
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime, timedelta
+import time
 import uuid
 
 from ..config import config
+from .connections import SQLiteConnections
+from .base import AGE_BUCKET_TABLES, COUNTED_TABLES, POSTGRES_SCHEMES, SQLITE_SCHEME, StorageBackend
+from .context_cache import ConversationCache, ConversationKey
+from .user_cache import KnownUsers
+from .blobs import BLOB_MIN_LENGTH, PackedText, pack_text, should_pack, unpack_text
+from ..utils.tokens import count_tokens
+from ..utils.hll import HyperLogLog
+
+
+# Новый пользователь или изменившийся профиль; неизменную строку не трогает
+# (id, created_at и внешние ключи сохраняются, в отличие от INSERT OR REPLACE)
+UPSERT_USER_SQL = """
+    INSERT INTO users (user_id, username, first_name, last_name, updated_at)
+    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT (user_id) DO UPDATE SET
+        username = excluded.username,
+        first_name = excluded.first_name,
+        last_name = excluded.last_name,
+        updated_at = excluded.updated_at
+    WHERE users.username IS NOT excluded.username
+       OR users.first_name IS NOT excluded.first_name
+       OR users.last_name IS NOT excluded.last_name
+"""
 
 
 class DatabaseRepo:
-    """Репозиторий для работы с базой данных"""
+    """Репозиторий для работы с базой данных SQLite (реализация StorageBackend)"""
     
     def __init__(self, db_path: str = None):
         self.db_path = db_path or config.database_url
-        self._connection = None
+        self.db = SQLiteConnections(self.db_path)
+        
+        # Последние сообщения диалогов в памяти (сквозная запись в conversation_context)
+        self.context_cache = ConversationCache()
+        # Номер последней отложенной записи каждого диалога (см. SQLiteConnections.write_behind)
+        self._context_writes: Dict[ConversationKey, int] = {}
+        
+        # Пользователи, уже записанные в users (повторный /start не пишет в базу)
+        self.known_users = KnownUsers()
+        
+        # Кэш статуса подписки: user_id -> (активна, момент проверки)
+        self._subscription_cache: Dict[int, Tuple[bool, float]] = {}
         
         # Создаем директорию для базы данных, если она не существует
         db_dir = Path(self.db_path).parent
         if not db_dir.exists():
             db_dir.mkdir(parents=True, exist_ok=True)
     
-    async def get_connection(self) -> aiosqlite.Connection:
-        """Получает соединение с базой данных"""
-        if self._connection is None:
-            self._connection = await aiosqlite.connect(self.db_path)
-            # Включаем поддержку внешних ключей
-            await self._connection.execute("PRAGMA foreign_keys = ON")
-        return self._connection
-    
     async def close(self):
-        """Закрывает соединение с базой данных"""
-        if self._connection:
-            await self._connection.close()
-            self._connection = None
+        """Дописывает очередь изменений и закрывает соединения с базой данных"""
+        await self.db.close()
+    
+    async def flush(self):
+        """Дожидается фиксации отложенных записей"""
+        await self.db.flush()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика соединений (чтения, записи, очередь писателя), кэшей контекста и пользователей"""
+        return {
+            "connections": self.db.get_stats(),
+            "context_cache": self.context_cache.get_stats(),
+            "known_users": self.known_users.get_stats(),
+        }
     
     async def init_db(self):
         """Инициализирует базу данных"""
         try:
-            conn = await self.get_connection()
-            
             # Читаем схему из файла
             schema_path = Path(__file__).parent / "schema.sql"
             with open(schema_path, 'r', encoding='utf-8') as f:
                 schema_sql = f.read()
             
-            # Выполняем SQL команды
-            await conn.executescript(schema_sql)
-            await conn.commit()
+            async def apply_schema(conn: aiosqlite.Connection):
+                # Выполняем SQL команды
+                await conn.executescript(schema_sql)
+                await conn.commit()
+                
+                # Доводим существующую базу до текущей версии схемы
+                await self._migrate(conn)
+            
+            await self.db.write(apply_schema)
             
         except Exception as e:
             print(f"Ошибка инициализации БД: {e}")
             raise
     
+    # === МИГРАЦИИ ===
+    
+    async def _migrate(self, conn: aiosqlite.Connection):
+        """Применяет миграции, которых еще нет в базе (версия хранится в PRAGMA user_version)"""
+        cursor = await conn.execute("PRAGMA user_version")
+        version = (await cursor.fetchone())[0]
+        
+        for target_version, migration in self._migrations():
+            if version >= target_version:
+                continue
+            await migration(conn)
+            await conn.execute(f"PRAGMA user_version = {target_version}")
+            await conn.commit()
+            version = target_version
+    
+    def _migrations(self):
+        """Список миграций по порядку: (версия, функция)"""
+        return [
+            (1, self._migration_context_token_count),
+            (2, self._migration_covering_indexes),
+            (3, self._migration_incremental_vacuum),
+            (4, self._migration_table_counters),
+            (5, self._migration_daily_rollup),
+            (6, self._migration_answer_blobs),
+            (7, self._migration_image_answer_digest),
+            (8, self._migration_image_answers_by_digest),
+            (9, self._migration_request_subject_source),
+        ]
+    
+    async def _add_column_if_missing(self, conn: aiosqlite.Connection, table: str,
+                                     column: str, definition: str):
+        """Добавляет колонку, если ее нет (новые базы получают ее сразу из schema.sql)"""
+        cursor = await conn.execute(f"PRAGMA table_info({table})")
+        columns = {row[1] for row in await cursor.fetchall()}
+        if column not in columns:
+            await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    
+    async def _migration_context_token_count(self, conn: aiosqlite.Connection):
+        """Количество токенов сообщения контекста (старые строки считаются при чтении)"""
+        await self._add_column_if_missing(conn, "conversation_context", "token_count", "INTEGER")
+    
+    async def _migration_covering_indexes(self, conn: aiosqlite.Connection):
+        """
+        Составные индексы под горячие запросы вместо одноколоночных
+        
+        Новые индексы создает schema.sql; здесь удаляются старые, которые
+        стали префиксами составных или дублируют UNIQUE.
+        """
+        for index in ("idx_users_user_id", "idx_requests_user_id", "idx_requests_timestamp",
+                      "idx_context_user_id", "idx_context_conversation_id"):
+            await conn.execute(f"DROP INDEX IF EXISTS {index}")
+        # Статистика для планировщика по новым индексам (выборочно, чтобы не читать всю базу)
+        await conn.execute("PRAGMA analysis_limit = 1000")
+        await conn.execute("ANALYZE")
+    
+    async def _migration_incremental_vacuum(self, conn: aiosqlite.Connection):
+        """
+        auto_vacuum = INCREMENTAL: место после удалений возвращается понемногу
+        через incremental_vacuum, без полного VACUUM на работающем боте
+        
+        Режим меняется только полной перестройкой файла — один раз, при запуске.
+        """
+        cursor = await conn.execute("PRAGMA auto_vacuum")
+        if (await cursor.fetchone())[0] == 2:
+            return
+        await conn.commit()
+        await conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await conn.execute("VACUUM")
+    
+    async def _migration_table_counters(self, conn: aiosqlite.Connection):
+        """Начальные значения счетчиков строк (таблицы и триггеры создает schema.sql)"""
+        await self._recount_table_stats(conn)
+    
+    async def _migration_daily_rollup(self, conn: aiosqlite.Connection):
+        """
+        daily_rollup вместо представления daily_stats
+        
+        Таблицы создает schema.sql; существующие запросы попадут в агрегаты
+        при первом проходе DailyRollup (водяной знак начинается с 0).
+        """
+        await conn.execute("DROP VIEW IF EXISTS daily_stats")
+    
+    async def _migration_answer_blobs(self, conn: aiosqlite.Connection):
+        """
+        Длинные тексты существующих запросов и сообщений — в answer_blobs
+        
+        Фиксируется по частям: прерванная миграция продолжится со строк, у
+        которых еще нет ссылки. Освободившиеся страницы вернет incremental_vacuum
+        при очистке.
+        """
+        await self._add_column_if_missing(conn, "requests", "response_hash", "BLOB")
+        await self._add_column_if_missing(conn, "conversation_context", "content_hash", "BLOB")
+        
+        for table, text_column, hash_column, empty in (
+                ("requests", "response_text", "response_hash", None),
+                ("conversation_context", "message_content", "content_hash", "")):
+            last_id = 0
+            while True:
+                cursor = await conn.execute(f"""
+                    SELECT id, {text_column} FROM {table}
+                    WHERE id > ? AND {hash_column} IS NULL AND LENGTH({text_column}) >= ?
+                    ORDER BY id
+                    LIMIT 1000
+                """, (last_id, BLOB_MIN_LENGTH))
+                rows = await cursor.fetchall()
+                if not rows:
+                    break
+                
+                updates = []
+                for row_id, text in rows:
+                    blob = pack_text(text)
+                    await self._save_blob(conn, blob)
+                    updates.append((empty, blob.key, row_id))
+                await conn.executemany(f"""
+                    UPDATE {table} SET {text_column} = ?, {hash_column} = ? WHERE id = ?
+                """, updates)
+                await conn.commit()
+                last_id = rows[-1][0]
+    
+    async def _migration_image_answer_digest(self, conn: aiosqlite.Connection):
+        """Дайджест фото в image_answers (старые строки без него не отдаются)"""
+        await self._add_column_if_missing(conn, "image_answers", "digest", "BLOB")
+    
+    async def _migration_image_answers_by_digest(self, conn: aiosqlite.Connection):
+        """
+        image_answers по (дайджест, подпись) вместо перцептивного хэша
+        
+        Строки без дайджеста и повторы одного ключа удаляются (это кэш),
+        колонка phash — тоже. Уникальный индекс создается здесь, а не в
+        schema.sql: в старой базе колонки digest до миграции 7 нет.
+        """
+        cursor = await conn.execute("PRAGMA table_info(image_answers)")
+        if "phash" in {row[1] for row in await cursor.fetchall()}:
+            await conn.execute("""
+                DELETE FROM image_answers
+                WHERE digest IS NULL
+                   OR id NOT IN (SELECT MAX(id) FROM image_answers GROUP BY digest, caption_key)
+            """)
+            await conn.execute("ALTER TABLE image_answers DROP COLUMN phash")
+        await conn.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_image_answers_digest
+            ON image_answers(digest, caption_key)
+        """)
+    
+    async def _migration_request_subject_source(self, conn: aiosqlite.Connection):
+        """Источник и уверенность метки предмета (у старых запросов неизвестны, в обучение не идут)"""
+        await self._add_column_if_missing(conn, "requests", "subject_source", "TEXT")
+        await self._add_column_if_missing(conn, "requests", "subject_confidence", "REAL")
+    
     # === ПОЛЬЗОВАТЕЛИ ===
     
     async def create_user(self, user_id: int, username: str = None, 
                          first_name: str = None, last_name: str = None):
-        """Создает или обновляет пользователя"""
-        conn = await self.get_connection()
+        """Создает или обновляет пользователя (без записи, если профиль не менялся)"""
+        fingerprint = KnownUsers.fingerprint(username, first_name, last_name)
+        if self.known_users.is_current(user_id, fingerprint):
+            return
         
-        await conn.execute("""
-            INSERT OR REPLACE INTO users (user_id, username, first_name, last_name, updated_at)
-            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-        """, (user_id, username, first_name, last_name))
+        await self.db.write(lambda conn: conn.execute(
+            UPSERT_USER_SQL, (user_id, username, first_name, last_name)))
+        self.known_users.remember(user_id, fingerprint)
+    
+    async def register_user(self, user_id: int, username: str = None,
+                            first_name: str = None, last_name: str = None):
+        """
+        Регистрирует автора сообщения, если его еще нет (пользователь мог не
+        присылать /start)
         
-        await conn.commit()
+        Запись отложенная и уходит пачкой в той же очереди писателя перед
+        сообщениями и запросами пользователя, поэтому внешние ключи на users
+        уже выполнены. Если запись не удалась, пользователь забывается и
+        следующее сообщение зарегистрирует его снова.
+        """
+        fingerprint = KnownUsers.fingerprint(username, first_name, last_name)
+        if self.known_users.is_current(user_id, fingerprint):
+            return
+        
+        async def upsert(conn: aiosqlite.Connection):
+            try:
+                await conn.execute(UPSERT_USER_SQL, (user_id, username, first_name, last_name))
+            except Exception:
+                self.known_users.forget(user_id)
+                raise
+        
+        await self.db.write_behind(upsert)
+        self.known_users.remember(user_id, fingerprint)
     
     async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Получает пользователя по ID"""
-        conn = await self.get_connection()
-        
-        cursor = await conn.execute("""
-            SELECT * FROM users WHERE user_id = ?
-        """, (user_id,))
+        async with self.db.reader() as conn:
+            cursor = await conn.execute("""
+                SELECT * FROM users WHERE user_id = ?
+            """, (user_id,))
+            row = await cursor.fetchone()
         
-        row = await cursor.fetchone()
         if row:
             columns = [description[0] for description in cursor.description]
             return dict(zip(columns, row))
         return None
     
+    # === ХРАНИЛИЩЕ ТЕКСТОВ ===
+    
+    async def _save_blob(self, conn: aiosqlite.Connection, blob: Optional[PackedText]):
+        """Кладет сжатый текст в answer_blobs, если такого еще нет (ссылки считают триггеры)"""
+        if blob is None:
+            return
+        await conn.execute("""
+            INSERT INTO answer_blobs (hash, data, size) VALUES (?, ?, ?)
+            ON CONFLICT (hash) DO NOTHING
+        """, (blob.key, blob.data, blob.size))
+    
+    async def delete_unreferenced_blobs(self, limit: int) -> int:
+        """Удаляет до limit текстов, на которые больше нет ссылок"""
+        cursor = await self.db.write(lambda conn: conn.execute("""
+            DELETE FROM answer_blobs WHERE id IN (
+                SELECT id FROM answer_blobs
+                WHERE refs <= 0
+                LIMIT ?
+            )
+        """, (limit,)))
+        return cursor.rowcount
+    
     # === ЗАПРОСЫ ===
     
     async def save_request(self, user_id: int, request_text: str = None, 
                           request_type: str = "text", subject: str = None, 
-                          response_text: str = None):
-        """Сохраняет запрос пользователя"""
-        conn = await self.get_connection()
+                          response_text: str = None, subject_source: str = None,
+                          subject_confidence: float = None):
+        """
+        Сохраняет запрос пользователя (запись отложенная, фиксируется пачкой)
         
-        await conn.execute("""
-            INSERT INTO requests (user_id, request_text, request_type, subject, response_text)
-            VALUES (?, ?, ?, ?, ?)
-        """, (user_id, request_text, request_type, subject, response_text))
+        subject_source — откуда взялся предмет (SOURCE_* из utils.subjects).
+        """
+        # Длинный ответ хранится сжатым в answer_blobs, одна копия на одинаковые ответы
+        blob = pack_text(response_text) if should_pack(response_text) else None
         
-        await conn.commit()
+        async def save(conn: aiosqlite.Connection):
+            await self._save_blob(conn, blob)
+            await conn.execute("""
+                INSERT INTO requests (user_id, request_text, request_type, subject,
+                                      response_text, response_hash, subject_source, subject_confidence)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (user_id, request_text, request_type, subject,
+                  None if blob else response_text, blob.key if blob else None,
+                  subject_source, subject_confidence))
+        
+        await self.db.write_behind(save)
+    
+    async def get_subject_samples(self, limit: int = 200000,
+                                  min_confidence: float = 0.0) -> List[Tuple[str, str]]:
+        """
+        Тексты задач с предметом для обучения классификатора (новые первыми)
+        
+        Только метки по ключевым словам: предмет по умолчанию и предсказания
+        самой модели (обучение на них закрепляло бы ее же ошибки) не берутся.
+        """
+        async with self.db.reader() as conn:
+            cursor = await conn.execute("""
+                SELECT request_text, subject FROM requests
+                WHERE request_type = 'text' AND subject_source = 'keywords'
+                  AND subject_confidence >= ?
+                  AND request_text IS NOT NULL AND request_text != ''
+                ORDER BY id DESC
+                LIMIT ?
+            """, (min_confidence, limit))
+            return [(row[0], row[1]) for row in await cursor.fetchall()]
     
     # === КОНТЕКСТ ДИАЛОГОВ ===
     
     async def save_message(self, user_id: int, conversation_id: str, 
                           role: str, content: str):
-        """Сохраняет сообщение в контекст диалога"""
-        conn = await self.get_connection()
+        """Сохраняет сообщение в контекст диалога (запись отложенная, фиксируется пачкой)"""
+        token_count = count_tokens(content)
+        self.context_cache.append((user_id, conversation_id), role, content, token_count)
+        blob = pack_text(content) if should_pack(content) else None
         
-        await conn.execute("""
-            INSERT INTO conversation_context (user_id, conversation_id, message_role, message_content)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, conversation_id, role, content))
+        async def save(conn: aiosqlite.Connection):
+            await self._save_blob(conn, blob)
+            await conn.execute("""
+                INSERT INTO conversation_context (user_id, conversation_id, message_role, message_content,
+                                                  content_hash, token_count)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (user_id, conversation_id, role, "" if blob else content,
+                  blob.key if blob else None, token_count))
         
-        await conn.commit()
+        key = (user_id, conversation_id)
+        self._context_writes[key] = await self.db.write_behind(save)
+        if len(self._context_writes) > config.db_write_queue_size:
+            # Незаписанных больше, чем вмещает очередь, быть не может: чистим обработанные
+            self._context_writes = {k: ticket for k, ticket in self._context_writes.items()
+                                    if not self.db.is_written(ticket)}
     
     async def get_conversation_context(self, user_id: int, conversation_id: str, 
                                      limit: int = 10) -> List[Dict[str, Any]]:
-        """Получает контекст диалога"""
-        conn = await self.get_connection()
-        
-        cursor = await conn.execute("""
-            SELECT message_role, message_content, timestamp
-            FROM conversation_context
-            WHERE user_id = ? AND conversation_id = ?
-            ORDER BY timestamp DESC
-            LIMIT ?
-        """, (user_id, conversation_id, limit))
-        
-        rows = await cursor.fetchall()
-        return [
-            {
-                "role": row[0],
-                "content": row[1],
-                "timestamp": row[2]
-            }
-            for row in reversed(rows)  # Возвращаем в хронологическом порядке
-        ]
+        """Получает контекст диалога (из буфера в памяти, при промахе — из базы)"""
+        key = (user_id, conversation_id)
+        cached = self.context_cache.get(key, limit)
+        if cached is not None:
+            return cached
+        
+        # Буфер заполняем целиком, чтобы он отвечал и на более короткие запросы
+        cacheable = self.context_cache.enabled and limit <= self.context_cache.capacity
+        fetch = self.context_cache.capacity if cacheable else limit
+        if cacheable:
+            self.context_cache.begin_load(key)
+        
+        try:
+            # Отложенные записи этого диалога могли еще не дойти до базы: ждем
+            # только их пачку, а не всю очередь писателя
+            ticket = self._context_writes.get(key)
+            if ticket is not None:
+                await self.db.wait_written(ticket)
+                if self._context_writes.get(key) == ticket:
+                    del self._context_writes[key]
+            
+            async with self.db.reader() as conn:
+                cursor = await conn.execute("""
+                    SELECT c.message_role, c.message_content, c.timestamp, c.token_count, b.data
+                    FROM conversation_context c
+                    LEFT JOIN answer_blobs b ON b.hash = c.content_hash
+                    WHERE c.user_id = ? AND c.conversation_id = ?
+                    ORDER BY c.timestamp DESC, c.id DESC
+                    LIMIT ?
+                """, (user_id, conversation_id, fetch))
+                rows = await cursor.fetchall()
+        except Exception:
+            if cacheable:
+                self.context_cache.abort_load(key)
+            raise
+        
+        # В хронологическом порядке
+        entries = [(row[0], unpack_text(row[4]) if row[4] is not None else row[1], row[2], row[3])
+                   for row in reversed(rows)]
+        if cacheable:
+            self.context_cache.finish_load(key, entries)
+        return self.context_cache.to_dicts(entries[-limit:] if limit > 0 else [])
     
     async def create_conversation_id(self) -> str:
         """Создает уникальный ID для диалога"""
@@ -141,78 +439,183 @@ class DatabaseRepo:
     
     async def cleanup_old_context(self, days: int = 7):
         """Удаляет старый контекст диалогов"""
-        conn = await self.get_connection()
-        
         cutoff_date = datetime.now() - timedelta(days=days)
         
-        await conn.execute("""
+        await self.db.write(lambda conn: conn.execute("""
             DELETE FROM conversation_context
             WHERE timestamp < ?
-        """, (cutoff_date,))
+        """, (cutoff_date,)))
+        self.context_cache.invalidate()
+    
+    # === КЭШ ОТВЕТОВ ===
+    
+    async def get_cached_answer(self, cache_key: str, ttl_hours: int) -> Optional[Tuple[str, float]]:
+        """Получает ответ из кэша и его возраст в секундах, если он не старше ttl_hours"""
+        async with self.db.reader() as conn:
+            cursor = await conn.execute("""
+                SELECT response_text, (julianday('now') - julianday(created_at)) * 86400
+                FROM answer_cache
+                WHERE cache_key = ? AND created_at > datetime('now', ?)
+            """, (cache_key, f"-{ttl_hours} hours"))
+            row = await cursor.fetchone()
         
-        await conn.commit()
+        if not row:
+            return None
+        
+        await self.db.write_behind(lambda conn: conn.execute("""
+            UPDATE answer_cache SET hits = hits + 1, last_hit_at = CURRENT_TIMESTAMP
+            WHERE cache_key = ?
+        """, (cache_key,)))
+        return row[0], row[1]
+    
+    async def save_cached_answer(self, cache_key: str, subject: str, model: str,
+                                 response_text: str):
+        """Сохраняет ответ в кэш"""
+        await self.db.write_behind(lambda conn: conn.execute("""
+            INSERT OR REPLACE INTO answer_cache (cache_key, subject, model, response_text)
+            VALUES (?, ?, ?, ?)
+        """, (cache_key, subject, model, response_text)))
+    
+    async def evict_cached_answers(self, ttl_hours: int, max_rows: int) -> int:
+        """Удаляет устаревшие записи кэша и самые давно использованные сверх лимита"""
+        async def evict(conn: aiosqlite.Connection) -> int:
+            cursor = await conn.execute("""
+                DELETE FROM answer_cache WHERE created_at < datetime('now', ?)
+            """, (f"-{ttl_hours} hours",))
+            deleted = cursor.rowcount
+            
+            cursor = await conn.execute("""
+                DELETE FROM answer_cache WHERE cache_key IN (
+                    SELECT cache_key FROM answer_cache
+                    ORDER BY last_hit_at DESC
+                    LIMIT -1 OFFSET ?
+                )
+            """, (max_rows,))
+            return deleted + cursor.rowcount
+        
+        return await self.db.write(evict)
+    
+    # === КЭШ ОТВЕТОВ ПО ФОТО ===
+    
+    async def get_image_answer(self, digest: bytes, caption_key: str, ttl_hours: int) -> Optional[str]:
+        """Получает ответ на то же фото с той же подписью, если он не старше ttl_hours"""
+        async with self.db.reader() as conn:
+            cursor = await conn.execute("""
+                SELECT response_text FROM image_answers
+                WHERE digest = ? AND caption_key = ? AND created_at > datetime('now', ?)
+            """, (digest, caption_key, f"-{ttl_hours} hours"))
+            row = await cursor.fetchone()
+        
+        return row[0] if row else None
+    
+    async def save_image_answer(self, digest: bytes, caption_key: str, subject: str,
+                                response_text: str):
+        """Сохраняет ответ на фото (прежний ответ для того же фото и подписи заменяется)"""
+        await self.db.write(lambda conn: conn.execute("""
+            INSERT INTO image_answers (digest, caption_key, subject, response_text)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (digest, caption_key) DO UPDATE SET
+                subject = excluded.subject,
+                response_text = excluded.response_text,
+                created_at = CURRENT_TIMESTAMP
+        """, (digest, caption_key, subject, response_text)))
+    
+    async def evict_image_answers(self, ttl_hours: int, max_rows: int) -> int:
+        """Удаляет устаревшие ответы на фото и самые старые сверх лимита"""
+        async def evict(conn: aiosqlite.Connection) -> int:
+            cursor = await conn.execute("""
+                DELETE FROM image_answers WHERE created_at < datetime('now', ?)
+            """, (f"-{ttl_hours} hours",))
+            deleted = cursor.rowcount
+            
+            cursor = await conn.execute("""
+                DELETE FROM image_answers WHERE id IN (
+                    SELECT id FROM image_answers
+                    ORDER BY created_at DESC
+                    LIMIT -1 OFFSET ?
+                )
+            """, (max_rows,))
+            return deleted + cursor.rowcount
+        
+        return await self.db.write(evict)
     
     # === ПОДПИСКИ ===
     
     async def set_subscription(self, user_id: int, is_active: bool = True, 
                               expires_at: datetime = None):
         """Устанавливает подписку пользователя"""
-        conn = await self.get_connection()
+        self._subscription_cache.pop(user_id, None)
         
-        await conn.execute("""
+        await self.db.write(lambda conn: conn.execute("""
             INSERT OR REPLACE INTO subscriptions (user_id, is_active, expires_at)
             VALUES (?, ?, ?)
-        """, (user_id, is_active, expires_at))
-        
-        await conn.commit()
+        """, (user_id, is_active, expires_at)))
     
     async def get_subscription(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Получает информацию о подписке"""
-        conn = await self.get_connection()
-        
-        cursor = await conn.execute("""
-            SELECT * FROM subscriptions WHERE user_id = ?
-        """, (user_id,))
+        async with self.db.reader() as conn:
+            cursor = await conn.execute("""
+                SELECT * FROM subscriptions WHERE user_id = ?
+            """, (user_id,))
+            row = await cursor.fetchone()
         
-        row = await cursor.fetchone()
         if row:
             columns = [description[0] for description in cursor.description]
             return dict(zip(columns, row))
         return None
     
+    async def has_active_subscription(self, user_id: int, cache_ttl: float = 60.0) -> bool:
+        """Проверяет, есть ли у пользователя действующая подписка (с кэшем на cache_ttl секунд)"""
+        cached = self._subscription_cache.get(user_id)
+        if cached and time.monotonic() - cached[1] < cache_ttl:
+            return cached[0]
+        
+        async with self.db.reader() as conn:
+            cursor = await conn.execute("""
+                SELECT 1 FROM subscriptions
+                WHERE user_id = ? AND is_active = TRUE
+                  AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
+                LIMIT 1
+            """, (user_id,))
+            active = await cursor.fetchone() is not None
+        
+        if len(self._subscription_cache) > 10000:
+            self._subscription_cache.clear()
+        self._subscription_cache[user_id] = (active, time.monotonic())
+        return active
+    
     # === СТАТИСТИКА ===
     
     async def get_user_stats(self, user_id: int) -> Dict[str, Any]:
         """Получает статистику пользователя"""
-        conn = await self.get_connection()
-        
-        # Общее количество запросов
-        cursor = await conn.execute("""
-            SELECT COUNT(*) FROM requests WHERE user_id = ?
-        """, (user_id,))
-        total_requests = (await cursor.fetchone())[0]
-        
-        # Запросы за последние 7 дней
-        cursor = await conn.execute("""
-            SELECT COUNT(*) FROM requests 
-            WHERE user_id = ? AND timestamp > datetime('now', '-7 days')
-        """, (user_id,))
-        recent_requests = (await cursor.fetchone())[0]
-        
-        # Любимые предметы
-        cursor = await conn.execute("""
-            SELECT subject, COUNT(*) as count
-            FROM requests 
-            WHERE user_id = ? AND subject IS NOT NULL
-            GROUP BY subject
-            ORDER BY count DESC
-            LIMIT 3
-        """, (user_id,))
-        
-        favorite_subjects = [
-            {"subject": row[0], "count": row[1]}
-            for row in await cursor.fetchall()
-        ]
+        async with self.db.reader() as conn:
+            # Общее количество запросов
+            cursor = await conn.execute("""
+                SELECT COUNT(*) FROM requests WHERE user_id = ?
+            """, (user_id,))
+            total_requests = (await cursor.fetchone())[0]
+            
+            # Запросы за последние 7 дней
+            cursor = await conn.execute("""
+                SELECT COUNT(*) FROM requests 
+                WHERE user_id = ? AND timestamp > datetime('now', '-7 days')
+            """, (user_id,))
+            recent_requests = (await cursor.fetchone())[0]
+            
+            # Любимые предметы
+            cursor = await conn.execute("""
+                SELECT subject, COUNT(*) as count
+                FROM requests 
+                WHERE user_id = ? AND subject IS NOT NULL
+                GROUP BY subject
+                ORDER BY count DESC
+                LIMIT 3
+            """, (user_id,))
+            
+            favorite_subjects = [
+                {"subject": row[0], "count": row[1]}
+                for row in await cursor.fetchall()
+            ]
         
         return {
             "total_requests": total_requests,
@@ -220,122 +623,363 @@ class DatabaseRepo:
             "favorite_subjects": favorite_subjects
         }
     
-    # === ОЧИСТКА ДАННЫХ ===
+    # === ДНЕВНЫЕ АГРЕГАТЫ ===
     
-    async def cleanup_old_data(self, days: int = 7):
-        """Удаляет старые данные для экономии места"""
-        conn = await self.get_connection()
-        cutoff_date = datetime.now() - timedelta(days=days)
-        
-        try:
-            # Удаляем старый контекст диалогов
+    async def get_rollup_watermark(self, name: str) -> int:
+        """Последний id исходной таблицы, уже учтенный в агрегатах name"""
+        async with self.db.reader() as conn:
+            cursor = await conn.execute("SELECT last_id FROM rollup_state WHERE name = ?", (name,))
+            row = await cursor.fetchone()
+            return row[0] if row else 0
+    
+    async def get_max_request_id(self) -> int:
+        """Наибольший requests.id (отставание агрегатов от водяного знака)"""
+        async with self.db.reader() as conn:
+            cursor = await conn.execute("SELECT MAX(id) FROM requests")
+            row = await cursor.fetchone()
+        return row[0] or 0
+    
+    async def get_requests_after(self, after_id: int, limit: int) -> List[Tuple[int, str, str, str, int]]:
+        """Запросы с id > after_id по порядку: (id, день, предмет, тип, user_id)"""
+        async with self.db.reader() as conn:
             cursor = await conn.execute("""
-                DELETE FROM conversation_context
-                WHERE timestamp < ?
-            """, (cutoff_date,))
-            context_deleted = cursor.rowcount
+                SELECT id, COALESCE(DATE(timestamp), ''), COALESCE(subject, ''),
+                       COALESCE(request_type, ''), user_id
+                FROM requests
+                WHERE id > ?
+                ORDER BY id
+                LIMIT ?
+            """, (after_id, limit))
+            return await cursor.fetchall()
+    
+    async def apply_daily_rollup(self, name: str, counts: Dict[Tuple[str, str, str], int],
+                                 sketches: Dict[str, HyperLogLog], after_id: int, last_id: int) -> bool:
+        """
+        Добавляет порцию (after_id, last_id] к дневным агрегатам и сдвигает водяной знак
+        
+        Все в одной транзакции: порция учитывается ровно один раз. Если
+        водяной знак уже не after_id (порцию учел другой проход), ничего не
+        меняется и возвращается False.
+        """
+        async def apply(conn: aiosqlite.Connection) -> bool:
+            cursor = await conn.execute("SELECT last_id FROM rollup_state WHERE name = ?", (name,))
+            row = await cursor.fetchone()
+            if (row[0] if row else 0) != after_id:
+                return False
+            
+            await conn.executemany("""
+                INSERT INTO daily_rollup (day, subject, request_type, requests)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (day, subject, request_type) DO UPDATE SET requests = requests + excluded.requests
+            """, [(day, subject, request_type, count)
+                  for (day, subject, request_type), count in counts.items()])
             
-            # Удаляем старые запросы (оставляем только последние 30 дней)
-            old_requests_cutoff = datetime.now() - timedelta(days=30)
+            for day, sketch in sketches.items():
+                cursor = await conn.execute("SELECT users_hll FROM daily_users WHERE day = ?", (day,))
+                row = await cursor.fetchone()
+                if row:
+                    sketch.merge(HyperLogLog.from_bytes(row[0]))
+                await conn.execute("""
+                    INSERT INTO daily_users (day, users_hll) VALUES (?, ?)
+                    ON CONFLICT (day) DO UPDATE SET users_hll = excluded.users_hll
+                """, (day, sketch.to_bytes()))
+            
+            await conn.execute("""
+                INSERT INTO rollup_state (name, last_id) VALUES (?, ?)
+                ON CONFLICT (name) DO UPDATE SET last_id = excluded.last_id
+            """, (name, last_id))
+            return True
+        
+        return await self.db.write(apply)
+    
+    async def get_daily_rollup(self, days: int) -> List[Tuple[str, str, str, int]]:
+        """Агрегаты за последние days дней (UTC): (день, предмет, тип, запросов)"""
+        async with self.db.reader() as conn:
+            cursor = await conn.execute("""
+                SELECT day, subject, request_type, requests FROM daily_rollup
+                WHERE day >= DATE('now', ?)
+                ORDER BY day
+            """, (f"-{days - 1} days",))
+            return await cursor.fetchall()
+    
+    async def get_daily_user_sketches(self, days: int) -> Dict[str, HyperLogLog]:
+        """Скетчи уникальных пользователей за последние days дней (UTC)"""
+        async with self.db.reader() as conn:
             cursor = await conn.execute("""
-                DELETE FROM requests
+                SELECT day, users_hll FROM daily_users
+                WHERE day >= DATE('now', ?)
+            """, (f"-{days - 1} days",))
+            return {day: HyperLogLog.from_bytes(data) for day, data in await cursor.fetchall()}
+    
+    # === ЛИМИТЫ ЧАСТОТЫ ===
+    
+    async def load_rate_limits(self, now: float) -> List[Tuple[int, float]]:
+        """Сохраненные состояния лимитов, еще не истекшие к now: [(user_id, TAT)]"""
+        async with self.db.reader() as conn:
+            cursor = await conn.execute("SELECT user_id, tat FROM rate_limits WHERE tat > ?", (now,))
+            return [(row[0], row[1]) for row in await cursor.fetchall()]
+    
+    async def save_rate_limits(self, states: List[Tuple[int, float]], now: float):
+        """Сохраняет состояния лимитов (более поздний TAT побеждает) и удаляет истекшие"""
+        async def save(conn: aiosqlite.Connection):
+            await conn.execute("DELETE FROM rate_limits WHERE tat <= ?", (now,))
+            await conn.executemany("""
+                INSERT INTO rate_limits (user_id, tat) VALUES (?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET tat = MAX(rate_limits.tat, excluded.tat)
+            """, states)
+        
+        await self.db.write(save)
+    
+    # === ОЧИСТКА ДАННЫХ ===
+    
+    # Удаление идет небольшими пачками по первичному ключу, каждая пачка —
+    # отдельная короткая транзакция писателя (см. app/db/retention.py)
+    
+    async def delete_old_context(self, cutoff: datetime, limit: int) -> int:
+        """Удаляет до limit сообщений контекста старше cutoff"""
+        cursor = await self.db.write(lambda conn: conn.execute("""
+            DELETE FROM conversation_context WHERE id IN (
+                SELECT id FROM conversation_context
                 WHERE timestamp < ?
-            """, (old_requests_cutoff,))
-            requests_deleted = cursor.rowcount
-            
-            # Удаляем неактивных пользователей (не заходили больше 90 дней)
-            inactive_users_cutoff = datetime.now() - timedelta(days=90)
+                LIMIT ?
+            )
+        """, (cutoff, limit)))
+        if cursor.rowcount:
+            # Буферы диалогов в памяти могли держать удаленные сообщения
+            self.context_cache.invalidate()
+        return cursor.rowcount
+    
+    async def delete_old_requests(self, cutoff: datetime, limit: int, max_id: int) -> int:
+        """Удаляет до limit запросов старше cutoff с id <= max_id (уже учтенных в агрегатах)"""
+        cursor = await self.db.write(lambda conn: conn.execute("""
+            DELETE FROM requests WHERE id IN (
+                SELECT id FROM requests
+                WHERE timestamp < ? AND id <= ?
+                LIMIT ?
+            )
+        """, (cutoff, max_id, limit)))
+        return cursor.rowcount
+    
+    async def get_old_context(self, cutoff: datetime, limit: int) -> List[Tuple]:
+        """
+        До limit сообщений контекста старше cutoff для архива, по времени
+        
+        Returns:
+            [(id, user_id, conversation_id, роль, текст, токены, время)]
+        """
+        async with self.db.reader() as conn:
             cursor = await conn.execute("""
-                DELETE FROM users
-                WHERE user_id NOT IN (
-                    SELECT DISTINCT user_id FROM requests 
-                    WHERE timestamp > ?
-                ) AND updated_at < ?
-            """, (inactive_users_cutoff, inactive_users_cutoff))
-            users_deleted = cursor.rowcount
-            
-            # Удаляем старые подписки (истекшие больше 30 дней назад)
-            expired_subs_cutoff = datetime.now() - timedelta(days=30)
+                SELECT c.id, c.user_id, c.conversation_id, c.message_role, c.message_content,
+                       c.token_count, c.timestamp, b.data
+                FROM conversation_context c
+                LEFT JOIN answer_blobs b ON b.hash = c.content_hash
+                WHERE c.timestamp < ?
+                ORDER BY c.timestamp
+                LIMIT ?
+            """, (cutoff, limit))
+            rows = await cursor.fetchall()
+        return [(*row[:4], unpack_text(row[7]) if row[7] is not None else row[4], row[5], row[6])
+                for row in rows]
+    
+    async def get_old_requests(self, cutoff: datetime, limit: int, max_id: int) -> List[Tuple]:
+        """
+        До limit запросов старше cutoff с id <= max_id для архива, по времени
+        
+        Returns:
+            [(id, user_id, текст запроса, тип, предмет, ответ, время)]
+        """
+        async with self.db.reader() as conn:
             cursor = await conn.execute("""
-                DELETE FROM subscriptions
+                SELECT r.id, r.user_id, r.request_text, r.request_type, r.subject,
+                       r.response_text, r.timestamp, b.data
+                FROM requests r
+                LEFT JOIN answer_blobs b ON b.hash = r.response_hash
+                WHERE r.timestamp < ? AND r.id <= ?
+                ORDER BY r.timestamp
+                LIMIT ?
+            """, (cutoff, max_id, limit))
+            rows = await cursor.fetchall()
+        return [(*row[:5], unpack_text(row[7]) if row[7] is not None else row[5], row[6])
+                for row in rows]
+    
+    async def delete_context_rows(self, row_ids: List[int]) -> int:
+        """Удаляет сообщения контекста по id (после записи в архив)"""
+        cursor = await self.db.write(lambda conn: conn.executemany("""
+            DELETE FROM conversation_context WHERE id = ?
+        """, [(row_id,) for row_id in row_ids]))
+        if cursor.rowcount:
+            self.context_cache.invalidate()
+        return cursor.rowcount
+    
+    async def delete_request_rows(self, row_ids: List[int]) -> int:
+        """Удаляет запросы по id (после записи в архив)"""
+        cursor = await self.db.write(lambda conn: conn.executemany("""
+            DELETE FROM requests WHERE id = ?
+        """, [(row_id,) for row_id in row_ids]))
+        return cursor.rowcount
+    
+    async def get_max_user_row_id(self) -> int:
+        """Наибольший users.id (граница обхода пользователей по диапазонам)"""
+        async with self.db.reader() as conn:
+            cursor = await conn.execute("SELECT MAX(id) FROM users")
+            row = await cursor.fetchone()
+        return row[0] or 0
+    
+    async def delete_inactive_users(self, cutoff: datetime, after_id: int, until_id: int) -> int:
+        """
+        Удаляет неактивных пользователей с id в (after_id, until_id]
+        
+        Неактивный — не обновлялся с cutoff и не имеет ни запросов, ни
+        контекста, ни подписок: такие строки удаляются без нарушения
+        внешних ключей. Проверки — поиск по индексам user_id.
+        """
+        cursor = await self.db.write(lambda conn: conn.execute("""
+            DELETE FROM users WHERE id IN (
+                SELECT u.id FROM users u
+                WHERE u.id > ? AND u.id <= ? AND u.updated_at < ?
+                  AND NOT EXISTS (SELECT 1 FROM requests r WHERE r.user_id = u.user_id)
+                  AND NOT EXISTS (SELECT 1 FROM conversation_context c WHERE c.user_id = u.user_id)
+                  AND NOT EXISTS (SELECT 1 FROM subscriptions s WHERE s.user_id = u.user_id)
+            )
+        """, (after_id, until_id, cutoff)))
+        if cursor.rowcount:
+            # Удаленные строки по id не сопоставить с user_id — забываем всех
+            self.known_users.forget()
+        return cursor.rowcount
+    
+    async def delete_expired_subscriptions(self, cutoff: datetime, limit: int) -> int:
+        """Удаляет до limit неактивных подписок, истекших раньше cutoff"""
+        cursor = await self.db.write(lambda conn: conn.execute("""
+            DELETE FROM subscriptions WHERE id IN (
+                SELECT id FROM subscriptions
                 WHERE expires_at < ? AND is_active = FALSE
-            """, (expired_subs_cutoff,))
-            subs_deleted = cursor.rowcount
-            
-            await conn.commit()
-            
-            return {
-                "context_messages_deleted": context_deleted,
-                "old_requests_deleted": requests_deleted,
-                "inactive_users_deleted": users_deleted,
-                "expired_subscriptions_deleted": subs_deleted
-            }
-            
-        except Exception as e:
-            await conn.rollback()
-            raise e
+                LIMIT ?
+            )
+        """, (cutoff, limit)))
+        return cursor.rowcount
+    
+    async def incremental_vacuum(self, pages: int) -> int:
+        """Возвращает системе до pages свободных страниц, результат — сколько освобождено"""
+        async def vacuum(conn: aiosqlite.Connection) -> int:
+            cursor = await conn.execute("PRAGMA freelist_count")
+            before = (await cursor.fetchone())[0]
+            # execute() делает один шаг оператора, то есть освобождает одну страницу
+            await conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+            cursor = await conn.execute("PRAGMA freelist_count")
+            return before - (await cursor.fetchone())[0]
+        
+        return await self.db.write(vacuum)
     
     async def get_database_stats(self) -> Dict[str, Any]:
-        """Получает статистику базы данных"""
-        conn = await self.get_connection()
+        """
+        Получает статистику базы данных
+        
+        Число строк берется из table_counters, которые ведут триггеры, а не из
+        COUNT(*). Старые данные считаются по дням (row_age_buckets), поэтому
+        это оценка с точностью до суток: день границы не учитывается.
+        """
+        async with self.db.reader() as conn:
+            placeholders = ", ".join("?" * len(COUNTED_TABLES))
+            cursor = await conn.execute(f"""
+                SELECT table_name, row_count FROM table_counters WHERE table_name IN ({placeholders})
+            """, COUNTED_TABLES)
+            stats = {f"{table}_count": count for table, count in await cursor.fetchall()}
+            
+            # Размер базы данных (приблизительно)
+            cursor = await conn.execute("""
+                SELECT page_count * page_size as size_bytes
+                FROM pragma_page_count(), pragma_page_size()
+            """)
+            size_result = await cursor.fetchone()
+            stats["database_size_bytes"] = size_result[0] if size_result else 0
+            stats["database_size_mb"] = round(stats["database_size_bytes"] / (1024 * 1024), 2)
+            
+            # Старые данные
+            for key, table, days in (("old_context_messages", "conversation_context", 7),
+                                     ("old_requests", "requests", 30)):
+                cutoff_date = datetime.now() - timedelta(days=days)
+                cursor = await conn.execute("""
+                    SELECT COALESCE(SUM(row_count), 0) FROM row_age_buckets
+                    WHERE table_name = ? AND day < DATE(?)
+                """, (table, cutoff_date))
+                stats[key] = (await cursor.fetchone())[0]
         
-        # Количество записей в каждой таблице
-        tables = ['users', 'requests', 'conversation_context', 'subscriptions']
-        stats = {}
+        return stats
+    
+    async def _recount_table_stats(self, conn: aiosqlite.Connection) -> Dict[str, int]:
+        """Пересчитывает счетчики по таблицам, возвращает расхождение (было - стало)"""
+        cursor = await conn.execute("SELECT table_name, row_count FROM table_counters")
+        stored = dict(await cursor.fetchall())
         
-        for table in tables:
+        drift = {}
+        for table in COUNTED_TABLES:
             cursor = await conn.execute(f"SELECT COUNT(*) FROM {table}")
             count = (await cursor.fetchone())[0]
-            stats[f"{table}_count"] = count
+            drift[table] = stored.get(table, 0) - count
+            await conn.execute("""
+                INSERT INTO table_counters (table_name, row_count) VALUES (?, ?)
+                ON CONFLICT (table_name) DO UPDATE SET row_count = excluded.row_count
+            """, (table, count))
         
-        # Размер базы данных (приблизительно)
-        cursor = await conn.execute("""
-            SELECT page_count * page_size as size_bytes
-            FROM pragma_page_count(), pragma_page_size()
-        """)
-        size_result = await cursor.fetchone()
-        stats["database_size_bytes"] = size_result[0] if size_result else 0
-        stats["database_size_mb"] = round(stats["database_size_bytes"] / (1024 * 1024), 2)
-        
-        # Старые данные
-        cutoff_date = datetime.now() - timedelta(days=7)
-        cursor = await conn.execute("""
-            SELECT COUNT(*) FROM conversation_context WHERE timestamp < ?
-        """, (cutoff_date,))
-        stats["old_context_messages"] = (await cursor.fetchone())[0]
-        
-        old_requests_cutoff = datetime.now() - timedelta(days=30)
-        cursor = await conn.execute("""
-            SELECT COUNT(*) FROM requests WHERE timestamp < ?
-        """, (old_requests_cutoff,))
-        stats["old_requests"] = (await cursor.fetchone())[0]
+        await conn.execute("DELETE FROM row_age_buckets")
+        for table in AGE_BUCKET_TABLES:
+            await conn.execute(f"""
+                INSERT INTO row_age_buckets (table_name, day, row_count)
+                SELECT ?, COALESCE(DATE(timestamp), ''), COUNT(*) FROM {table}
+                GROUP BY 2
+            """, (table,))
+        return drift
+    
+    async def recount_table_stats(self) -> Dict[str, int]:
+        """
+        Точный пересчет счетчиков для сверки (COUNT(*) по всем таблицам)
         
-        return stats
+        Читает таблицы целиком в одной транзакции писателя — записи на это
+        время ждут; для /stats exact, не для регулярного вызова.
+        """
+        return await self.db.write(self._recount_table_stats)
     
     async def vacuum_database(self):
-        """Оптимизирует базу данных (VACUUM)"""
-        conn = await self.get_connection()
-        await conn.execute("VACUUM")
-        await conn.commit()
+        """
+        Полностью перестраивает файл базы (VACUUM)
+        
+        Блокирует запись на все время перестройки; в работе бота место
+        возвращает RetentionEngine через incremental_vacuum.
+        """
+        await self.db.write(lambda conn: conn.execute("VACUUM"))
     
     async def delete_user_data(self, user_id: int):
         """Полностью удаляет все данные пользователя (GDPR compliance)"""
-        conn = await self.get_connection()
-        
-        try:
+        async def delete(conn: aiosqlite.Connection):
             # Удаляем в правильном порядке (с учетом внешних ключей)
             await conn.execute("DELETE FROM conversation_context WHERE user_id = ?", (user_id,))
             await conn.execute("DELETE FROM requests WHERE user_id = ?", (user_id,))
             await conn.execute("DELETE FROM subscriptions WHERE user_id = ?", (user_id,))
             await conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
-            
-            await conn.commit()
-            return True
-            
-        except Exception as e:
-            await conn.rollback()
-            raise e
+        
+        await self.db.write(delete)
+        self.context_cache.invalidate(user_id)
+        self.known_users.forget(user_id)
+        return True
+
+
+def create_repo(database_url: str = None) -> StorageBackend:
+    """
+    Репозиторий по DATABASE_URL
+    
+    postgres:// и postgresql:// — PostgreSQL через asyncpg (несколько
+    процессов бота с общим состоянием), sqlite:///путь или просто путь к
+    файлу — SQLite.
+    """
+    url = database_url or config.database_url
+    if url.startswith(POSTGRES_SCHEMES):
+        # asyncpg нужен только для PostgreSQL
+        from .postgres import PostgresRepo
+        return PostgresRepo(url)
+    if url.startswith(SQLITE_SCHEME):
+        url = url[len(SQLITE_SCHEME):]
+    return DatabaseRepo(url)
 
 
 # Глобальный экземпляр репозитория
-db_repo = DatabaseRepo()
+db_repo = create_repo()
@@ -0,0 +1,155 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+from loguru import logger
+from ..config import config
+from .archive import Archiver, archiver
+from .base import StorageBackend
+from .repo import db_repo
+from .rollup import DailyRollup, daily_rollup
+
+
+# Сроки хранения, дни
+CONTEXT_DAYS = 7
+REQUESTS_DAYS = 30
+INACTIVE_USERS_DAYS = 90
+EXPIRED_SUBSCRIPTIONS_DAYS = 30
+
+
+class RetentionEngine:
+    """
+    Очистка старых данных небольшими пачками в пределах бюджета времени
+
+    Каждая пачка — короткая транзакция писателя на retention_batch_size строк,
+    между пачками — пауза, чтобы записи обработчиков не ждали очистку.
+    Освободившиеся страницы возвращаются через incremental_vacuum тоже по
+    частям. Если бюджет закончился, run() возвращает complete=False, и
+    следующий запуск продолжает с того же места (старые строки никуда не денутся).
+
+    Перед удалением запросов новые строки учитываются в дневных агрегатах
+    (DailyRollup), и удаляются только запросы до его водяного знака.
+
+    С архивом (Archiver) старые запросы и контекст перед удалением
+    дописываются в сжатые файлы по дням, теми же пачками.
+    """
+
+    def __init__(self, repo: StorageBackend, rollup: DailyRollup = None, archiver: Archiver = None,
+                 batch_size: int = None, time_budget: float = None, pause: float = None,
+                 vacuum_pages: int = None):
+        self.repo = repo
+        self.rollup = rollup or DailyRollup(repo)
+        self.archiver = archiver
+        self.batch_size = batch_size or config.retention_batch_size
+        self.time_budget = config.retention_time_budget if time_budget is None else time_budget
+        self.pause = config.retention_batch_pause_ms / 1000 if pause is None else pause
+        self.vacuum_pages = vacuum_pages or config.retention_vacuum_pages
+
+        self._lock = asyncio.Lock()
+        self._deadline = 0.0
+        self._interrupted = False
+
+        # Счетчики
+        self.runs = 0
+        self.incomplete_runs = 0
+        self.batches = 0
+        self.last_result: Optional[Dict[str, Any]] = None
+
+    def _time_left(self) -> bool:
+        if time.monotonic() < self._deadline:
+            return True
+        self._interrupted = True
+        return False
+
+    async def _drain(self, delete_batch: Callable[[], Awaitable[int]]) -> int:
+        """Удаляет пачками, пока есть что удалять и не вышло время"""
+        deleted = 0
+        while self._time_left():
+            count = await delete_batch()
+            self.batches += 1
+            deleted += count
+            if count < self.batch_size:
+                break
+            await asyncio.sleep(self.pause)
+        return deleted
+
+    async def _delete_inactive_users(self, cutoff: datetime) -> int:
+        """Обходит users по диапазонам первичного ключа"""
+        deleted = 0
+        max_id = await self.repo.get_max_user_row_id()
+        after_id = 0
+        while after_id < max_id and self._time_left():
+            until_id = after_id + self.batch_size
+            deleted += await self.repo.delete_inactive_users(cutoff, after_id, until_id)
+            self.batches += 1
+            after_id = until_id
+            await asyncio.sleep(self.pause)
+        return deleted
+
+    async def _vacuum(self) -> int:
+        """Возвращает свободные страницы порциями по vacuum_pages"""
+        freed = 0
+        while self._time_left():
+            count = await self.repo.incremental_vacuum(self.vacuum_pages)
+            freed += count
+            if count < self.vacuum_pages:
+                break
+            await asyncio.sleep(self.pause)
+        return freed
+
+    async def run(self, days: int = CONTEXT_DAYS) -> Dict[str, Any]:
+        """Один проход очистки; параллельный вызов ждет завершения текущего"""
+        async with self._lock:
+            started = time.monotonic()
+            self._deadline = started + self.time_budget
+            self._interrupted = False
+            now = datetime.now()
+
+            # С архивом строки сначала уходят в файлы, затем удаляются
+            delete_context = self.archiver.archive_context if self.archiver else self.repo.delete_old_context
+            delete_requests = self.archiver.archive_requests if self.archiver else self.repo.delete_old_requests
+
+            # Буферы диалогов в памяти сбрасывают сами методы удаления репозитория
+            context_deleted = await self._drain(lambda: delete_context(
+                now - timedelta(days=days), self.batch_size))
+
+            rolled_up_id = await self.rollup.run()
+            requests_deleted = await self._drain(lambda: delete_requests(
+                now - timedelta(days=REQUESTS_DAYS), self.batch_size, rolled_up_id))
+            subs_deleted = await self._drain(lambda: self.repo.delete_expired_subscriptions(
+                now - timedelta(days=EXPIRED_SUBSCRIPTIONS_DAYS), self.batch_size))
+            users_deleted = await self._delete_inactive_users(now - timedelta(days=INACTIVE_USERS_DAYS))
+            # Сжатые ответы, на которые после удалений не осталось ссылок
+            blobs_deleted = await self._drain(lambda: self.repo.delete_unreferenced_blobs(self.batch_size))
+            pages_freed = await self._vacuum()
+
+            complete = not self._interrupted
+            self.runs += 1
+            if not complete:
+                self.incomplete_runs += 1
+                logger.warning(f"Очистка не уложилась в {self.time_budget} с, продолжим в следующий раз")
+
+            self.last_result = {
+                "context_messages_deleted": context_deleted,
+                "old_requests_deleted": requests_deleted,
+                "inactive_users_deleted": users_deleted,
+                "expired_subscriptions_deleted": subs_deleted,
+                "answer_blobs_deleted": blobs_deleted,
+                "pages_freed": pages_freed,
+                "archived": self.archiver is not None,
+                "seconds": round(time.monotonic() - started, 2),
+                "complete": complete,
+            }
+            return self.last_result
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "runs": self.runs,
+            "incomplete_runs": self.incomplete_runs,
+            "batches": self.batches,
+            "last_result": self.last_result,
+        }
+
+
+# Глобальный экземпляр
+retention = RetentionEngine(db_repo, daily_rollup, archiver)
@@ -0,0 +1,125 @@
+import asyncio
+from collections import Counter
+from typing import Any, Dict, List, Optional
+from ..config import config
+from ..utils.hll import HyperLogLog
+from .base import StorageBackend
+from .repo import db_repo
+
+
+# Имя водяного знака в rollup_state
+REQUESTS_WATERMARK = "requests"
+
+
+class DailyRollup:
+    """
+    Дневные агрегаты запросов (daily_rollup, daily_users)
+
+    Каждый проход читает только строки requests после водяного знака и
+    добавляет их к счетчикам по (день, предмет, тип запроса) и к дневным
+    скетчам уникальных пользователей; порция и новый водяной знак
+    фиксируются одной транзакцией. Чтение агрегатов не зависит от размера
+    requests, а удаленные очисткой строки в них уже учтены — RetentionEngine
+    вызывает run() перед удалением и не трогает строки за водяным знаком.
+    """
+
+    def __init__(self, repo: StorageBackend, batch_size: int = None):
+        self.repo = repo
+        self.batch_size = batch_size or config.rollup_batch_size
+
+        self._lock = asyncio.Lock()
+
+        # Счетчики
+        self.runs = 0
+        self.rows_processed = 0
+        self.last_id = 0
+
+    async def run(self) -> int:
+        """Учитывает все новые запросы, возвращает водяной знак (последний учтенный id)"""
+        async with self._lock:
+            last_id = await self.repo.get_rollup_watermark(REQUESTS_WATERMARK)
+            while True:
+                after_id = last_id
+                rows = await self.repo.get_requests_after(after_id, self.batch_size)
+                if not rows:
+                    break
+
+                counts: Counter = Counter()
+                sketches: Dict[str, HyperLogLog] = {}
+                for row_id, day, subject, request_type, user_id in rows:
+                    counts[(day, subject, request_type)] += 1
+                    if day not in sketches:
+                        sketches[day] = HyperLogLog()
+                    sketches[day].add(user_id)
+                    last_id = row_id
+
+                if not await self.repo.apply_daily_rollup(REQUESTS_WATERMARK, counts, sketches,
+                                                          after_id, last_id):
+                    # Порцию уже учел другой процесс бота (общая база PostgreSQL)
+                    last_id = await self.repo.get_rollup_watermark(REQUESTS_WATERMARK)
+                    continue
+                self.rows_processed += len(rows)
+                if len(rows) < self.batch_size:
+                    break
+                # Отдаем писателя обработчикам между порциями
+                await asyncio.sleep(0)
+
+            self.runs += 1
+            self.last_id = last_id
+            return last_id
+
+    async def get_lag(self) -> int:
+        """
+        Сколько запросов еще не учтено в агрегатах (разница id после водяного знака)
+
+        Очистка не удаляет строки за водяным знаком, поэтому разница id
+        совпадает с числом строк, кроме пропусков последовательности.
+        """
+        watermark = await self.repo.get_rollup_watermark(REQUESTS_WATERMARK)
+        return max(await self.repo.get_max_request_id() - watermark, 0)
+
+    async def get_days(self, days: int = 7) -> List[Dict[str, Any]]:
+        """
+        Статистика по дням за последние days дней (UTC), от старых к новым
+
+        unique_users — оценка HyperLogLog (ошибка ~2%).
+        """
+        rows = await self.repo.get_daily_rollup(days)
+        sketches = await self.repo.get_daily_user_sketches(days)
+
+        result: Dict[str, Dict[str, Any]] = {}
+        for day, subject, request_type, count in rows:
+            stats = result.setdefault(day, {
+                "date": day, "total_requests": 0, "by_subject": {}, "by_type": {},
+            })
+            stats["total_requests"] += count
+            if subject:
+                stats["by_subject"][subject] = stats["by_subject"].get(subject, 0) + count
+            if request_type:
+                stats["by_type"][request_type] = stats["by_type"].get(request_type, 0) + count
+
+        for day, stats in result.items():
+            sketch = sketches.get(day)
+            stats["unique_users"] = sketch.count() if sketch else 0
+        return [result[day] for day in sorted(result)]
+
+    async def get_unique_users(self, days: int = 7) -> int:
+        """Оценка уникальных пользователей за весь период (объединение дневных скетчей)"""
+        total: Optional[HyperLogLog] = None
+        for sketch in (await self.repo.get_daily_user_sketches(days)).values():
+            if total is None:
+                total = sketch
+            else:
+                total.merge(sketch)
+        return total.count() if total else 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "runs": self.runs,
+            "rows_processed": self.rows_processed,
+            "last_id": self.last_id,
+        }
+
+
+# Глобальный экземпляр
+daily_rollup = DailyRollup(db_repo)
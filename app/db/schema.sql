@@ -18,8 +18,11 @@ CREATE TABLE IF NOT EXISTS requests (
     request_text TEXT,
     request_type TEXT, -- 'text' или 'image'
     subject TEXT,
-    response_text TEXT,
+    response_text TEXT, -- NULL, если ответ вынесен в answer_blobs
+    response_hash BLOB, -- ссылка на answer_blobs.hash
     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    subject_source TEXT, -- 'model', 'keywords' или 'fallback'; NULL у запросов до миграции 9
+    subject_confidence REAL,
     FOREIGN KEY (user_id) REFERENCES users (user_id)
 );
 
@@ -29,27 +32,52 @@ CREATE TABLE IF NOT EXISTS conversation_context (
     user_id INTEGER NOT NULL,
     conversation_id TEXT NOT NULL, -- уникальный ID диалога
     message_role TEXT NOT NULL, -- 'user' или 'assistant'
-    message_content TEXT NOT NULL,
+    message_content TEXT NOT NULL, -- '', если текст вынесен в answer_blobs
+    content_hash BLOB, -- ссылка на answer_blobs.hash
+    token_count INTEGER, -- оценка токенов, считается один раз при записи
     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (user_id) REFERENCES users (user_id)
 );
 
--- Индексы для быстрого поиска
-CREATE INDEX IF NOT EXISTS idx_users_user_id ON users(user_id);
-CREATE INDEX IF NOT EXISTS idx_requests_user_id ON requests(user_id);
-CREATE INDEX IF NOT EXISTS idx_requests_timestamp ON requests(timestamp);
-CREATE INDEX IF NOT EXISTS idx_context_user_id ON conversation_context(user_id);
-CREATE INDEX IF NOT EXISTS idx_context_conversation_id ON conversation_context(conversation_id);
+-- Индексы под запросы DatabaseRepo (проверка: python check_query_plans.py).
+-- users.user_id индексирован ограничением UNIQUE.
+-- Контекст диалога: поиск по (user_id, conversation_id) сразу в нужном порядке
+CREATE INDEX IF NOT EXISTS idx_context_conversation ON conversation_context(user_id, conversation_id, timestamp);
 CREATE INDEX IF NOT EXISTS idx_context_timestamp ON conversation_context(timestamp);
+-- Статистика пользователя: счетчики и любимые предметы без чтения строк
+CREATE INDEX IF NOT EXISTS idx_requests_user_timestamp ON requests(user_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_requests_user_subject ON requests(user_id, subject);
+-- Очистка и поиск активных пользователей по времени
+CREATE INDEX IF NOT EXISTS idx_requests_timestamp_user ON requests(timestamp, user_id);
 
--- Статистика по дням
-CREATE VIEW IF NOT EXISTS daily_stats AS
-SELECT 
-    DATE(timestamp) as date,
-    COUNT(*) as total_requests,
-    COUNT(DISTINCT user_id) as unique_users
-FROM requests
-GROUP BY DATE(timestamp);
+-- Статистика по дням: агрегаты переживают удаление старых строк requests.
+-- Заполняет DailyRollup (app/db/rollup.py) по строкам после водяного знака
+CREATE TABLE IF NOT EXISTS daily_rollup (
+    day TEXT NOT NULL,
+    subject TEXT NOT NULL DEFAULT '',
+    request_type TEXT NOT NULL DEFAULT '',
+    requests INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, subject, request_type)
+) WITHOUT ROWID;
+
+-- Уникальные пользователи за день — скетч HyperLogLog (app/utils/hll.py)
+CREATE TABLE IF NOT EXISTS daily_users (
+    day TEXT PRIMARY KEY,
+    users_hll BLOB NOT NULL
+) WITHOUT ROWID;
+
+-- Водяные знаки агрегатов: последний учтенный id исходной таблицы
+CREATE TABLE IF NOT EXISTS rollup_state (
+    name TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+-- Состояние ограничения частоты заданий (GCRA): время, с которого
+-- пользователь снова укладывается в лимит (unix-время, сек)
+CREATE TABLE IF NOT EXISTS rate_limits (
+    user_id INTEGER PRIMARY KEY,
+    tat REAL NOT NULL
+);
 
 -- Таблица подписок
 CREATE TABLE IF NOT EXISTS subscriptions (
@@ -60,3 +88,135 @@ CREATE TABLE IF NOT EXISTS subscriptions (
     expires_at TIMESTAMP,
     FOREIGN KEY (user_id) REFERENCES users (user_id)
 );
+
+CREATE INDEX IF NOT EXISTS idx_subscriptions_user ON subscriptions(user_id, is_active, expires_at);
+
+-- Длинные тексты (ответы) в сжатом виде, одна копия на все ссылки.
+-- requests.response_hash и conversation_context.content_hash ссылаются на hash;
+-- refs ведут триггеры, строки с refs = 0 удаляет RetentionEngine
+CREATE TABLE IF NOT EXISTS answer_blobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    hash BLOB UNIQUE NOT NULL, -- blake2b-128 от текста (app/db/blobs.py)
+    data BLOB NOT NULL, -- текст, сжатый zlib
+    size INTEGER NOT NULL, -- длина исходного текста, байт
+    refs INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_answer_blobs_unreferenced ON answer_blobs(refs) WHERE refs <= 0;
+
+CREATE TRIGGER IF NOT EXISTS requests_blob_insert AFTER INSERT ON requests
+WHEN NEW.response_hash IS NOT NULL BEGIN
+    UPDATE answer_blobs SET refs = refs + 1 WHERE hash = NEW.response_hash;
+END;
+
+CREATE TRIGGER IF NOT EXISTS requests_blob_delete AFTER DELETE ON requests
+WHEN OLD.response_hash IS NOT NULL BEGIN
+    UPDATE answer_blobs SET refs = refs - 1 WHERE hash = OLD.response_hash;
+END;
+
+CREATE TRIGGER IF NOT EXISTS requests_blob_update AFTER UPDATE OF response_hash ON requests BEGIN
+    UPDATE answer_blobs SET refs = refs - 1 WHERE hash = OLD.response_hash;
+    UPDATE answer_blobs SET refs = refs + 1 WHERE hash = NEW.response_hash;
+END;
+
+CREATE TRIGGER IF NOT EXISTS context_blob_insert AFTER INSERT ON conversation_context
+WHEN NEW.content_hash IS NOT NULL BEGIN
+    UPDATE answer_blobs SET refs = refs + 1 WHERE hash = NEW.content_hash;
+END;
+
+CREATE TRIGGER IF NOT EXISTS context_blob_delete AFTER DELETE ON conversation_context
+WHEN OLD.content_hash IS NOT NULL BEGIN
+    UPDATE answer_blobs SET refs = refs - 1 WHERE hash = OLD.content_hash;
+END;
+
+CREATE TRIGGER IF NOT EXISTS context_blob_update AFTER UPDATE OF content_hash ON conversation_context BEGIN
+    UPDATE answer_blobs SET refs = refs - 1 WHERE hash = OLD.content_hash;
+    UPDATE answer_blobs SET refs = refs + 1 WHERE hash = NEW.content_hash;
+END;
+
+-- Кэш ответов на повторяющиеся задачи
+CREATE TABLE IF NOT EXISTS answer_cache (
+    cache_key TEXT PRIMARY KEY, -- sha256 от (модель, предмет, нормализованный текст)
+    subject TEXT,
+    model TEXT,
+    response_text TEXT NOT NULL,
+    hits INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_hit_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_answer_cache_last_hit ON answer_cache(last_hit_at);
+CREATE INDEX IF NOT EXISTS idx_answer_cache_created_at ON answer_cache(created_at);
+
+-- Ответы на повторно присланные фото.
+-- Уникальный индекс (digest, caption_key) создает миграция 8 (DatabaseRepo)
+CREATE TABLE IF NOT EXISTS image_answers (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    digest BLOB NOT NULL, -- blake2b байтов фото
+    caption_key TEXT NOT NULL DEFAULT '', -- подпись к фото без пробелов по краям
+    subject TEXT,
+    response_text TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_image_answers_created_at ON image_answers(created_at);
+
+-- Счетчики строк для /stats без COUNT(*) по таблицам.
+-- Ведутся триггерами; точный пересчет — DatabaseRepo.recount_table_stats()
+CREATE TABLE IF NOT EXISTS table_counters (
+    table_name TEXT PRIMARY KEY,
+    row_count INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+INSERT OR IGNORE INTO table_counters (table_name, row_count) VALUES
+    ('users', 0), ('requests', 0), ('conversation_context', 0), ('subscriptions', 0);
+
+-- Число строк по дням (DATE(timestamp), '' — строки без даты) — для оценки объема старых данных
+CREATE TABLE IF NOT EXISTS row_age_buckets (
+    table_name TEXT NOT NULL,
+    day TEXT NOT NULL,
+    row_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (table_name, day)
+) WITHOUT ROWID;
+
+-- INSERT OR REPLACE в users удаляет старую строку; триггер удаления при этом
+-- срабатывает только с PRAGMA recursive_triggers = ON (включено в connections.py)
+CREATE TRIGGER IF NOT EXISTS users_count_insert AFTER INSERT ON users BEGIN
+    UPDATE table_counters SET row_count = row_count + 1 WHERE table_name = 'users';
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_count_delete AFTER DELETE ON users BEGIN
+    UPDATE table_counters SET row_count = row_count - 1 WHERE table_name = 'users';
+END;
+
+CREATE TRIGGER IF NOT EXISTS subscriptions_count_insert AFTER INSERT ON subscriptions BEGIN
+    UPDATE table_counters SET row_count = row_count + 1 WHERE table_name = 'subscriptions';
+END;
+
+CREATE TRIGGER IF NOT EXISTS subscriptions_count_delete AFTER DELETE ON subscriptions BEGIN
+    UPDATE table_counters SET row_count = row_count - 1 WHERE table_name = 'subscriptions';
+END;
+
+CREATE TRIGGER IF NOT EXISTS requests_count_insert AFTER INSERT ON requests BEGIN
+    UPDATE table_counters SET row_count = row_count + 1 WHERE table_name = 'requests';
+    INSERT INTO row_age_buckets (table_name, day, row_count) VALUES ('requests', COALESCE(DATE(NEW.timestamp), ''), 1)
+        ON CONFLICT (table_name, day) DO UPDATE SET row_count = row_count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS requests_count_delete AFTER DELETE ON requests BEGIN
+    UPDATE table_counters SET row_count = row_count - 1 WHERE table_name = 'requests';
+    UPDATE row_age_buckets SET row_count = row_count - 1
+        WHERE table_name = 'requests' AND day = COALESCE(DATE(OLD.timestamp), '');
+END;
+
+CREATE TRIGGER IF NOT EXISTS context_count_insert AFTER INSERT ON conversation_context BEGIN
+    UPDATE table_counters SET row_count = row_count + 1 WHERE table_name = 'conversation_context';
+    INSERT INTO row_age_buckets (table_name, day, row_count) VALUES ('conversation_context', COALESCE(DATE(NEW.timestamp), ''), 1)
+        ON CONFLICT (table_name, day) DO UPDATE SET row_count = row_count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS context_count_delete AFTER DELETE ON conversation_context BEGIN
+    UPDATE table_counters SET row_count = row_count - 1 WHERE table_name = 'conversation_context';
+    UPDATE row_age_buckets SET row_count = row_count - 1
+        WHERE table_name = 'conversation_context' AND day = COALESCE(DATE(OLD.timestamp), '');
+END;
@@ -0,0 +1,177 @@
+-- Схема базы данных для школьного бота (PostgreSQL, app/db/postgres.py)
+-- Время хранится в UTC без часового пояса, как CURRENT_TIMESTAMP в SQLite:
+-- соединения пула открываются с timezone = 'UTC'
+
+-- Таблица пользователей
+CREATE TABLE IF NOT EXISTS users (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT UNIQUE NOT NULL,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    created_at TIMESTAMP DEFAULT LOCALTIMESTAMP,
+    updated_at TIMESTAMP DEFAULT LOCALTIMESTAMP
+);
+
+-- Длинные тексты (ответы) в сжатом виде, одна копия на все ссылки (app/db/blobs.py)
+CREATE TABLE IF NOT EXISTS answer_blobs (
+    id BIGSERIAL PRIMARY KEY,
+    hash BYTEA UNIQUE NOT NULL,
+    data BYTEA NOT NULL,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_answer_blobs_unreferenced ON answer_blobs(refs) WHERE refs <= 0;
+
+-- Таблица запросов
+CREATE TABLE IF NOT EXISTS requests (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL REFERENCES users (user_id),
+    request_text TEXT,
+    request_type TEXT,
+    subject TEXT,
+    response_text TEXT,
+    response_hash BYTEA,
+    timestamp TIMESTAMP DEFAULT LOCALTIMESTAMP,
+    subject_source TEXT,
+    subject_confidence DOUBLE PRECISION,
+    -- Время вставки строки по часам сервера (id выдается в тот же момент);
+    -- timestamp — время запроса у клиента, до отложенной записи
+    inserted_at TIMESTAMPTZ DEFAULT clock_timestamp()
+);
+ALTER TABLE requests ADD COLUMN IF NOT EXISTS subject_source TEXT;
+ALTER TABLE requests ADD COLUMN IF NOT EXISTS subject_confidence DOUBLE PRECISION;
+-- Без значения по умолчанию в ADD COLUMN таблица не перезаписывается; у старых строк NULL
+ALTER TABLE requests ADD COLUMN IF NOT EXISTS inserted_at TIMESTAMPTZ;
+ALTER TABLE requests ALTER COLUMN inserted_at SET DEFAULT clock_timestamp();
+
+-- Таблица контекста диалогов
+CREATE TABLE IF NOT EXISTS conversation_context (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL REFERENCES users (user_id),
+    conversation_id TEXT NOT NULL,
+    message_role TEXT NOT NULL,
+    message_content TEXT NOT NULL,
+    content_hash BYTEA,
+    token_count INTEGER,
+    timestamp TIMESTAMP DEFAULT LOCALTIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_context_conversation ON conversation_context(user_id, conversation_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_context_timestamp ON conversation_context(timestamp);
+CREATE INDEX IF NOT EXISTS idx_requests_user_timestamp ON requests(user_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_requests_user_subject ON requests(user_id, subject);
+CREATE INDEX IF NOT EXISTS idx_requests_timestamp_user ON requests(timestamp, user_id);
+
+-- Таблица подписок
+CREATE TABLE IF NOT EXISTS subscriptions (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL REFERENCES users (user_id),
+    is_active BOOLEAN DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT LOCALTIMESTAMP,
+    expires_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_subscriptions_user ON subscriptions(user_id, is_active, expires_at);
+
+-- Кэш ответов на повторяющиеся задачи
+CREATE TABLE IF NOT EXISTS answer_cache (
+    cache_key TEXT PRIMARY KEY,
+    subject TEXT,
+    model TEXT,
+    response_text TEXT NOT NULL,
+    hits INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT LOCALTIMESTAMP,
+    last_hit_at TIMESTAMP DEFAULT LOCALTIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_answer_cache_last_hit ON answer_cache(last_hit_at);
+CREATE INDEX IF NOT EXISTS idx_answer_cache_created_at ON answer_cache(created_at);
+
+-- Ответы на повторно присланные фото
+CREATE TABLE IF NOT EXISTS image_answers (
+    id BIGSERIAL PRIMARY KEY,
+    digest BYTEA NOT NULL,
+    caption_key TEXT NOT NULL DEFAULT '',
+    subject TEXT,
+    response_text TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT LOCALTIMESTAMP
+);
+
+-- Таблица с перцептивным хэшем: строки без дайджеста и повторы ключа удаляются (это кэш)
+ALTER TABLE image_answers ADD COLUMN IF NOT EXISTS digest BYTEA;
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_name = 'image_answers' AND column_name = 'phash') THEN
+        DELETE FROM image_answers
+        WHERE digest IS NULL
+           OR id NOT IN (SELECT MAX(id) FROM image_answers GROUP BY digest, caption_key);
+        ALTER TABLE image_answers DROP COLUMN phash;
+        ALTER TABLE image_answers ALTER COLUMN digest SET NOT NULL;
+    END IF;
+END $$;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_image_answers_digest ON image_answers(digest, caption_key);
+CREATE INDEX IF NOT EXISTS idx_image_answers_created_at ON image_answers(created_at);
+
+-- Дневные агрегаты запросов (DailyRollup)
+CREATE TABLE IF NOT EXISTS daily_rollup (
+    day TEXT NOT NULL,
+    subject TEXT NOT NULL DEFAULT '',
+    request_type TEXT NOT NULL DEFAULT '',
+    requests BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, subject, request_type)
+);
+
+CREATE TABLE IF NOT EXISTS daily_users (
+    day TEXT PRIMARY KEY,
+    users_hll BYTEA NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS rollup_state (
+    name TEXT PRIMARY KEY,
+    last_id BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS rate_limits (
+    user_id BIGINT PRIMARY KEY,
+    tat DOUBLE PRECISION NOT NULL
+);
+
+-- Ссылки на answer_blobs считает триггер. Счетчиков строк и разбивки по
+-- дням, как в SQLite, здесь нет: при нескольких процессах одна строка
+-- счетчика стала бы общей блокировкой для всех вставок. /stats берет
+-- оценку числа строк из pg_stat_user_tables.
+CREATE OR REPLACE FUNCTION answer_blob_refs() RETURNS trigger AS $$
+DECLARE
+    old_hash BYTEA;
+    new_hash BYTEA;
+BEGIN
+    IF TG_TABLE_NAME = 'requests' THEN
+        IF TG_OP <> 'INSERT' THEN old_hash := OLD.response_hash; END IF;
+        IF TG_OP <> 'DELETE' THEN new_hash := NEW.response_hash; END IF;
+    ELSE
+        IF TG_OP <> 'INSERT' THEN old_hash := OLD.content_hash; END IF;
+        IF TG_OP <> 'DELETE' THEN new_hash := NEW.content_hash; END IF;
+    END IF;
+    IF old_hash IS NOT DISTINCT FROM new_hash THEN
+        RETURN NULL;
+    END IF;
+    IF old_hash IS NOT NULL THEN
+        UPDATE answer_blobs SET refs = refs - 1 WHERE hash = old_hash;
+    END IF;
+    IF new_hash IS NOT NULL THEN
+        UPDATE answer_blobs SET refs = refs + 1 WHERE hash = new_hash;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS requests_blob_refs ON requests;
+CREATE TRIGGER requests_blob_refs AFTER INSERT OR DELETE OR UPDATE OF response_hash ON requests
+    FOR EACH ROW EXECUTE FUNCTION answer_blob_refs();
+
+DROP TRIGGER IF EXISTS context_blob_refs ON conversation_context;
+CREATE TRIGGER context_blob_refs AFTER INSERT OR DELETE OR UPDATE OF content_hash ON conversation_context
+    FOR EACH ROW EXECUTE FUNCTION answer_blob_refs();
@@ -0,0 +1,70 @@
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+from ..config import config
+
+
+class KnownUsers:
+    """
+    Пользователи, уже записанные в users, с отпечатком профиля (LRU)
+
+    Повторный /start и каждое сообщение пользователя с тем же профилем
+    (username, имя, фамилия) не пишут в базу. На пользователя — int
+    отпечатка и узел OrderedDict; сверх max_users вытесняются давно не
+    писавшие.
+    """
+
+    def __init__(self, max_users: int = None):
+        self.max_users = max_users or config.known_users_cache_size
+
+        self._users: "OrderedDict[int, int]" = OrderedDict()
+
+        # Счетчики
+        self.hits = 0
+        self.misses = 0
+        self.changed = 0
+        self.evictions = 0
+
+    @staticmethod
+    def fingerprint(username: Optional[str], first_name: Optional[str],
+                    last_name: Optional[str]) -> int:
+        """Отпечаток профиля (hash строк стабилен в пределах процесса)"""
+        return hash((username, first_name, last_name))
+
+    def is_current(self, user_id: int, fingerprint: int) -> bool:
+        """True — пользователь в базе с тем же профилем, писать не нужно"""
+        known = self._users.get(user_id)
+        if known == fingerprint:
+            self._users.move_to_end(user_id)
+            self.hits += 1
+            return True
+        if known is None:
+            self.misses += 1
+        else:
+            self.changed += 1
+        return False
+
+    def remember(self, user_id: int, fingerprint: int):
+        """Запоминает профиль, записанный в базу"""
+        self._users[user_id] = fingerprint
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+            self.evictions += 1
+
+    def forget(self, user_id: int = None):
+        """Забывает пользователя (или всех) после удаления строк users"""
+        if user_id is None:
+            self._users.clear()
+        else:
+            self._users.pop(user_id, None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses + self.changed
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "changed": self.changed,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            "users": len(self._users),
+        }
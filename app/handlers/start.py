@@ -1,14 +1,38 @@
 from aiogram import Router, F
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from loguru import logger
 from ..config import config
 from ..llm.client import llm_client
-from ..utils.subjects import detect_subject, get_subject_emoji
+from ..llm.scheduler import PRIORITY_FREE, PRIORITY_SUBSCRIBER
+from ..llm.router import model_router
+from ..utils.subjects import get_subject_emoji, label_subject
+from ..utils.streaming import render_stream
+from ..utils.images import choose_photo_size, preprocess_image_async
+from ..utils.metrics import stage_metrics
 from ..db.repo import db_repo
+from ..db.retention import retention
+from ..db.rollup import daily_rollup
+from ..middleware.rate_limit import RateLimitMiddleware, rate_limiter
 
 router = Router()
 
+# Кнопки выбора режима: ответ на них не тратит LLM
+MENU_BUTTONS = {"📝 Решить текстом", "📸 Решить по фото"}
+
+
+def is_task_message(message: Message) -> bool:
+    """Задание для LLM (фото или текст), а не команда или кнопка меню"""
+    if message.photo:
+        return True
+    text = (message.text or "").strip()
+    return bool(text) and not text.startswith("/") and text not in MENU_BUTTONS
+
+
+# Лимит заданий в час проверяется до фильтров обработчиков
+rate_limit_middleware = RateLimitMiddleware(db_repo, rate_limiter, is_task_message)
+router.message.outer_middleware(rate_limit_middleware)
+
 
 WELCOME_KEYBOARD = ReplyKeyboardMarkup(
     keyboard=[
@@ -31,6 +55,22 @@ def build_subscription_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+async def get_request_priority(user_id: int) -> int:
+    """Подписчики получают приоритет в очереди к LLM ("Быстрые ответы")"""
+    try:
+        if await db_repo.has_active_subscription(user_id):
+            return PRIORITY_SUBSCRIBER
+    except Exception as e:
+        logger.warning(f"Не удалось проверить подписку {user_id}: {e}")
+    return PRIORITY_FREE
+
+
+async def register_user(message: Message):
+    """Регистрирует автора сообщения, если он пришел без /start (запись отложенная)"""
+    user = message.from_user
+    await db_repo.register_user(user.id, user.username, user.first_name or "", user.last_name)
+
+
 @router.message(Command("start"))
 async def cmd_start(message: Message):
     """Короткое приветствие + inline-кнопки подписки + основное меню."""
@@ -194,6 +234,90 @@ async def keep_subscription(callback: CallbackQuery):
     )
 
 
+# Команды регистрируются до F.text: иначе handle_text перехватит "/stats" как задачу
+@router.message(Command("stats"))
+async def cmd_stats(message: Message, command: CommandObject):
+    """Показывает статистику базы данных (/stats exact — со сверкой счетчиков, только для администраторов)"""
+    try:
+        drift = None
+        # Пересчет — полный COUNT в транзакции писателя, остальным аргумент не доступен
+        exact = (command.args or "").strip().lower() == "exact"
+        if exact and message.from_user.id in config.admin_ids:
+            drift = await db_repo.recount_table_stats()
+        stats = await db_repo.get_database_stats()
+        # Агрегаты как есть: их дописывает фоновый rollup_loop, здесь только отставание
+        days = await daily_rollup.get_days(7)
+        week_requests = sum(day["total_requests"] for day in days)
+        week_users = await daily_rollup.get_unique_users(7)
+        rollup_lag = await daily_rollup.get_lag()
+        
+        stats_text = (
+            "📊 Статистика базы данных:\n\n"
+            f"👥 Пользователи: {stats['users_count']}\n"
+            f"📝 Запросы: {stats['requests_count']}\n"
+            f"💬 Сообщения контекста: {stats['conversation_context_count']}\n"
+            f"💎 Подписки: {stats['subscriptions_count']}\n\n"
+            f"💾 Размер базы: {stats['database_size_mb']} МБ\n\n"
+            f"🗑️ Старые данные (с точностью до дня):\n"
+            f"• Контекст старше 7 дней: {stats['old_context_messages']}\n"
+            f"• Запросы старше 30 дней: {stats['old_requests']}\n\n"
+            f"📅 За 7 дней: {week_requests} запросов, ~{week_users} пользователей\n"
+            f"🕓 Еще не в агрегатах: {rollup_lag} запросов (обновляются раз в {config.rollup_interval} с)\n"
+            f"⏳ Отклонено по лимиту: {rate_limit_middleware.rejected}\n\n"
+            "💡 Используйте /cleanup для очистки старых данных"
+        )
+        if drift is not None:
+            mismatched = {table: diff for table, diff in drift.items() if diff}
+            if mismatched:
+                stats_text += "\n\n🔁 Счетчики пересчитаны, расхождение: " + ", ".join(
+                    f"{table} {diff:+d}" for table, diff in mismatched.items())
+            else:
+                stats_text += "\n\n🔁 Счетчики пересчитаны, расхождений нет"
+        
+        await message.answer(stats_text)
+        
+    except Exception as e:
+        logger.error(f"Ошибка получения статистики: {e}")
+        await message.answer("❌ Ошибка при получении статистики")
+
+
+@router.message(Command("cleanup"))
+async def cmd_cleanup(message: Message):
+    """Очищает старые данные"""
+    try:
+        # Показываем сообщение о начале очистки
+        cleanup_msg = await message.answer("🧹 Начинаю очистку старых данных...")
+        
+        # Выполняем очистку (пачками, без блокировки базы)
+        result = await retention.run()
+        
+        # Показываем результат
+        total_deleted = (result['context_messages_deleted'] + result['old_requests_deleted']
+                         + result['inactive_users_deleted'] + result['expired_subscriptions_deleted']
+                         + result['answer_blobs_deleted'])
+        
+        archived = " (в архиве)" if result['archived'] else ""
+        cleanup_result = (
+            "✅ Очистка завершена!\n\n"
+            f"🗑️ Удалено записей:\n"
+            f"• Сообщения контекста: {result['context_messages_deleted']}{archived}\n"
+            f"• Старые запросы: {result['old_requests_deleted']}{archived}\n"
+            f"• Неактивные пользователи: {result['inactive_users_deleted']}\n"
+            f"• Истекшие подписки: {result['expired_subscriptions_deleted']}\n"
+            f"• Ответы без ссылок: {result['answer_blobs_deleted']}\n\n"
+            f"📊 Всего удалено: {total_deleted} записей\n"
+            f"💾 Освобождено страниц: {result['pages_freed']}"
+        )
+        if not result['complete']:
+            cleanup_result += "\n\n⏳ Не все успели удалить за один проход — повторите /cleanup позже"
+        
+        await cleanup_msg.edit_text(cleanup_result)
+        
+    except Exception as e:
+        logger.error(f"Ошибка очистки данных: {e}")
+        await message.answer("❌ Ошибка при очистке данных")
+
+
 # Обработчик фото с реальным LLM
 @router.message(F.photo)
 async def handle_photo(message: Message):
@@ -203,39 +327,64 @@ async def handle_photo(message: Message):
     processing_msg = await message.answer("📸 Фото получено. Обрабатываю задание…")
     
     try:
-        # Получаем фото
-        photo = message.photo[-1]  # Берем самое большое фото
-        file = await message.bot.get_file(photo.file_id)
-        image_bytes = await message.bot.download_file(file.file_path)
+        # Получаем фото: наименьший размер, достаточный для распознавания
+        photo = choose_photo_size(message.photo)
+        with stage_metrics.measure("photo_download"):
+            file = await message.bot.get_file(photo.file_id)
+            downloaded = await message.bot.download_file(file.file_path)
+        
+        # Поворот, обрезка полей, уменьшение и пережатие — вне event loop
+        with stage_metrics.measure("photo_preprocess"):
+            image_bytes = await preprocess_image_async(downloaded.read())
         
         # Создаем или получаем ID диалога
         conversation_id = f"user_{user_id}_main"
         
         # Получаем контекст диалога
-        conversation_context = await db_repo.get_conversation_context(user_id, conversation_id)
+        with stage_metrics.measure("context_load"):
+            conversation_context = await db_repo.get_conversation_context(
+                user_id, conversation_id, limit=config.context_max_messages
+            )
         
         # Определяем предмет (пока без подсказки)
-        subject, confidence = detect_subject(message.caption or "")
+        label = label_subject(message.caption or "")
+        subject, confidence = label.subject, label.confidence
         subject_emoji = get_subject_emoji(subject)
         
-        # Решаем задачу с контекстом
-        result = await llm_client.solve_image(image_bytes.read(), subject, conversation_context)
-        
-        # Сохраняем сообщения в контекст
-        photo_description = f"[Фото с заданием] {message.caption or ''}"
-        await db_repo.save_message(user_id, conversation_id, "user", photo_description)
-        await db_repo.save_message(user_id, conversation_id, "assistant", result['response'])
-        
-        # Сохраняем запрос в статистику
-        await db_repo.save_request(user_id, photo_description, "image", subject, result['response'])
-        
-        # Отправляем ответ как есть
-        await processing_msg.delete()
-        await message.answer(result['response'])
+        # Решаем задачу с контекстом, показывая ответ по мере генерации
+        priority = await get_request_priority(user_id)
+        tier = model_router.route(subject, confidence, len(message.caption or ""), has_image=True,
+                                  subscriber=priority == PRIORITY_SUBSCRIBER)
+        with stage_metrics.measure("llm"):
+            response = await render_stream(
+                processing_msg,
+                llm_client.stream_image(image_bytes, subject, conversation_context,
+                                        priority=priority, caption=message.caption or "",
+                                        tier=tier)
+            )
         
     except Exception as e:
         logger.error(f"Ошибка обработки фото: {e}")
         await processing_msg.edit_text("❌ Ошибка при обработке фото. Попробуйте еще раз.")
+        return
+    
+    # Ответ уже показан: ошибка записи в базу только логируется
+    try:
+        with stage_metrics.measure("db_save"):
+            # Пользователь должен быть в users раньше своих сообщений (внешние ключи)
+            await register_user(message)
+            
+            # Сохраняем сообщения в контекст
+            photo_description = f"[Фото с заданием] {message.caption or ''}"
+            await db_repo.save_message(user_id, conversation_id, "user", photo_description)
+            await db_repo.save_message(user_id, conversation_id, "assistant", response)
+            
+            # Сохраняем запрос в статистику
+            await db_repo.save_request(user_id, photo_description, "image", subject, response,
+                                       subject_source=label.source,
+                                       subject_confidence=label.confidence)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения фото-задания в БД: {e}")
 
 
 # Обработчик текста с реальным LLM
@@ -250,7 +399,7 @@ async def handle_text(message: Message):
         await message.answer("Пожалуйста, отправьте текст задания или фото.")
         return
 
-    if text in {"📝 Решить текстом", "📸 Решить по фото"}:
+    if text in MENU_BUTTONS:
         return  # уже обработано соответствующими хендлерами
 
     user_id = message.from_user.id
@@ -263,88 +412,46 @@ async def handle_text(message: Message):
         conversation_id = f"user_{user_id}_main"
         
         # Получаем контекст диалога
-        conversation_context = await db_repo.get_conversation_context(user_id, conversation_id)
+        with stage_metrics.measure("context_load"):
+            conversation_context = await db_repo.get_conversation_context(
+                user_id, conversation_id, limit=config.context_max_messages
+            )
         
         # Определяем предмет
-        subject, confidence = detect_subject(text)
+        with stage_metrics.measure("detect_subject"):
+            label = label_subject(text)
+            subject, confidence = label.subject, label.confidence
         subject_emoji = get_subject_emoji(subject)
         
-        # Решаем задачу с контекстом
-        result = await llm_client.solve_text(text, subject, conversation_context)
-        
-        # Сохраняем сообщения в контекст
-        await db_repo.save_message(user_id, conversation_id, "user", text)
-        await db_repo.save_message(user_id, conversation_id, "assistant", result['response'])
-        
-        # Сохраняем запрос в статистику
-        await db_repo.save_request(user_id, text, "text", subject, result['response'])
-        
-        # Отправляем ответ как есть
-        await processing_msg.delete()
-        await message.answer(result['response'])
+        # Решаем задачу с контекстом, показывая ответ по мере генерации
+        priority = await get_request_priority(user_id)
+        tier = model_router.route(subject, confidence, len(text), has_image=False,
+                                  subscriber=priority == PRIORITY_SUBSCRIBER)
+        with stage_metrics.measure("llm"):
+            response = await render_stream(
+                processing_msg,
+                llm_client.stream_text(text, subject, conversation_context, priority=priority,
+                                       tier=tier)
+            )
         
     except Exception as e:
         logger.error(f"Ошибка обработки текста: {e}")
         await processing_msg.edit_text("❌ Ошибка при обработке задания. Попробуйте еще раз.")
-
-
-@router.message(Command("stats"))
-async def cmd_stats(message: Message):
-    """Показывает статистику базы данных"""
-    try:
-        stats = await db_repo.get_database_stats()
-        
-        stats_text = (
-            "📊 Статистика базы данных:\n\n"
-            f"👥 Пользователи: {stats['users_count']}\n"
-            f"📝 Запросы: {stats['requests_count']}\n"
-            f"💬 Сообщения контекста: {stats['conversation_context_count']}\n"
-            f"💎 Подписки: {stats['subscriptions_count']}\n\n"
-            f"💾 Размер базы: {stats['database_size_mb']} МБ\n\n"
-            f"🗑️ Старые данные:\n"
-            f"• Контекст старше 7 дней: {stats['old_context_messages']}\n"
-            f"• Запросы старше 30 дней: {stats['old_requests']}\n\n"
-            "💡 Используйте /cleanup для очистки старых данных"
-        )
-        
-        await message.answer(stats_text)
-        
-    except Exception as e:
-        logger.error(f"Ошибка получения статистики: {e}")
-        await message.answer("❌ Ошибка при получении статистики")
-
-
-@router.message(Command("cleanup"))
-async def cmd_cleanup(message: Message):
-    """Очищает старые данные"""
+        return
+    
+    # Ответ уже показан: ошибка записи в базу только логируется
     try:
-        # Показываем сообщение о начале очистки
-        cleanup_msg = await message.answer("🧹 Начинаю очистку старых данных...")
-        
-        # Выполняем очистку
-        result = await db_repo.cleanup_old_data()
-        
-        # Показываем результат
-        total_deleted = sum(result.values())
-        
-        cleanup_result = (
-            "✅ Очистка завершена!\n\n"
-            f"🗑️ Удалено записей:\n"
-            f"• Сообщения контекста: {result['context_messages_deleted']}\n"
-            f"• Старые запросы: {result['old_requests_deleted']}\n"
-            f"• Неактивные пользователи: {result['inactive_users_deleted']}\n"
-            f"• Истекшие подписки: {result['expired_subscriptions_deleted']}\n\n"
-            f"📊 Всего удалено: {total_deleted} записей"
-        )
-        
-        await cleanup_msg.edit_text(cleanup_result)
-        
-        # Если удалили много данных, делаем VACUUM
-        if total_deleted > 50:
-            vacuum_msg = await message.answer("🔧 Оптимизирую базу данных...")
-            await db_repo.vacuum_database()
-            await vacuum_msg.edit_text("✅ База данных оптимизирована!")
-        
+        with stage_metrics.measure("db_save"):
+            # Пользователь должен быть в users раньше своих сообщений (внешние ключи)
+            await register_user(message)
+            
+            # Сохраняем сообщения в контекст
+            await db_repo.save_message(user_id, conversation_id, "user", text)
+            await db_repo.save_message(user_id, conversation_id, "assistant", response)
+            
+            # Сохраняем запрос в статистику
+            await db_repo.save_request(user_id, text, "text", subject, response,
+                                       subject_source=label.source,
+                                       subject_confidence=label.confidence)
     except Exception as e:
-        logger.error(f"Ошибка очистки данных: {e}")
-        await message.answer("❌ Ошибка при очистке данных")
+        logger.error(f"Ошибка сохранения задания в БД: {e}")
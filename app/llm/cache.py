@@ -0,0 +1,148 @@
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+from loguru import logger
+from ..config import config
+from ..db.repo import db_repo
+
+
+# Маркеры уточняющих вопросов: такие сообщения зависят от предыдущего ответа
+FOLLOW_UP_MARKERS = (
+    "а если", "а почему", "почему", "объясни", "поясни", "подробнее", "еще", "ещё",
+    "дальше", "продолжи", "не понял", "не поняла", "непонятно", "а как", "а что",
+    "это", "этот", "эту", "там", "тут", "второй", "третий", "следующ", "предыдущ",
+    "в ответе", "проверь", "переделай", "исправь"
+)
+
+# Сообщения короче этого без цифр считаем уточнением к диалогу
+FOLLOW_UP_MAX_LENGTH = 25
+
+
+def normalize_problem_text(text: str) -> str:
+    """Нормализует текст задачи для ключа кэша"""
+    text = text.lower().replace("ё", "е").strip()
+    text = re.sub(r"\s+", " ", text)
+    # Пробелы вокруг знаков не влияют на смысл: "3x + 7 = 25" == "3x+7=25"
+    text = re.sub(r"\s*([^\w\s])\s*", r"\1", text)
+    return text.rstrip(".!?…")
+
+
+def is_follow_up(text: str, conversation_context: list = None) -> bool:
+    """Определяет, является ли сообщение продолжением текущего диалога"""
+    if not conversation_context:
+        return False
+
+    text_lower = text.lower().strip()
+    if text_lower.startswith(FOLLOW_UP_MARKERS):
+        return True
+
+    return len(text_lower) < FOLLOW_UP_MAX_LENGTH and not re.search(r"\d", text_lower)
+
+
+class AnswerCache:
+    """Двухуровневый кэш ответов: LRU в памяти + таблица answer_cache в SQLite"""
+
+    def __init__(self, memory_size: int = None, ttl_hours: int = None, max_rows: int = None):
+        self.memory_size = memory_size or config.answer_cache_memory_size
+        self.ttl_hours = ttl_hours or config.answer_cache_ttl_hours
+        self.max_rows = max_rows or config.answer_cache_max_rows
+        self.enabled = config.answer_cache_enabled
+
+        # ключ -> (ответ, момент записи по time.monotonic())
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._stores_since_eviction = 0
+
+        # Счетчики
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.stores = 0
+
+    @staticmethod
+    def make_key(text: str, subject: str, model: str) -> str:
+        """Строит ключ кэша из нормализованного текста, предмета и модели"""
+        raw = f"{model}\x00{subject or ''}\x00{normalize_problem_text(text)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def should_bypass(self, text: str, conversation_context: list = None) -> bool:
+        """Кэш не используется, если вопрос — уточнение к диалогу"""
+        if is_follow_up(text, conversation_context):
+            self.bypassed += 1
+            return True
+        return False
+
+    async def get(self, key: str) -> Optional[str]:
+        """Ищет ответ сначала в памяти, затем в SQLite"""
+        if not self.enabled:
+            return None
+
+        entry = self._memory.get(key)
+        if entry is not None:
+            response, stored_at = entry
+            if time.monotonic() - stored_at < self.ttl_hours * 3600:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return response
+            # Устарел: в таблице он тоже старше TTL
+            del self._memory[key]
+
+        try:
+            found = await db_repo.get_cached_answer(key, self.ttl_hours)
+        except Exception as e:
+            logger.warning(f"Ошибка чтения кэша ответов: {e}")
+            found = None
+
+        if found is None:
+            self.misses += 1
+            return None
+
+        # В памяти ответ живет не дольше, чем в таблице: отсчет от его записи туда
+        response, age = found
+        self.db_hits += 1
+        self._remember(key, response, age)
+        return response
+
+    async def put(self, key: str, subject: str, model: str, response: str):
+        """Сохраняет ответ в оба уровня кэша"""
+        if not self.enabled:
+            return
+
+        self._remember(key, response)
+        self.stores += 1
+
+        try:
+            await db_repo.save_cached_answer(key, subject, model, response)
+
+            # Периодически чистим таблицу по TTL и размеру
+            self._stores_since_eviction += 1
+            if self._stores_since_eviction >= 100:
+                self._stores_since_eviction = 0
+                evicted = await db_repo.evict_cached_answers(self.ttl_hours, self.max_rows)
+                if evicted:
+                    logger.info(f"Из кэша ответов удалено записей: {evicted}")
+        except Exception as e:
+            logger.warning(f"Ошибка записи в кэш ответов: {e}")
+
+    def _remember(self, key: str, response: str, age: float = 0.0):
+        """Кладет ответ в LRU в памяти (age — сколько секунд ответ уже пролежал в таблице)"""
+        self._memory[key] = (response, time.monotonic() - age)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает счетчики попаданий и промахов"""
+        lookups = self.memory_hits + self.db_hits + self.misses
+        hits = self.memory_hits + self.db_hits
+        return {
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "stores": self.stores,
+            "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+            "memory_entries": len(self._memory)
+        }
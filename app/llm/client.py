@@ -1,8 +1,40 @@
 import httpx
 import asyncio
-from typing import Dict, Any, Optional
+import base64
+import json
+import time
+from typing import Dict, Any, Optional, List, AsyncIterator, Awaitable, Callable
 from loguru import logger
 from ..config import config
+from .cache import AnswerCache
+from .singleflight import SingleFlight
+from .image_cache import ImageAnswerCache
+from ..utils.image_hash import content_digest
+from .scheduler import llm_scheduler, estimate_tokens, PRIORITY_FREE
+from .context import select_context, context_budget
+from .router import ModelTier, model_router
+from .resilience import (
+    LLMTarget, ResilienceState, RETRYABLE_STATUSES, FALLBACK_STATUSES,
+    parse_retry_after, backoff_delay
+)
+from ..utils.tokens import count_tokens
+
+
+class LLMError(Exception):
+    """Ошибка ответа LLM API"""
+    
+    def __init__(self, message: str, status_code: int = None, retry_after: float = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+async def _next_chunk(stream: AsyncIterator[str]) -> Optional[str]:
+    """Следующий фрагмент потока; None — поток закончился"""
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return None
 
 
 class LLMClient:
@@ -14,8 +46,529 @@ class LLMClient:
         self.model_text = config.llm_model_text
         self.model_vision = config.llm_model_vision
         
+        # Цепочки моделей по умолчанию: основная + запасные на случай сбоев
+        self.text_targets = model_router.default_tier().targets
+        self.vision_targets = model_router.default_tier(has_image=True).targets
+        self.resilience = ResilienceState()
+        
+        # Долгоживущий HTTP-клиент с пулом соединений (создается в start())
+        self._client: Optional[httpx.AsyncClient] = None
+        self._limits = httpx.Limits(
+            max_connections=config.llm_max_connections,
+            max_keepalive_connections=config.llm_max_keepalive_connections,
+            keepalive_expiry=config.llm_keepalive_expiry
+        )
+        
+        # Кэш ответов на повторяющиеся задачи
+        self.cache = AnswerCache()
+        
+        # Объединение одинаковых одновременных запросов
+        self.inflight = SingleFlight()
+        
+        # Ответы на повторно присланные фото
+        self.image_cache = ImageAnswerCache()
+        
+        # Статистика пула
+        self._requests_total = 0
+        self._connections_opened = 0
+        self._in_flight = 0
+        self._peak_in_flight = 0
+        # Время от отправки запроса в httpx до его заголовков: ожидание
+        # соединения (или потока HTTP/2) в пуле и установка нового соединения
+        self._acquires = 0
+        self._acquire_seconds = 0.0
+        self._max_acquire_seconds = 0.0
+    
+    async def start(self):
+        """Поднимает HTTP-клиент"""
+        await self._create_client()
+    
+    async def _create_client(self):
+        """Создает общий HTTP-клиент с keep-alive и HTTP/2"""
+        if self._client is not None:
+            return
+        
+        http2 = config.llm_http2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("Пакет h2 не установлен, используем HTTP/1.1")
+                http2 = False
+        
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=config.llm_timeout,
+            limits=self._limits,
+            http2=http2,
+            headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
+            }
+        )
+        logger.info(
+            f"HTTP-клиент LLM запущен (http2={http2}, "
+            f"max_connections={self._limits.max_connections}, "
+            f"keepalive={self._limits.max_keepalive_connections})"
+        )
+    
+    async def close(self):
+        """Закрывает HTTP-клиент и освобождает соединения"""
+        if self._client is not None:
+            logger.info(f"Статистика пула LLM: {self.get_pool_stats()}")
+            await self._client.aclose()
+            self._client = None
+    
+    async def _get_client(self) -> httpx.AsyncClient:
+        """Возвращает общий HTTP-клиент, создавая его при необходимости"""
+        if self._client is None:
+            await self._create_client()
+        return self._client
+    
+    def _request_trace(self) -> Callable[[str, dict], Awaitable[None]]:
+        """Хук httpcore для одного запроса: считаем новые TCP-соединения и время получения соединения"""
+        started = time.perf_counter()
+        acquired = False
+        
+        async def trace(event_name: str, info: dict):
+            nonlocal acquired
+            if event_name == "connection.connect_tcp.complete":
+                self._connections_opened += 1
+            elif event_name.endswith(".send_request_headers.started") and not acquired:
+                # Заголовки уходят, когда соединение (и поток HTTP/2) уже получены
+                acquired = True
+                waited = time.perf_counter() - started
+                self._acquires += 1
+                self._acquire_seconds += waited
+                self._max_acquire_seconds = max(self._max_acquire_seconds, waited)
+        
+        return trace
+    
+    def _chat_url(self, target: LLMTarget = None) -> str:
+        """URL chat/completions: относительный для основного эндпоинта, полный для запасных"""
+        if target is None or target.base_url == self.base_url:
+            return "/chat/completions"
+        return f"{target.base_url}/chat/completions"
+    
+    def _auth_headers(self, target: LLMTarget = None) -> Optional[Dict[str, str]]:
+        """Заголовок авторизации цели со своим ключом (иначе — основной ключ клиента)"""
+        if target is None or target.api_key is None:
+            return None
+        return {"Authorization": f"Bearer {target.api_key}"}
+    
+    async def _post_chat(self, payload: Dict[str, Any],
+                         priority: int = PRIORITY_FREE,
+                         target: LLMTarget = None) -> httpx.Response:
+        """Отправляет запрос chat/completions через планировщик и общий пул соединений"""
+        client = await self._get_client()
+        tokens = estimate_tokens(payload["messages"], payload["max_tokens"])
+        
+        async with llm_scheduler.slot(tokens, priority) as usage:
+            self._requests_total += 1
+            self._in_flight += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+            
+            try:
+                response = await client.post(
+                    self._chat_url(target),
+                    json=payload,
+                    headers=self._auth_headers(target),
+                    extensions={"trace": self._request_trace()}
+                )
+            finally:
+                self._in_flight -= 1
+            
+            if response.status_code == 200:
+                usage["actual_tokens"] = (response.json().get("usage") or {}).get("total_tokens")
+            return response
+    
+    def get_pool_stats(self) -> Dict[str, Any]:
+        """Возвращает статистику пула соединений"""
+        open_connections = 0
+        pool = getattr(getattr(self._client, "_transport", None), "_pool", None)
+        if pool is not None:
+            open_connections = len(pool.connections)
+        
+        reused = max(self._requests_total - self._connections_opened, 0)
+        return {
+            "requests_total": self._requests_total,
+            "connections_opened": self._connections_opened,
+            "connections_reused": reused,
+            "reuse_ratio": round(reused / self._requests_total, 3) if self._requests_total else 0.0,
+            "open_connections": open_connections,
+            "in_flight": self._in_flight,
+            "peak_in_flight": self._peak_in_flight,
+            "acquire_ms_avg": round(self._acquire_seconds / self._acquires * 1000, 1) if self._acquires else 0.0,
+            "acquire_ms_max": round(self._max_acquire_seconds * 1000, 1),
+            "max_connections": self._limits.max_connections
+        }
+        
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает сводную статистику клиента"""
+        return {
+            "pool": self.get_pool_stats(),
+            "cache": self.cache.get_stats(),
+            "inflight": self.inflight.get_stats(),
+            "image_cache": self.image_cache.get_stats(),
+            "scheduler": llm_scheduler.get_stats(),
+            "router": model_router.get_stats(),
+            "resilience": self.resilience.get_stats()
+        }
+    
+    async def _stream_chat(self, payload: Dict[str, Any],
+                           priority: int = PRIORITY_FREE,
+                           target: LLMTarget = None,
+                           usage_sink: Dict[str, Any] = None) -> AsyncIterator[str]:
+        """Отправляет потоковый запрос chat/completions и отдает куски текста из SSE"""
+        client = await self._get_client()
+        tokens = estimate_tokens(payload["messages"], payload["max_tokens"])
+        
+        async with llm_scheduler.slot(tokens, priority) as usage:
+            self._requests_total += 1
+            self._in_flight += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+            
+            try:
+                async with client.stream(
+                    "POST",
+                    self._chat_url(target),
+                    json={**payload, "stream": True, "stream_options": {"include_usage": True}},
+                    headers=self._auth_headers(target),
+                    extensions={"trace": self._request_trace()}
+                ) as response:
+                    if response.status_code != 200:
+                        body = await response.aread()
+                        raise LLMError(
+                            f"OpenAI API error: {response.status_code} - {body.decode(errors='replace')}",
+                            status_code=response.status_code,
+                            retry_after=parse_retry_after(response.headers)
+                        )
+                    
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            # Дочитываем тело до конца, иначе соединение не вернется в пул
+                            continue
+                        
+                        chunk = json.loads(data)
+                        if chunk.get("usage"):
+                            usage["actual_tokens"] = chunk["usage"].get("total_tokens")
+                            if usage_sink is not None:
+                                usage_sink.update(chunk["usage"])
+                        choices = chunk.get("choices") or []
+                        if not choices:
+                            continue
+                        delta = choices[0].get("delta", {}).get("content")
+                        if delta:
+                            yield delta
+            finally:
+                self._in_flight -= 1
+    
+    async def _post_hedged(self, payload: Dict[str, Any], priority: int,
+                           target: LLMTarget) -> httpx.Response:
+        """
+        Отправляет запрос; если ответа нет дольше p95 задержки цели,
+        отправляет дублирующий запрос и берет первый пришедший ответ
+        """
+        hedge_delay = self.resilience.hedge_delay(target)
+        if hedge_delay is None:
+            return await self._post_chat(payload, priority, target)
+        
+        first = asyncio.create_task(self._post_chat(payload, priority, target))
+        done, _ = await asyncio.wait({first}, timeout=hedge_delay)
+        if done:
+            return first.result()
+        
+        self.resilience.hedged += 1
+        second = asyncio.create_task(self._post_chat(payload, priority, target))
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    # Ошибку одного запроса игнорируем, пока второй еще идет
+                    if task.exception() is not None and pending:
+                        continue
+                    if task is second:
+                        self.resilience.hedge_wins += 1
+                    return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    async def _stream_hedged(self, payload: Dict[str, Any], priority: int,
+                             target: LLMTarget,
+                             usage_sink: Dict[str, Any] = None) -> AsyncIterator[str]:
+        """
+        Потоковый запрос; если первого фрагмента нет дольше p95 времени до
+        первого фрагмента у цели, открывает дублирующий поток
+
+        Дальше читается поток, первым отдавший фрагмент, второй закрывается.
+        После первого фрагмента дублировать уже нечего.
+        """
+        started = time.monotonic()
+        streams: Dict[asyncio.Future, AsyncIterator[str]] = {}
+        primary = self._stream_chat(payload, priority, target, usage_sink)
+        streams[asyncio.ensure_future(_next_chunk(primary))] = primary
+        winner = None
+        try:
+            hedge_delay = self.resilience.hedge_delay(target, streaming=True)
+            done, _ = await asyncio.wait(set(streams), timeout=hedge_delay)
+            if not done:
+                self.resilience.hedged += 1
+                # Проигравший поток закрывается до конца ответа, поэтому usage
+                # в общий словарь успевает записать только победитель
+                backup = self._stream_chat(payload, priority, target, usage_sink)
+                streams[asyncio.ensure_future(_next_chunk(backup))] = backup
+            
+            pending = set(streams)
+            while winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    # Ошибку одного потока игнорируем, пока второй еще идет
+                    if task.exception() is not None and pending:
+                        continue
+                    first_chunk = task.result()
+                    winner = streams.pop(task)
+                    if winner is not primary:
+                        self.resilience.hedge_wins += 1
+                    break
+        finally:
+            # Отмена задачи закрывает ее поток и освобождает слот планировщика;
+            # ошибка проигравшего уже не важна
+            for task in streams:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()
+        
+        try:
+            if first_chunk is None:
+                return
+            self.resilience.first_chunk_latency(target).record(time.monotonic() - started)
+            yield first_chunk
+            async for chunk in winner:
+                yield chunk
+        finally:
+            await winner.aclose()
+    
+    async def _complete(self, payload: Dict[str, Any], targets: List[LLMTarget],
+                        priority: int = PRIORITY_FREE) -> httpx.Response:
+        """
+        Запрос chat/completions с повторами и запасными моделями
+        
+        Временные ошибки (сеть, 429, 5xx) повторяются с экспоненциальной
+        задержкой и учетом Retry-After. Если цель недоступна или ее
+        выключатель разомкнут, запрос уходит следующей модели цепочки.
+        Постоянные ошибки (400, 401, ...) возвращаются сразу.
+        """
+        last_response = None
+        last_error = None
+        
+        for index, target in enumerate(targets):
+            if index > 0:
+                self.resilience.fallbacks += 1
+                logger.warning(f"Переключаемся на запасную модель {target.model} ({target.base_url})")
+            
+            breaker = self.resilience.breaker(target)
+            for attempt in range(config.llm_max_retries + 1):
+                if not breaker.allow():
+                    self.resilience.breaker_rejections += 1
+                    break
+                
+                retry_after = None
+                started = time.monotonic()
+                try:
+                    response = await self._post_hedged({**payload, "model": target.model}, priority, target)
+                except httpx.TransportError as e:
+                    logger.warning(f"Сетевая ошибка LLM ({target.model}): {e!r}")
+                    breaker.record_failure()
+                    last_error = e
+                else:
+                    if response.status_code == 200:
+                        breaker.record_success()
+                        self.resilience.latency(target).record(time.monotonic() - started)
+                        return response
+                    
+                    last_response = response
+                    if response.status_code in FALLBACK_STATUSES:
+                        # Модели нет на этом эндпоинте
+                        breaker.record_failure()
+                        break
+                    if response.status_code not in RETRYABLE_STATUSES:
+                        # Эндпоинт отвечает, ошибка в самом запросе
+                        breaker.record_success()
+                        return response
+                    
+                    logger.warning(f"LLM {target.model} ответил {response.status_code}, попытка {attempt + 1}")
+                    breaker.record_failure()
+                    retry_after = parse_retry_after(response.headers)
+                finally:
+                    # Отмена и таймаут планировщика не дают результата, но пробу освобождают
+                    breaker.release()
+                
+                self.resilience.log_breaker(target)
+                if attempt == config.llm_max_retries:
+                    break
+                delay = backoff_delay(attempt, retry_after)
+                if delay > config.llm_retry_max_delay:
+                    # Ждать слишком долго — лучше попробовать следующую модель
+                    break
+                self.resilience.retries += 1
+                await asyncio.sleep(delay)
+        
+        if last_response is not None:
+            return last_response
+        raise last_error or LLMError("Все модели LLM временно недоступны")
+    
+    async def _stream_resilient(self, payload: Dict[str, Any], priority: int,
+                                targets: List[LLMTarget],
+                                usage_sink: Dict[str, Any] = None) -> AsyncIterator[str]:
+        """
+        Потоковый запрос с повторами и запасными моделями
+        
+        Повторить можно только до первого полученного фрагмента: после
+        этого пользователь уже видит ответ, и ошибка пробрасывается.
+        """
+        last_error = None
+        
+        for index, target in enumerate(targets):
+            if index > 0:
+                self.resilience.fallbacks += 1
+                logger.warning(f"Переключаемся на запасную модель {target.model} ({target.base_url})")
+            
+            breaker = self.resilience.breaker(target)
+            for attempt in range(config.llm_max_retries + 1):
+                if not breaker.allow():
+                    self.resilience.breaker_rejections += 1
+                    break
+                
+                received = False
+                retry_after = None
+                try:
+                    async for chunk in self._stream_hedged({**payload, "model": target.model},
+                                                           priority, target, usage_sink):
+                        received = True
+                        yield chunk
+                    breaker.record_success()
+                    return
+                except LLMError as e:
+                    last_error = e
+                    if received:
+                        breaker.record_failure()
+                        raise
+                    if e.status_code in FALLBACK_STATUSES:
+                        breaker.record_failure()
+                        break
+                    if e.status_code not in RETRYABLE_STATUSES:
+                        breaker.record_success()
+                        raise
+                    logger.warning(f"LLM {target.model} ответил {e.status_code}, попытка {attempt + 1}")
+                    breaker.record_failure()
+                    retry_after = e.retry_after
+                except httpx.TransportError as e:
+                    last_error = e
+                    breaker.record_failure()
+                    if received:
+                        raise
+                    logger.warning(f"Сетевая ошибка LLM ({target.model}): {e!r}")
+                finally:
+                    # Отмена, таймаут планировщика и закрытие генератора (GeneratorExit)
+                    # результата не дают, но пробу освобождают
+                    breaker.release()
+                
+                self.resilience.log_breaker(target)
+                if attempt == config.llm_max_retries:
+                    break
+                delay = backoff_delay(attempt, retry_after)
+                if delay > config.llm_retry_max_delay:
+                    break
+                self.resilience.retries += 1
+                await asyncio.sleep(delay)
+        
+        raise last_error or LLMError("Все модели LLM временно недоступны")
+    
+    def _build_text_messages(self, text: str, subject_hint: str = None,
+                             conversation_context: list = None,
+                             model: str = None) -> List[Dict[str, Any]]:
+        """Собирает сообщения для текстового запроса"""
+        system_prompt = self._get_system_prompt(subject_hint)
+        
+        # Формируем сообщения с контекстом
+        messages = [{"role": "system", "content": system_prompt}]
+        
+        # Добавляем контекст диалога в пределах бюджета токенов модели
+        messages += select_context(conversation_context, context_budget(model or self.model_text))
+        
+        # Добавляем текущий запрос
+        messages.append({"role": "user", "content": text})
+        return messages
+    
+    def _build_image_messages(self, image_bytes: bytes, subject_hint: str = None,
+                              conversation_context: list = None,
+                              model: str = None) -> List[Dict[str, Any]]:
+        """Собирает сообщения для запроса с изображением"""
+        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+        
+        system_prompt = self._get_system_prompt(subject_hint)
+        
+        # Формируем сообщения с контекстом
+        messages = [{"role": "system", "content": system_prompt}]
+        
+        # Добавляем контекст диалога (для изображений бюджет меньше)
+        messages += select_context(conversation_context,
+                                   context_budget(model or self.model_vision, vision=True))
+        
+        # Добавляем текущий запрос с изображением
+        messages.append({
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "Реши задачу на этом изображении:"},
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:image/jpeg;base64,{image_base64}"
+                    }
+                }
+            ]
+        })
+        return messages
+    
+    def _shared_key(self, text: str, subject_hint: str = None,
+                    conversation_context: list = None,
+                    use_cache: bool = True,
+                    model: str = None) -> Optional[str]:
+        """
+        Ключ для кэша и объединения одинаковых запросов
+        
+        Возвращает None, если ответ зависит от личного контекста диалога
+        (уточняющий вопрос) или вызывающий явно отказался от кэша.
+        """
+        if not use_cache or self.cache.should_bypass(text, conversation_context):
+            return None
+        return self.cache.make_key(text, subject_hint, model or self.model_text)
+    
+    def _record_usage(self, tier: ModelTier, started: float, messages: List[Dict[str, Any]],
+                      content: Optional[str], usage: Dict[str, Any] = None):
+        """Записывает задержку и токены запроса в статистику уровня"""
+        if content is None:
+            model_router.record(tier, time.monotonic() - started, ok=False)
+            return
+        usage = usage or {}
+        model_router.record(
+            tier,
+            time.monotonic() - started,
+            prompt_tokens=usage.get("prompt_tokens") or estimate_tokens(messages, 0),
+            completion_tokens=usage.get("completion_tokens") or count_tokens(content),
+        )
+    
     async def solve_text(self, text: str, subject_hint: str = None, 
-                        conversation_context: list = None) -> Dict[str, Any]:
+                        conversation_context: list = None,
+                        use_cache: bool = True,
+                        priority: int = PRIORITY_FREE,
+                        tier: ModelTier = None) -> Dict[str, Any]:
         """Решает текстовую задачу с учетом контекста"""
         if self.api_key == "demo_key":
             return {
@@ -23,53 +576,73 @@ class LLMClient:
                 "response": "Это демо-режим. Для полного функционала настройте OpenAI API ключ."
             }
         
+        tier = tier or model_router.default_tier()
+        shared_key = self._shared_key(text, subject_hint, conversation_context, use_cache, tier.model)
+        if not shared_key:
+            return await self._solve_text_uncached(text, subject_hint, conversation_context,
+                                                   priority=priority, tier=tier)
+        
+        cached = await self.cache.get(shared_key)
+        if cached is not None:
+            return self._parse_response(cached, subject_hint)
+        
+        # Одинаковые задачи, пришедшие одновременно, решаем одним вызовом API
+        result = await self.inflight.do(
+            shared_key,
+            lambda: self._solve_text_uncached(text, subject_hint, conversation_context,
+                                              shared_key, priority, tier)
+        )
+        return dict(result)
+    
+    async def _solve_text_uncached(self, text: str, subject_hint: str = None,
+                                   conversation_context: list = None,
+                                   cache_key: str = None,
+                                   priority: int = PRIORITY_FREE,
+                                   tier: ModelTier = None) -> Dict[str, Any]:
+        """Решает текстовую задачу запросом к API"""
+        tier = tier or model_router.default_tier()
+        started = time.monotonic()
+        messages = []
         try:
-            system_prompt = self._get_system_prompt(subject_hint)
+            messages = self._build_text_messages(text, subject_hint, conversation_context, tier.model)
             
-            # Формируем сообщения с контекстом
-            messages = [{"role": "system", "content": system_prompt}]
+            response = await self._complete({
+                "model": tier.model,
+                "messages": messages,
+                "temperature": 0.3,
+                "max_tokens": tier.max_tokens
+            }, tier.targets, priority)
             
-            # Добавляем контекст диалога (последние 5 сообщений)
-            if conversation_context:
-                for msg in conversation_context[-5:]:  # Берем последние 5 сообщений
-                    messages.append({
-                        "role": msg["role"],
-                        "content": msg["content"]
-                    })
+            if response.status_code != 200:
+                logger.error(f"OpenAI API error: {response.status_code} - {response.text}")
+                self._record_usage(tier, started, messages, None)
+                return self._get_error_response()
             
-            # Добавляем текущий запрос
-            messages.append({"role": "user", "content": text})
+            result = response.json()
+            content = result["choices"][0]["message"]["content"]
+            self._record_usage(tier, started, messages, content, result.get("usage"))
             
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    f"{self.base_url}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": self.model_text,
-                        "messages": messages,
-                        "temperature": 0.3,
-                        "max_tokens": 3000
-                    }
-                )
-                
-                if response.status_code != 200:
-                    logger.error(f"OpenAI API error: {response.status_code} - {response.text}")
-                    return self._get_error_response()
-                
-                result = response.json()
-                content = result["choices"][0]["message"]["content"]
-                
-                return self._parse_response(content, subject_hint)
+            if cache_key:
+                await self.cache.put(cache_key, subject_hint, tier.model, content)
+            
+            return self._parse_response(content, subject_hint)
                 
         except Exception as e:
             logger.error(f"Ошибка при обращении к OpenAI API: {e}")
+            self._record_usage(tier, started, messages, None)
             return self._get_error_response()
     
+    def _image_digest(self, image_bytes: bytes) -> Optional[bytes]:
+        """Дайджест фото для поиска повторов (None, если поиск выключен)"""
+        if not self.image_cache.enabled:
+            return None
+        return content_digest(image_bytes)
+    
     async def solve_image(self, image_bytes: bytes, subject_hint: str = None,
-                         conversation_context: list = None) -> Dict[str, Any]:
+                         conversation_context: list = None,
+                         priority: int = PRIORITY_FREE,
+                         caption: str = "",
+                         tier: ModelTier = None) -> Dict[str, Any]:
         """Решает задачу по изображению с учетом контекста"""
         if self.api_key == "demo_key":
             return {
@@ -77,65 +650,177 @@ class LLMClient:
                 "response": "Это демо-режим. Для полного функционала настройте OpenAI API ключ."
             }
         
+        # Тот же лист уже фотографировали — отдаем сохраненный ответ
+        digest = self._image_digest(image_bytes)
+        cached = await self.image_cache.get(digest, caption)
+        if cached is not None:
+            return self._parse_response(cached, subject_hint)
+        
+        tier = tier or model_router.default_tier(has_image=True)
+        started = time.monotonic()
+        messages = []
         try:
-            import base64
-            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-            
-            system_prompt = self._get_system_prompt(subject_hint)
-            
-            # Формируем сообщения с контекстом
-            messages = [{"role": "system", "content": system_prompt}]
-            
-            # Добавляем контекст диалога (последние 3 сообщения для изображений)
-            if conversation_context:
-                for msg in conversation_context[-3:]:  # Меньше контекста для изображений
-                    messages.append({
-                        "role": msg["role"],
-                        "content": msg["content"]
-                    })
-            
-            # Добавляем текущий запрос с изображением
-            messages.append({
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": "Реши задачу на этом изображении:"},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_base64}"
-                        }
-                    }
-                ]
-            })
+            messages = self._build_image_messages(image_bytes, subject_hint, conversation_context,
+                                                  tier.model)
             
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    f"{self.base_url}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": self.model_vision,
-                        "messages": messages,
-                        "temperature": 0.3,
-                        "max_tokens": 3000
-                    }
-                )
-                
-                if response.status_code != 200:
-                    logger.error(f"OpenAI API error: {response.status_code} - {response.text}")
-                    return self._get_error_response()
-                
-                result = response.json()
-                content = result["choices"][0]["message"]["content"]
-                
-                return self._parse_response(content, subject_hint)
+            response = await self._complete({
+                "model": tier.model,
+                "messages": messages,
+                "temperature": 0.3,
+                "max_tokens": tier.max_tokens
+            }, tier.targets, priority)
+            
+            if response.status_code != 200:
+                logger.error(f"OpenAI API error: {response.status_code} - {response.text}")
+                self._record_usage(tier, started, messages, None)
+                return self._get_error_response()
+            
+            result = response.json()
+            content = result["choices"][0]["message"]["content"]
+            self._record_usage(tier, started, messages, content, result.get("usage"))
+            
+            await self.image_cache.put(digest, caption, subject_hint, content)
+            
+            return self._parse_response(content, subject_hint)
                 
         except Exception as e:
             logger.error(f"Ошибка при обращении к OpenAI Vision API: {e}")
+            self._record_usage(tier, started, messages, None)
             return self._get_error_response()
     
+    async def stream_text(self, text: str, subject_hint: str = None,
+                          conversation_context: list = None,
+                          use_cache: bool = True,
+                          priority: int = PRIORITY_FREE,
+                          tier: ModelTier = None) -> AsyncIterator[str]:
+        """Решает текстовую задачу, отдавая ответ по мере генерации"""
+        if self.api_key == "demo_key" or not config.llm_streaming:
+            result = await self.solve_text(text, subject_hint, conversation_context, use_cache,
+                                           priority, tier)
+            yield result["response"]
+            return
+        
+        tier = tier or model_router.default_tier()
+        shared_key = self._shared_key(text, subject_hint, conversation_context, use_cache, tier.model)
+        if shared_key:
+            cached = await self.cache.get(shared_key)
+            if cached is not None:
+                yield cached
+                return
+            
+            # Такая же задача уже решается — ждем ее ответ целиком
+            flight = self.inflight.join(shared_key)
+            if flight is not None:
+                try:
+                    result = await asyncio.shield(flight)
+                    yield result["response"]
+                    return
+                except asyncio.CancelledError:
+                    if not flight.cancelled():
+                        raise
+                    # Ведущий запрос отменили — решаем сами, без объединения
+                    shared_key = None
+                except Exception:
+                    yield self._get_error_response()["response"]
+                    return
+        
+        # Полный ответ; остается None, если поток оборвался или вернул ошибку
+        completed = None
+        
+        async def store(content: str):
+            nonlocal completed
+            completed = content
+            if shared_key:
+                await self.cache.put(shared_key, subject_hint, tier.model, content)
+        
+        if shared_key:
+            self.inflight.begin(shared_key)
+        
+        messages = self._build_text_messages(text, subject_hint, conversation_context, tier.model)
+        try:
+            async for chunk in self._stream_with_fallback({
+                "model": tier.model,
+                "messages": messages,
+                "temperature": 0.3,
+                "max_tokens": tier.max_tokens
+            }, tier, priority, on_complete=store):
+                yield chunk
+        except BaseException:
+            if shared_key:
+                self.inflight.finish(shared_key, error=asyncio.CancelledError())
+            raise
+        
+        if not shared_key:
+            return
+        if completed is not None:
+            self.inflight.finish(shared_key, self._parse_response(completed, subject_hint))
+        else:
+            # Текст ошибки или прерванный ответ ожидающим не раздаем: они получат
+            # свое сообщение об ошибке
+            self.inflight.finish(shared_key, error=LLMError("Потоковый ответ не завершен"))
+    
+    async def stream_image(self, image_bytes: bytes, subject_hint: str = None,
+                           conversation_context: list = None,
+                           priority: int = PRIORITY_FREE,
+                           caption: str = "",
+                           tier: ModelTier = None) -> AsyncIterator[str]:
+        """Решает задачу по изображению, отдавая ответ по мере генерации"""
+        if self.api_key == "demo_key" or not config.llm_streaming:
+            result = await self.solve_image(image_bytes, subject_hint, conversation_context,
+                                            priority, caption, tier)
+            yield result["response"]
+            return
+        
+        # Тот же лист уже фотографировали — отдаем сохраненный ответ
+        digest = self._image_digest(image_bytes)
+        cached = await self.image_cache.get(digest, caption)
+        if cached is not None:
+            yield cached
+            return
+        
+        async def store(content: str):
+            await self.image_cache.put(digest, caption, subject_hint, content)
+        
+        tier = tier or model_router.default_tier(has_image=True)
+        messages = self._build_image_messages(image_bytes, subject_hint, conversation_context,
+                                              tier.model)
+        async for chunk in self._stream_with_fallback({
+            "model": tier.model,
+            "messages": messages,
+            "temperature": 0.3,
+            "max_tokens": tier.max_tokens
+        }, tier, priority, on_complete=store):
+            yield chunk
+    
+    async def _stream_with_fallback(self, payload: Dict[str, Any],
+                                    tier: ModelTier,
+                                    priority: int = PRIORITY_FREE,
+                                    on_complete: Callable[[str], Awaitable[None]] = None
+                                    ) -> AsyncIterator[str]:
+        """Стримит ответ; при ошибке отдает текст ошибки вместо (или после) частичного ответа"""
+        received = False
+        started = time.monotonic()
+        usage: Dict[str, Any] = {}
+        try:
+            chunks = []
+            async for chunk in self._stream_resilient(payload, priority, tier.targets, usage):
+                received = True
+                chunks.append(chunk)
+                yield chunk
+            
+            self._record_usage(tier, started, payload["messages"], "".join(chunks), usage)
+            
+            # Успешно завершенный ответ передаем дальше (например, в кэш)
+            if on_complete and chunks:
+                await on_complete("".join(chunks))
+        except Exception as e:
+            logger.error(f"Ошибка потокового запроса к OpenAI API: {e}")
+            self._record_usage(tier, started, payload["messages"], None)
+            if received:
+                yield "\n\n⚠️ Ответ прерван. Попробуйте еще раз."
+            else:
+                yield self._get_error_response()["response"]
+    
     def _get_system_prompt(self, subject_hint: str = None) -> str:
         """Возвращает простой и четкий системный промпт"""
         return """Ты - эксперт по решению школьных задач. Решай задачи правильно и пошагово.
@@ -0,0 +1,97 @@
+import re
+from functools import lru_cache
+from typing import Any, Dict, List
+from ..config import config
+from ..utils.tokens import count_tokens
+
+
+# Строки решения, которые стоит сохранить в кратком пересказе
+_ANSWER_LINE = re.compile(r"^\s*(ответ|итог|answer)\b", re.IGNORECASE)
+
+
+@lru_cache(maxsize=8)
+def parse_budgets(spec: str) -> Dict[str, int]:
+    """Разбирает бюджеты контекста по моделям: "gpt-4o:6000,gpt-4o-mini:3000" """
+    budgets = {}
+    for item in spec.split(","):
+        if ":" not in item:
+            continue
+        model, tokens = item.rsplit(":", 1)
+        budgets[model.strip()] = int(tokens)
+    return budgets
+
+
+def context_budget(model: str, vision: bool = False) -> int:
+    """Бюджет токенов истории диалога для модели"""
+    budgets = parse_budgets(config.llm_context_budgets)
+    if model in budgets:
+        return budgets[model]
+    return config.llm_context_budget_vision if vision else config.llm_context_budget
+
+
+def message_tokens(msg: Dict[str, Any]) -> int:
+    """Токены сообщения: сохраненное при записи значение или оценка на лету"""
+    tokens = msg.get("tokens")
+    if tokens is None:
+        tokens = count_tokens(msg["content"])
+    return tokens
+
+
+def summarize_answer(text: str, max_tokens: int) -> str:
+    """
+    Краткий пересказ старого ответа ассистента без обращения к LLM
+
+    Оставляет первую строку (что решали) и строки с ответом, остальное
+    решение выбрасывает.
+    """
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if not lines:
+        return text
+
+    kept = [lines[0]]
+    kept += [line for line in lines[1:] if _ANSWER_LINE.match(line)]
+    if len(kept) == 1 and len(lines) > 1:
+        kept.append(lines[-1])
+
+    summary = "[Кратко] " + " … ".join(kept)
+    while count_tokens(summary) > max_tokens and len(summary) > 40:
+        summary = summary[:int(len(summary) * 0.8)].rstrip() + "…"
+    return summary
+
+
+def select_context(conversation_context: List[Dict[str, Any]], budget: int,
+                   summarize: bool = None) -> List[Dict[str, str]]:
+    """
+    Выбирает историю диалога в пределах бюджета токенов
+
+    Сообщения берутся от новых к старым, пока помещаются в бюджет.
+    Все ответы ассистента, кроме последнего, при включенной опции
+    заменяются краткими пересказами, чтобы в бюджет влезло больше ходов.
+    """
+    if not conversation_context or budget <= 0:
+        return []
+    if summarize is None:
+        summarize = config.llm_context_summarize
+
+    selected = []
+    used = 0
+    seen_assistant = False
+    for msg in reversed(conversation_context):
+        content = msg["content"]
+        tokens = message_tokens(msg)
+
+        if msg["role"] == "assistant" and summarize and tokens > config.llm_context_summary_tokens:
+            # Последний ответ оставляем целиком, если он помещается в бюджет
+            if seen_assistant or used + tokens > budget:
+                content = summarize_answer(content, config.llm_context_summary_tokens)
+                tokens = count_tokens(content)
+        if msg["role"] == "assistant":
+            seen_assistant = True
+
+        if used + tokens > budget:
+            break
+        used += tokens
+        selected.append({"role": msg["role"], "content": content})
+
+    selected.reverse()
+    return selected
@@ -0,0 +1,74 @@
+from typing import Any, Dict, Optional
+from loguru import logger
+from ..config import config
+from ..db.repo import db_repo
+
+
+class ImageAnswerCache:
+    """
+    Кэш ответов по повторно присланным фото (таблица image_answers)
+
+    Ключ — дайджест байтов подготовленного фото и подпись целиком: ответ
+    отдается только для того же файла с той же подписью. Похожие, но не
+    одинаковые фото не совпадают — перцептивный хэш не различал листы с
+    текстом. Таблица ограничена по возрасту и количеству записей.
+    """
+
+    def __init__(self):
+        self.enabled = config.image_dedup_enabled
+        self.max_entries = config.image_dedup_max_entries
+        self.ttl_hours = config.image_dedup_ttl_hours
+        self._stores_since_eviction = 0
+
+        # Счетчики
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    async def get(self, digest: Optional[bytes], caption: str = "") -> Optional[str]:
+        """Ищет ответ для фото, уже решенного с той же подписью"""
+        if not self.enabled or digest is None:
+            return None
+
+        try:
+            response = await db_repo.get_image_answer(digest, (caption or "").strip(), self.ttl_hours)
+        except Exception as e:
+            logger.warning(f"Ошибка чтения кэша фото: {e}")
+            response = None
+
+        if response is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        logger.info("Фото совпало с решенным ранее")
+        return response
+
+    async def put(self, digest: Optional[bytes], caption: str, subject: str, response: str):
+        """Запоминает ответ на фото (прежний ответ с тем же ключом заменяется)"""
+        if not self.enabled or digest is None:
+            return
+
+        try:
+            await db_repo.save_image_answer(digest, (caption or "").strip(), subject, response)
+            self.stores += 1
+
+            # Периодически чистим таблицу по TTL и размеру
+            self._stores_since_eviction += 1
+            if self._stores_since_eviction >= 100:
+                self._stores_since_eviction = 0
+                evicted = await db_repo.evict_image_answers(self.ttl_hours, self.max_entries)
+                if evicted:
+                    logger.info(f"Из кэша фото удалено записей: {evicted}")
+        except Exception as e:
+            logger.warning(f"Ошибка записи в кэш фото: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает счетчики кэша фото"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
@@ -0,0 +1,243 @@
+import os
+import random
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from typing import Any, Dict, List, NamedTuple, Optional
+from loguru import logger
+from ..config import config
+
+
+# Статусы, при которых запрос имеет смысл повторить
+RETRYABLE_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+# Статусы, при которых стоит сразу перейти к следующей модели цепочки
+FALLBACK_STATUSES = {404}
+
+
+class LLMTarget(NamedTuple):
+    """Эндпоинт и модель, на которые можно отправить запрос"""
+    base_url: str
+    model: str
+    # Ключ API эндпоинта (None — основной ключ OPENAI_API_KEY)
+    api_key: Optional[str] = None
+
+    def __repr__(self) -> str:
+        return f"LLMTarget({self.base_url!r}, {self.model!r})"
+
+
+def _host(url: str) -> str:
+    return urlsplit(url).netloc.lower()
+
+
+def parse_targets(spec: str, default_base_url: str) -> List[LLMTarget]:
+    """
+    Разбирает цепочку запасных моделей из строки
+
+    Формат: "model", "base_url|model" или "base_url|model|ENV_VAR" через
+    запятую, где ENV_VAR — переменная окружения с ключом API этого
+    эндпоинта, например
+    "gpt-4o-mini,https://proxy.example.com/v1|gpt-3.5-turbo|PROXY_API_KEY"
+
+    Основной ключ уходит только на хост основного эндпоинта: цель на
+    другом хосте без своего ключа пропускается.
+    """
+    targets = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if "|" not in item:
+            targets.append(LLMTarget(default_base_url, item))
+            continue
+
+        parts = [part.strip() for part in item.split("|", 2)]
+        base_url, model = parts[0].rstrip("/"), parts[1]
+        key_env = parts[2] if len(parts) > 2 else ""
+        api_key = None
+        if key_env:
+            api_key = os.getenv(key_env)
+            if not api_key:
+                logger.warning(f"Ключ {key_env} для {model} ({base_url}) не задан, модель пропускаем")
+                continue
+        elif _host(base_url) != _host(default_base_url):
+            logger.warning(f"Для {model} на другом хосте ({base_url}) не указан свой ключ, модель пропускаем")
+            continue
+        targets.append(LLMTarget(base_url, model, api_key))
+    return targets
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    """Возвращает задержку из заголовков retry-after-ms / Retry-After (секунды)"""
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(float(value) / 1000, 0.0)
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: float = None) -> float:
+    """Экспоненциальная задержка с полным джиттером; Retry-After имеет приоритет"""
+    if retry_after is not None:
+        return retry_after
+    cap = min(config.llm_retry_max_delay, config.llm_retry_base_delay * (2 ** attempt))
+    return random.uniform(0, cap)
+
+
+class CircuitBreaker:
+    """
+    Автоматический выключатель для одного эндпоинта/модели
+
+    После failure_threshold ошибок подряд запросы к цели не отправляются
+    reset_timeout секунд, затем пропускается один пробный запрос. Каждая
+    попытка, получившая allow(), заканчивается release() — иначе пробный
+    запрос, прерванный без результата (отмена, таймаут планировщика),
+    навсегда оставил бы выключатель закрытым для новых проб.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = None, reset_timeout: float = None):
+        self.failure_threshold = failure_threshold or config.llm_breaker_failures
+        self.reset_timeout = reset_timeout or config.llm_breaker_reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        """Можно ли сейчас отправить запрос"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.times_opened += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """Попытка завершена; если результат не записан, следующий запрос снова может стать пробным"""
+        self._probe_in_flight = False
+
+
+class LatencyTracker:
+    """Скользящее окно задержек успешных запросов для порога хеджирования"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self._samples = deque(maxlen=window)
+        self.min_samples = min_samples
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class ResilienceState:
+    """Выключатели, задержки и счетчики по всем целям"""
+
+    def __init__(self):
+        self._breakers: Dict[LLMTarget, CircuitBreaker] = {}
+        self._latency: Dict[LLMTarget, LatencyTracker] = {}
+        # Для потоковых запросов — время до первого фрагмента, а не до конца ответа
+        self._first_chunk: Dict[LLMTarget, LatencyTracker] = {}
+
+        # Счетчики
+        self.retries = 0
+        self.fallbacks = 0
+        self.breaker_rejections = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def breaker(self, target: LLMTarget) -> CircuitBreaker:
+        if target not in self._breakers:
+            self._breakers[target] = CircuitBreaker()
+        return self._breakers[target]
+
+    def latency(self, target: LLMTarget) -> LatencyTracker:
+        if target not in self._latency:
+            self._latency[target] = LatencyTracker()
+        return self._latency[target]
+
+    def first_chunk_latency(self, target: LLMTarget) -> LatencyTracker:
+        if target not in self._first_chunk:
+            self._first_chunk[target] = LatencyTracker()
+        return self._first_chunk[target]
+
+    def hedge_delay(self, target: LLMTarget, streaming: bool = False) -> Optional[float]:
+        """Через сколько секунд без ответа (без первого фрагмента потока) отправлять дублирующий запрос"""
+        if not config.llm_hedge_enabled:
+            return None
+        tracker = self.first_chunk_latency(target) if streaming else self.latency(target)
+        return tracker.percentile(config.llm_hedge_percentile)
+
+    def log_breaker(self, target: LLMTarget):
+        breaker = self.breaker(target)
+        if breaker.state == CircuitBreaker.OPEN:
+            logger.warning(f"Выключатель для {target.model} ({target.base_url}) разомкнут "
+                           f"после {breaker.failures} ошибок")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает счетчики повторов, резервных моделей и состояние выключателей"""
+        return {
+            "retries": self.retries,
+            "fallbacks": self.fallbacks,
+            "breaker_rejections": self.breaker_rejections,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "breakers": {
+                f"{target.model}@{target.base_url}": {
+                    "state": breaker.state,
+                    "failures": breaker.failures,
+                    "times_opened": breaker.times_opened,
+                }
+                for target, breaker in self._breakers.items()
+            },
+            "latency_p95_ms": {
+                f"{target.model}@{target.base_url}": round(p95 * 1000, 1)
+                for target, tracker in self._latency.items()
+                if (p95 := tracker.percentile(0.95)) is not None
+            },
+            "first_chunk_p95_ms": {
+                f"{target.model}@{target.base_url}": round(p95 * 1000, 1)
+                for target, tracker in self._first_chunk.items()
+                if (p95 := tracker.percentile(0.95)) is not None
+            },
+        }
@@ -0,0 +1,238 @@
+import re
+from collections import deque
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+from loguru import logger
+from ..config import config
+from .resilience import LLMTarget, parse_targets
+
+
+class ModelTier(NamedTuple):
+    """Уровень моделей: цепочка моделей (основная + запасные) и лимит ответа"""
+    name: str
+    targets: List[LLMTarget]
+    max_tokens: int
+
+    @property
+    def model(self) -> str:
+        return self.targets[0].model
+
+
+class RouteRequest(NamedTuple):
+    """Признаки запроса, по которым выбирается уровень"""
+    subject: str
+    confidence: float
+    text_length: int
+    has_image: bool
+    subscriber: bool
+
+
+# Встроенные уровни повторяют прежнее поведение: LLM_MODEL_TEXT и LLM_MODEL_VISION
+DEFAULT_MAX_TOKENS = 3000
+DEFAULT_ROUTES = "image->vision;*->text"
+
+_COMPARISON = re.compile(r"^(confidence|length)\s*(<=|>=|<|>)\s*([\d.]+)$")
+
+
+def parse_tiers(spec: str, default_base_url: str) -> Dict[str, ModelTier]:
+    """
+    Разбирает уровни моделей из строки
+
+    Формат: "имя=цепочка:max_tokens" через ";", цепочка — как в
+    LLM_FALLBACK_MODELS ("model", "base_url|model" или "base_url|model|ENV_VAR"
+    через запятую), например
+    "fast=gpt-4o-mini:800;strong=gpt-4o,gpt-4o-mini:3000"
+    """
+    tiers = {}
+    for item in spec.split(";"):
+        item = item.strip()
+        if not item or "=" not in item:
+            continue
+        name, rest = item.split("=", 1)
+        chain, max_tokens = rest, DEFAULT_MAX_TOKENS
+        if ":" in rest:
+            head, tail = rest.rsplit(":", 1)
+            if tail.strip().isdigit():
+                chain, max_tokens = head, int(tail)
+        targets = parse_targets(chain, default_base_url)
+        if not targets:
+            logger.warning(f"Уровень моделей {name.strip()!r} без моделей, пропускаем")
+            continue
+        tiers[name.strip()] = ModelTier(name.strip(), targets, max_tokens)
+    return tiers
+
+
+def _parse_condition(condition: str) -> Optional[Callable[[RouteRequest], bool]]:
+    """Одно условие правила маршрутизации -> предикат (None, если не распознано)"""
+    condition = condition.strip()
+    if condition in ("*", ""):
+        return lambda r: True
+    if condition == "image":
+        return lambda r: r.has_image
+    if condition == "text":
+        return lambda r: not r.has_image
+    if condition == "subscriber":
+        return lambda r: r.subscriber
+    if condition == "free":
+        return lambda r: not r.subscriber
+    if condition.startswith("subject="):
+        subjects = {s.strip() for s in condition[len("subject="):].split("|")}
+        return lambda r: r.subject in subjects
+
+    match = _COMPARISON.match(condition)
+    if match:
+        field, op, value = match.group(1), match.group(2), float(match.group(3))
+        attribute = "confidence" if field == "confidence" else "text_length"
+        compare = {
+            "<": lambda a: a < value,
+            "<=": lambda a: a <= value,
+            ">": lambda a: a > value,
+            ">=": lambda a: a >= value,
+        }[op]
+        return lambda r: compare(getattr(r, attribute))
+    return None
+
+
+class Route(NamedTuple):
+    rule: str
+    tier: str
+    predicates: List[Callable[[RouteRequest], bool]]
+    for_images: bool
+
+
+def parse_routes(spec: str, tiers: Dict[str, ModelTier]) -> List[Route]:
+    """
+    Разбирает правила маршрутизации: "условия->уровень" через ";", первое совпавшее побеждает
+
+    Условия через "&": image, text, subscriber, free, subject=физика|химия,
+    confidence<0.4, length>500 (символов), * — любое. Например
+    "image->vision;subject=физика|химия&length>300->strong;length<120->fast;*->standard"
+
+    Фото рассматривают только правила с условием image, чтобы изображение
+    случайно не ушло текстовой модели по правилу "*".
+    """
+    routes = []
+    for rule in spec.split(";"):
+        rule = rule.strip()
+        if "->" not in rule:
+            continue
+        conditions, tier = rule.rsplit("->", 1)
+        tier = tier.strip()
+        if tier not in tiers:
+            logger.warning(f"Правило {rule!r}: неизвестный уровень {tier!r}, пропускаем")
+            continue
+        predicates = [_parse_condition(c) for c in conditions.split("&")]
+        if any(p is None for p in predicates):
+            logger.warning(f"Правило {rule!r}: нераспознанное условие, пропускаем")
+            continue
+        for_images = "image" in {c.strip() for c in conditions.split("&")}
+        routes.append(Route(rule, tier, predicates, for_images))
+    return routes
+
+
+class TierStats:
+    """Счетчики одного уровня: решения, ошибки, задержка и токены"""
+
+    def __init__(self, window: int = 500):
+        self.routed = 0
+        self.completed = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._latency = deque(maxlen=window)
+
+    def record(self, seconds: float, prompt_tokens: int, completion_tokens: int):
+        self.completed += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self._latency.append(seconds)
+
+    def to_dict(self) -> Dict[str, Any]:
+        latency = sorted(self._latency)
+
+        def percentile(q: float) -> float:
+            return round(latency[min(len(latency) - 1, int(len(latency) * q))] * 1000, 1) if latency else 0.0
+
+        return {
+            "routed": self.routed,
+            "completed": self.completed,
+            "errors": self.errors,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "avg_completion_tokens": round(self.completion_tokens / self.completed, 1) if self.completed else 0.0,
+            "latency_p50_ms": percentile(0.50),
+            "latency_p95_ms": percentile(0.95),
+        }
+
+
+class ModelRouter:
+    """
+    Выбирает уровень моделей по предмету, уверенности, длине текста,
+    наличию фото и подписке (LLM_TIERS, LLM_ROUTES)
+    """
+
+    def __init__(self, tiers_spec: str = None, routes_spec: str = None, base_url: str = None):
+        base_url = base_url or config.llm_base_url
+        self.tiers: Dict[str, ModelTier] = {
+            "text": ModelTier(
+                "text",
+                [LLMTarget(base_url, config.llm_model_text)] + parse_targets(config.llm_fallback_models, base_url),
+                DEFAULT_MAX_TOKENS,
+            ),
+            "vision": ModelTier(
+                "vision",
+                [LLMTarget(base_url, config.llm_model_vision)] + parse_targets(config.llm_fallback_models_vision, base_url),
+                DEFAULT_MAX_TOKENS,
+            ),
+        }
+        self.tiers.update(parse_tiers(config.llm_tiers if tiers_spec is None else tiers_spec, base_url))
+
+        routes_spec = config.llm_routes if routes_spec is None else routes_spec
+        self.routes = parse_routes(routes_spec or DEFAULT_ROUTES, self.tiers)
+        self._fallback_routes = parse_routes(DEFAULT_ROUTES, self.tiers)
+
+        self._stats: Dict[str, TierStats] = {name: TierStats() for name in self.tiers}
+        self._rule_hits: Dict[str, int] = {}
+
+    def default_tier(self, has_image: bool = False) -> ModelTier:
+        """Уровень для вызовов без маршрутизации (прежнее поведение)"""
+        return self.tiers["vision" if has_image else "text"]
+
+    def route(self, subject: str, confidence: float = 0.0, text_length: int = 0,
+              has_image: bool = False, subscriber: bool = False) -> ModelTier:
+        """Возвращает уровень по первому подходящему правилу"""
+        request = RouteRequest(subject or "", confidence, text_length, has_image, subscriber)
+        for route in self.routes + self._fallback_routes:
+            if has_image and not route.for_images:
+                continue
+            if all(predicate(request) for predicate in route.predicates):
+                tier = self.tiers[route.tier]
+                self._rule_hits[route.rule] = self._rule_hits.get(route.rule, 0) + 1
+                self._stats[tier.name].routed += 1
+                logger.debug(f"Маршрут {request} -> {tier.name} ({route.rule})")
+                return tier
+        return self.default_tier(has_image)
+
+    def record(self, tier: ModelTier, seconds: float, prompt_tokens: int = 0,
+               completion_tokens: int = 0, ok: bool = True):
+        """Учитывает результат запроса к уровню"""
+        stats = self._stats.setdefault(tier.name, TierStats())
+        if not ok:
+            stats.errors += 1
+            return
+        stats.record(seconds, prompt_tokens or 0, completion_tokens or 0)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает решения по правилам и задержку/токены по уровням"""
+        return {
+            "tiers": {
+                name: {"model": self.tiers[name].model if name in self.tiers else None,
+                       "max_tokens": self.tiers[name].max_tokens if name in self.tiers else None,
+                       **stats.to_dict()}
+                for name, stats in self._stats.items()
+            },
+            "rules": dict(self._rule_hits),
+        }
+
+
+# Глобальный экземпляр
+model_router = ModelRouter()
@@ -0,0 +1,227 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
+from loguru import logger
+from ..config import config
+from ..utils.tokens import count_tokens
+
+
+# Приоритеты запросов: меньше — раньше
+PRIORITY_SUBSCRIBER = 0
+PRIORITY_FREE = 1
+
+PRIORITY_NAMES = {
+    PRIORITY_SUBSCRIBER: "subscriber",
+    PRIORITY_FREE: "free",
+}
+
+# Грубая оценка размера изображения в токенах для vision-запросов
+IMAGE_TOKENS_ESTIMATE = 1000
+
+
+def estimate_tokens(messages: List[Dict[str, Any]], max_tokens: int) -> int:
+    """Оценивает число токенов запроса: промпт + ожидаемый ответ"""
+    prompt = 0
+    for msg in messages:
+        content = msg.get("content")
+        if isinstance(content, str):
+            prompt += count_tokens(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    prompt += count_tokens(part.get("text", ""))
+                else:
+                    prompt += IMAGE_TOKENS_ESTIMATE
+    completion = min(max_tokens, config.llm_expected_completion_tokens)
+    return prompt + completion
+
+
+class TokenBucket:
+    """Token bucket с равномерным пополнением"""
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.refill_per_second)
+        self._updated = now
+
+    def time_until(self, amount: float) -> float:
+        """Сколько секунд ждать, пока в ведре наберется amount токенов"""
+        self._refill()
+        # Запрос больше емкости ведра пропускаем, как только оно полное
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_per_second
+
+    def take(self, amount: float):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount: float):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class _Waiter:
+    __slots__ = ("future", "tokens", "priority", "enqueued_at")
+
+    def __init__(self, future: asyncio.Future, tokens: int, priority: int):
+        self.future = future
+        self.tokens = tokens
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+
+
+class LLMScheduler:
+    """
+    Глобальный планировщик допуска запросов к LLM
+
+    Ограничивает число одновременных запросов и расход по лимитам
+    провайдера (запросы в минуту и токены в минуту). Ожидающие запросы
+    стоят в очереди с приоритетом: подписчики идут раньше бесплатных.
+    """
+
+    def __init__(self, max_concurrency: int = None, rpm: int = None, tpm: int = None,
+                 queue_timeout: float = None):
+        self.max_concurrency = max_concurrency or config.llm_max_concurrency
+        rpm = rpm or config.llm_rpm_limit
+        tpm = tpm or config.llm_tpm_limit
+        self.queue_timeout = queue_timeout or config.llm_queue_timeout
+
+        self._requests = TokenBucket(rpm, rpm / 60.0)
+        self._tokens = TokenBucket(tpm, tpm / 60.0)
+
+        self._queue: list = []
+        self._seq = itertools.count()
+        self._active = 0
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+        # Статистика
+        self.admitted = 0
+        self.timed_out = 0
+        self.peak_queue_depth = 0
+        self._waits = deque(maxlen=1000)
+
+    def _can_admit(self, tokens: int) -> float:
+        """0 — можно пускать сейчас, иначе через сколько секунд проверить снова"""
+        return max(self._requests.time_until(1), self._tokens.time_until(tokens))
+
+    def _admit(self, tokens: int):
+        self._requests.take(1)
+        self._tokens.take(tokens)
+        self._active += 1
+        self.admitted += 1
+
+    def _dispatch(self):
+        """Пускает запросы из головы очереди, пока есть свободные слоты и токены"""
+        self._wakeup = None
+        while self._queue and self._active < self.max_concurrency:
+            waiter: _Waiter = self._queue[0][2]
+            if waiter.future.done():
+                heapq.heappop(self._queue)
+                continue
+
+            delay = self._can_admit(waiter.tokens)
+            if delay > 0:
+                # Ждем пополнения ведер; строго соблюдаем порядок приоритетов
+                self._wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+
+            heapq.heappop(self._queue)
+            self._admit(waiter.tokens)
+            waiter.future.set_result(None)
+
+    async def acquire(self, tokens: int, priority: int = PRIORITY_FREE):
+        """Ждет разрешения на запрос к LLM"""
+        started = time.monotonic()
+
+        if not self._queue and self._active < self.max_concurrency and self._can_admit(tokens) == 0:
+            self._admit(tokens)
+            self._waits.append(0.0)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = _Waiter(future, tokens, priority)
+        heapq.heappush(self._queue, (priority, next(self._seq), waiter))
+        self.peak_queue_depth = max(self.peak_queue_depth, len(self._queue))
+        if self._wakeup is None:
+            self._dispatch()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # Слот выдали в последний момент — не теряем его
+                return
+            self.timed_out += 1
+            future.cancel()
+            logger.warning(f"Запрос к LLM не дождался очереди за {self.queue_timeout} с")
+            raise
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан — возвращаем его
+                self.release(tokens)
+            future.cancel()
+            raise
+        finally:
+            self._waits.append(time.monotonic() - started)
+
+    def release(self, tokens: int = 0, actual_tokens: int = None):
+        """Освобождает слот; если известен реальный расход токенов, корректирует ведро"""
+        self._active -= 1
+        if actual_tokens is not None and actual_tokens < tokens:
+            self._tokens.refund(tokens - actual_tokens)
+        if self._wakeup is None:
+            self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, tokens: int, priority: int = PRIORITY_FREE) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Контекст допуска запроса к LLM
+
+        В выданный словарь можно записать "actual_tokens" — реальный расход
+        из поля usage ответа, тогда лишнее списание вернется в ведро.
+        """
+        await self.acquire(tokens, priority)
+        usage: Dict[str, Any] = {}
+        try:
+            yield usage
+        finally:
+            self.release(tokens, usage.get("actual_tokens"))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает состояние очереди и время ожидания"""
+        depth_by_priority = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, _, waiter in self._queue:
+            if not waiter.future.done():
+                depth_by_priority[PRIORITY_NAMES.get(priority, str(priority))] += 1
+
+        waits = sorted(self._waits)
+        return {
+            "active": self._active,
+            "max_concurrency": self.max_concurrency,
+            "queue_depth": sum(depth_by_priority.values()),
+            "queue_depth_by_priority": depth_by_priority,
+            "peak_queue_depth": self.peak_queue_depth,
+            "admitted": self.admitted,
+            "timed_out": self.timed_out,
+            "wait_avg_ms": round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0,
+            "wait_p95_ms": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1) if waits else 0.0,
+            "wait_max_ms": round(waits[-1] * 1000, 1) if waits else 0.0,
+            "rpm_available": int(self._requests.tokens),
+            "tpm_available": int(self._tokens.tokens),
+        }
+
+
+# Глобальный экземпляр планировщика
+llm_scheduler = LLMScheduler()
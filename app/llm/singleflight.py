@@ -0,0 +1,75 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+class SingleFlight:
+    """
+    Объединение одинаковых запросов, выполняющихся одновременно
+
+    Первый запрос с данным ключом становится ведущим и идет в API,
+    остальные ждут его результат и не создают своих вызовов.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, asyncio.Future] = {}
+
+        # Счетчики
+        self.leaders = 0
+        self.coalesced = 0
+
+    def join(self, key: str) -> Optional[asyncio.Future]:
+        """Возвращает future уже идущего запроса с таким ключом (или None)"""
+        future = self._flights.get(key)
+        if future is not None:
+            self.coalesced += 1
+        return future
+
+    def begin(self, key: str) -> asyncio.Future:
+        """Регистрирует ведущий запрос"""
+        future = asyncio.get_running_loop().create_future()
+        # Ошибку ведущего могут так и не забрать, если ожидающих нет
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._flights[key] = future
+        self.leaders += 1
+        return future
+
+    def finish(self, key: str, result: Any = None, error: BaseException = None):
+        """Завершает ведущий запрос и раздает результат ожидающим"""
+        future = self._flights.pop(key, None)
+        if future is None or future.done():
+            return
+        if isinstance(error, asyncio.CancelledError):
+            future.cancel()
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Выполняет fn один раз для всех одновременных вызовов с одним ключом"""
+        future = self.join(key)
+        if future is not None:
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # Ведущий запрос отменили — выполняем свой
+                return await fn()
+
+        self.begin(key)
+        try:
+            result = await fn()
+        except BaseException as e:
+            self.finish(key, error=e)
+            raise
+        self.finish(key, result)
+        return result
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает статистику объединения запросов"""
+        return {
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._flights)
+        }
@@ -8,6 +8,11 @@ from aiogram.fsm.storage.memory import MemoryStorage
 from .config import config
 from .handlers.start import router as start_router
 from .db.repo import db_repo
+from .db.retention import retention
+from .db.rollup import daily_rollup
+from .middleware.rate_limit import rate_limiter
+from .llm.client import llm_client
+from .utils.images import shutdown_executor
 
 
 class SchoolBot:
@@ -18,6 +23,8 @@ class SchoolBot:
         self.storage = MemoryStorage()
         self.dp = Dispatcher(storage=self.storage)
         self.cleanup_task = None
+        self.rollup_task = None
+        self.rate_limit_task = None
         
         # Регистрируем обработчики
         self.dp.include_router(start_router)
@@ -36,22 +43,17 @@ class SchoolBot:
     async def start_cleanup_task(self):
         """Запускает периодическую задачу очистки данных"""
         async def cleanup_loop():
+            delay = 6 * 60 * 60
             while True:
                 try:
-                    # Ждем 6 часов
-                    await asyncio.sleep(6 * 60 * 60)
+                    # Ждем 6 часов (или меньше, если прошлый проход не уложился в бюджет)
+                    await asyncio.sleep(delay)
                     
                     logger.info("Запуск автоматической очистки данных...")
-                    result = await db_repo.cleanup_old_data()
+                    result = await retention.run()
                     
                     logger.info(f"Очистка завершена: {result}")
-                    
-                    # Если удалили много данных, делаем VACUUM
-                    total_deleted = sum(result.values())
-                    if total_deleted > 100:
-                        logger.info("Выполняем VACUUM для оптимизации базы данных...")
-                        await db_repo.vacuum_database()
-                        logger.info("VACUUM завершен")
+                    delay = 6 * 60 * 60 if result["complete"] else 10 * 60
                         
                 except Exception as e:
                     logger.error(f"Ошибка при автоматической очистке: {e}")
@@ -69,6 +71,62 @@ class SchoolBot:
                 pass
             logger.info("Задача автоматической очистки остановлена")
     
+    async def start_rollup_task(self):
+        """Запускает периодическое обновление дневных агрегатов"""
+        async def rollup_loop():
+            while True:
+                try:
+                    await daily_rollup.run()
+                except Exception as e:
+                    logger.error(f"Ошибка обновления дневных агрегатов: {e}")
+                await asyncio.sleep(config.rollup_interval)
+        
+        self.rollup_task = asyncio.create_task(rollup_loop())
+    
+    async def stop_rollup_task(self):
+        """Останавливает обновление дневных агрегатов"""
+        if self.rollup_task:
+            self.rollup_task.cancel()
+            try:
+                await self.rollup_task
+            except asyncio.CancelledError:
+                pass
+    
+    async def start_rate_limit_task(self):
+        """Восстанавливает лимиты частоты из базы и периодически их сохраняет"""
+        if config.rate_limit_snapshot_interval <= 0:
+            return
+        try:
+            await rate_limiter.load(db_repo)
+            logger.info(f"Лимиты частоты восстановлены: {len(rate_limiter)} пользователей")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки лимитов частоты: {e}")
+        
+        async def snapshot_loop():
+            while True:
+                await asyncio.sleep(config.rate_limit_snapshot_interval)
+                try:
+                    await rate_limiter.save(db_repo)
+                except Exception as e:
+                    logger.error(f"Ошибка сохранения лимитов частоты: {e}")
+        
+        self.rate_limit_task = asyncio.create_task(snapshot_loop())
+    
+    async def stop_rate_limit_task(self):
+        """Останавливает сохранение лимитов и делает последний снимок"""
+        if not self.rate_limit_task:
+            return
+        self.rate_limit_task.cancel()
+        try:
+            await self.rate_limit_task
+        except asyncio.CancelledError:
+            pass
+        self.rate_limit_task = None
+        try:
+            await rate_limiter.save(db_repo)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения лимитов частоты: {e}")
+    
     async def start(self):
         """Запускает бота"""
         try:
@@ -77,11 +135,16 @@ class SchoolBot:
             await db_repo.init_db()
             logger.info("База данных инициализирована")
             
+            # Поднимаем общий пул соединений к LLM
+            await llm_client.start()
+            
             # Устанавливаем команды
             await self.set_commands()
             
             # Запускаем задачу автоматической очистки
             await self.start_cleanup_task()
+            await self.start_rollup_task()
+            await self.start_rate_limit_task()
             
             # Запускаем бота
             logger.info("Бот запускается...")
@@ -92,14 +155,25 @@ class SchoolBot:
             raise
         finally:
             await self.stop_cleanup_task()
+            await self.stop_rollup_task()
+            await self.stop_rate_limit_task()
+            await db_repo.flush()
             await self.bot.session.close()
+            await llm_client.close()
+            shutdown_executor()
             await db_repo.close()
     
     async def stop(self):
         """Останавливает бота"""
         logger.info("Бот останавливается...")
         await self.stop_cleanup_task()
+        await self.stop_rollup_task()
+        await self.stop_rate_limit_task()
+        # Фиксируем отложенные записи (сообщения, запросы), пока соединения открыты
+        await db_repo.flush()
         await self.bot.session.close()
+        await llm_client.close()
+        shutdown_executor()
         await db_repo.close()
 
 
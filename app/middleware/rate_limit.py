@@ -0,0 +1,182 @@
+"""
+Ограничение частоты заданий на пользователя (GCRA)
+
+На пользователя хранится одно число — теоретическое время прибытия (TAT)
+следующего задания. Лимит N в час: каждое задание сдвигает TAT на 3600/N
+секунд, задание отклоняется, если TAT ушел вперед больше чем на час без
+одного интервала — то есть подряд можно отправить до N заданий, дальше
+по одному в 3600/N секунд. Запись, у которой TAT уже в прошлом, ничем не
+отличается от отсутствующей и удаляется.
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+from aiogram import BaseMiddleware
+from aiogram.types import Message, TelegramObject
+from loguru import logger
+from ..config import config
+from ..db.base import StorageBackend
+
+
+HOUR = 3600.0
+
+# Сколько самых старых записей проверять на истечение за один вызов
+EXPIRE_PER_CHECK = 2
+
+
+class GCRALimiter:
+    """
+    TAT пользователей в порядке последнего обновления
+
+    Время — по часам системы (time.time), чтобы сохраненное состояние
+    оставалось верным после перезапуска. Каждая запись истекает не позже
+    чем через час после своего обновления, поэтому хватает проверять
+    несколько самых старых записей при каждом вызове.
+    """
+
+    def __init__(self, max_users: int = None):
+        self.max_users = max_users or config.rate_limit_max_users
+
+        self._tat: "OrderedDict[int, float]" = OrderedDict()
+
+        # Счетчики
+        self.expired = 0
+        self.evictions = 0
+
+    def check(self, user_id: int, limit_per_hour: int, now: float = None) -> float:
+        """Учитывает задание; 0 — разрешено, иначе через сколько секунд можно снова"""
+        now = time.time() if now is None else now
+        interval = HOUR / limit_per_hour
+        tat = max(self._tat.get(user_id, now), now)
+
+        retry_after = tat - now - (HOUR - interval)
+        if retry_after > 0:
+            return retry_after
+
+        self._tat[user_id] = tat + interval
+        self._tat.move_to_end(user_id)
+        self._expire(now)
+        return 0.0
+
+    def _expire(self, now: float):
+        for _ in range(EXPIRE_PER_CHECK):
+            if not self._tat:
+                return
+            user_id, tat = next(iter(self._tat.items()))
+            if tat > now:
+                break
+            del self._tat[user_id]
+            self.expired += 1
+
+        while len(self._tat) > self.max_users:
+            self._tat.popitem(last=False)
+            self.evictions += 1
+
+    def snapshot(self, now: float = None) -> List[Tuple[int, float]]:
+        """Действующие записи (user_id, TAT) для сохранения"""
+        now = time.time() if now is None else now
+        return [(user_id, tat) for user_id, tat in self._tat.items() if tat > now]
+
+    def restore(self, states: List[Tuple[int, float]]):
+        """Восстанавливает сохраненные записи (не затирая более поздние TAT в памяти)"""
+        for user_id, tat in states:
+            if tat > self._tat.get(user_id, 0.0):
+                self._tat[user_id] = tat
+
+    async def load(self, repo: StorageBackend):
+        """Загружает сохраненное состояние при старте"""
+        self.restore(await repo.load_rate_limits(time.time()))
+
+    async def save(self, repo: StorageBackend):
+        """Сохраняет действующие записи и удаляет истекшие"""
+        now = time.time()
+        await repo.save_rate_limits(self.snapshot(now), now)
+
+    def __len__(self) -> int:
+        return len(self._tat)
+
+
+class RateLimitMiddleware(BaseMiddleware):
+    """
+    Outer middleware сообщений: задания сверх лимита не доходят до обработчиков
+
+    Лимит зависит от подписки (config.rate_limit_per_hour и
+    config.rate_limit_per_hour_subscriber, 0 — без лимита), администраторы
+    из config.admin_ids не ограничены. is_limited отбирает сообщения,
+    которые тратят LLM (команды и кнопки меню не считаются).
+    """
+
+    def __init__(self, repo: StorageBackend, limiter: GCRALimiter,
+                 is_limited: Callable[[Message], bool]):
+        self.repo = repo
+        self.limiter = limiter
+        self.is_limited = is_limited
+
+        # Кому уже сказали о лимите (повторно не отвечаем, пока лимит не отпустит)
+        self._notified: Dict[int, float] = {}
+
+        # Счетчики
+        self.allowed = 0
+        self.rejected = 0
+        self.exempt = 0
+
+    async def _limit(self, user_id: int) -> int:
+        try:
+            if await self.repo.has_active_subscription(user_id):
+                return config.rate_limit_per_hour_subscriber
+        except Exception as e:
+            logger.warning(f"Не удалось проверить подписку {user_id}: {e}")
+        return config.rate_limit_per_hour
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = getattr(event, "from_user", None)
+        if user is None or not isinstance(event, Message) or not self.is_limited(event):
+            return await handler(event, data)
+        if user.id in config.admin_ids:
+            self.exempt += 1
+            return await handler(event, data)
+
+        limit = await self._limit(user.id)
+        if limit <= 0:
+            self.exempt += 1
+            return await handler(event, data)
+
+        now = time.time()
+        retry_after = self.limiter.check(user.id, limit, now)
+        if retry_after <= 0:
+            self.allowed += 1
+            self._notified.pop(user.id, None)
+            return await handler(event, data)
+
+        self.rejected += 1
+        if self._notified.get(user.id, 0.0) > now:
+            return None
+        if len(self._notified) > self.limiter.max_users:
+            self._notified.clear()
+        self._notified[user.id] = now + retry_after
+
+        minutes = max(1, round(retry_after / 60))
+        logger.info(f"Пользователь {user.id} превысил лимит {limit} заданий в час")
+        await event.answer(
+            f"⏳ Лимит — {limit} заданий в час. Следующее можно отправить через {minutes} мин."
+        )
+        return None
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "exempt": self.exempt,
+            "users": len(self.limiter),
+            "expired": self.limiter.expired,
+            "evictions": self.limiter.evictions,
+        }
+
+
+# Глобальный экземпляр
+rate_limiter = GCRALimiter()
@@ -0,0 +1,75 @@
+import math
+from typing import Iterable
+
+
+# 2^11 регистров по байту: 2 КБ на скетч, стандартная ошибка ~2.3%
+DEFAULT_PRECISION = 11
+
+MASK64 = (1 << 64) - 1
+
+
+def mix64(value: int) -> int:
+    """Перемешивание 64-битного числа (финализатор splitmix64)"""
+    value = (value + 0x9E3779B97F4A7C15) & MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
+
+
+class HyperLogLog:
+    """
+    Оценка числа различных значений (HyperLogLog)
+
+    Занимает фиксированные 2^precision байт независимо от числа значений.
+    Скетчи объединяются поэлементным максимумом регистров, поэтому
+    уникальных за неделю можно получить из дневных скетчей.
+    """
+
+    __slots__ = ("precision", "registers")
+
+    def __init__(self, precision: int = DEFAULT_PRECISION, registers: bytes = None):
+        self.precision = precision
+        size = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(size)
+        if len(self.registers) != size:
+            raise ValueError(f"Скетч на {len(self.registers)} регистров, ожидалось {size}")
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        """Восстанавливает скетч из to_bytes() (точность — по длине)"""
+        return cls(int(math.log2(len(data))), data)
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.registers)
+
+    def add(self, value: int):
+        """Добавляет целое значение (например, user_id)"""
+        hashed = mix64(value)
+        rest_bits = 64 - self.precision
+        index = hashed >> rest_bits
+        rest = hashed & ((1 << rest_bits) - 1)
+        # Номер первой единицы в оставшихся битах
+        rank = rest_bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values: Iterable[int]):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other: "HyperLogLog"):
+        """Объединение со скетчем той же точности"""
+        if other.precision != self.precision:
+            raise ValueError("Нельзя объединить скетчи разной точности")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        """Оценка числа различных значений"""
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # Малые значения: линейный подсчет по пустым регистрам
+            estimate = size * math.log(size / zeros)
+        return round(estimate)
@@ -0,0 +1,15 @@
+import hashlib
+
+
+# Дайджест содержимого фото, байт
+DIGEST_SIZE = 16
+
+
+def content_digest(data: bytes) -> bytes:
+    """
+    Точный отпечаток байтов фото (blake2b) — ключ кэша ответов по фото
+
+    Перцептивный хэш (dHash) не подошел: 64 бита не различают листы с
+    текстом, разные страницы дают расстояние 0-5.
+    """
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
@@ -0,0 +1,141 @@
+import asyncio
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+from aiogram.types import PhotoSize
+from loguru import logger
+from PIL import Image, ImageChops, ImageOps, ImageStat
+from ..config import config
+
+
+# Pillow отпускает GIL на тяжелых операциях, поэтому хватает пула потоков
+_executor: Optional[ThreadPoolExecutor] = None
+
+# Порог отличия пикселя от фона при поиске полей (0-255)
+MARGIN_THRESHOLD = 40
+
+# Средняя насыщенность, ниже которой фото считаем черно-белым листом
+GRAYSCALE_SATURATION = 40
+
+# Размер уменьшенной копии для анализа (поля, цветность)
+ANALYSIS_SIZE = 256
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=config.image_workers,
+            thread_name_prefix="image"
+        )
+    return _executor
+
+
+def shutdown_executor():
+    """Останавливает пул обработки изображений"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def choose_photo_size(photos: List[PhotoSize]) -> PhotoSize:
+    """
+    Выбирает наименьший из размеров фото Telegram, которого хватает для распознавания
+
+    Достаточным считается размер, у которого длинная сторона не меньше
+    config.image_min_side. Если таких нет — берется самый большой.
+    """
+    adequate = [p for p in photos if max(p.width, p.height) >= config.image_min_side]
+    if adequate:
+        return min(adequate, key=lambda p: p.width * p.height)
+    return max(photos, key=lambda p: p.width * p.height)
+
+
+def _crop_margins(image: Image.Image) -> Image.Image:
+    """Обрезает однотонные поля вокруг содержимого"""
+    gray = image.convert("L")
+    gray.thumbnail((ANALYSIS_SIZE, ANALYSIS_SIZE))
+
+    # Цвет фона — самый частый цвет по краю кадра
+    width, height = gray.size
+    border = [gray.getpixel((x, 0)) for x in range(width)] + \
+             [gray.getpixel((x, height - 1)) for x in range(width)] + \
+             [gray.getpixel((0, y)) for y in range(height)] + \
+             [gray.getpixel((width - 1, y)) for y in range(height)]
+    background = max(set(border), key=border.count)
+
+    diff = ImageChops.difference(gray, Image.new("L", gray.size, background))
+    bbox = diff.point(lambda p: 255 if p > MARGIN_THRESHOLD else 0).getbbox()
+    if not bbox:
+        return image
+
+    # Не режем, если полей почти нет или "содержимое" подозрительно маленькое
+    crop_area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+    if crop_area > 0.95 * width * height or crop_area < 0.3 * width * height:
+        return image
+
+    scale_x = image.width / width
+    scale_y = image.height / height
+    pad_x = int(image.width * 0.02)
+    pad_y = int(image.height * 0.02)
+    return image.crop((
+        max(int(bbox[0] * scale_x) - pad_x, 0),
+        max(int(bbox[1] * scale_y) - pad_y, 0),
+        min(int(bbox[2] * scale_x) + pad_x, image.width),
+        min(int(bbox[3] * scale_y) + pad_y, image.height),
+    ))
+
+
+def _is_grayscale_document(image: Image.Image) -> bool:
+    """Фото листа с заданием почти не содержит цвета"""
+    preview = image.copy()
+    preview.thumbnail((ANALYSIS_SIZE, ANALYSIS_SIZE))
+    saturation = ImageStat.Stat(preview.convert("HSV").getchannel("S")).mean[0]
+    return saturation < GRAYSCALE_SATURATION
+
+
+def preprocess_image(data: bytes) -> bytes:
+    """
+    Подготавливает фото к vision-запросу
+
+    Поворачивает по EXIF, обрезает поля, уменьшает до config.image_max_side
+    по длинной стороне, переводит листы с заданиями в оттенки серого и
+    пережимает в JPEG. Если результат получился больше исходника,
+    возвращается исходник.
+    """
+    with Image.open(io.BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original)
+        image = image.convert("RGB")
+
+    image = _crop_margins(image)
+
+    if max(image.size) > config.image_max_side:
+        image.thumbnail((config.image_max_side, config.image_max_side), Image.LANCZOS)
+
+    if _is_grayscale_document(image):
+        image = image.convert("L")
+
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=config.image_jpeg_quality, optimize=True)
+    result = output.getvalue()
+    return result if len(result) < len(data) else data
+
+
+async def preprocess_image_async(data: bytes) -> bytes:
+    """Выполняет preprocess_image в пуле потоков, не блокируя event loop"""
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(_get_executor(), preprocess_image, data)
+    except Exception as e:
+        logger.warning(f"Не удалось обработать изображение, отправляем как есть: {e}")
+        return data
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    logger.info(
+        f"Изображение подготовлено: {len(data)} → {len(result)} байт "
+        f"за {elapsed_ms:.0f} мс"
+    )
+    return result
@@ -0,0 +1,62 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict
+
+
+class StageMetrics:
+    """
+    Задержки этапов обработки сообщений (скачивание фото, контекст, LLM, запись в БД)
+
+    Для каждого этапа хранится скользящее окно последних замеров, по нему
+    считаются перцентили. Используется в хендлерах и в нагрузочном тесте.
+    """
+
+    def __init__(self, window: int = 5000):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+        self._counts: Dict[str, int] = {}
+
+    def record(self, stage: str, seconds: float):
+        if stage not in self._samples:
+            self._samples[stage] = deque(maxlen=self.window)
+            self._counts[stage] = 0
+        self._samples[stage].append(seconds)
+        self._counts[stage] += 1
+
+    @contextmanager
+    def measure(self, stage: str):
+        """Замеряет время выполнения блока: with stage_metrics.measure("llm"): ..."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def reset(self):
+        self._samples.clear()
+        self._counts.clear()
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Возвращает количество замеров и p50/p95/p99/max в миллисекундах по этапам"""
+        stats = {}
+        for stage, samples in self._samples.items():
+            ordered = sorted(samples)
+            if not ordered:
+                continue
+
+            def percentile(q: float) -> float:
+                return round(ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000, 1)
+
+            stats[stage] = {
+                "count": self._counts[stage],
+                "p50_ms": percentile(0.50),
+                "p95_ms": percentile(0.95),
+                "p99_ms": percentile(0.99),
+                "max_ms": round(ordered[-1] * 1000, 1),
+            }
+        return stats
+
+
+# Глобальный экземпляр
+stage_metrics = StageMetrics()
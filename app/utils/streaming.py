@@ -0,0 +1,79 @@
+import time
+from typing import AsyncIterator, List
+from aiogram.types import Message
+from loguru import logger
+from ..config import config
+from .metrics import stage_metrics
+
+
+# Максимальная длина текста сообщения в Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Курсор, показывающий, что ответ еще генерируется
+STREAM_CURSOR = " ▌"
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """Разбивает длинный текст на части, стараясь резать по абзацам и строкам"""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        parts.append(text)
+    return parts
+
+
+async def _safe_edit(message: Message, text: str) -> bool:
+    """Редактирует сообщение, не падая на ошибках Telegram"""
+    try:
+        await message.edit_text(text)
+        return True
+    except Exception as e:
+        logger.debug(f"Не удалось отредактировать сообщение: {e}")
+        return False
+
+
+async def render_stream(processing_msg: Message, chunks: AsyncIterator[str]) -> str:
+    """
+    Показывает ответ в сообщении "Обрабатываю…" по мере генерации
+
+    Сообщение редактируется не чаще, чем раз в config.stream_edit_interval секунд,
+    чтобы не упираться в лимиты Telegram на редактирование.
+
+    Returns:
+        Полный текст ответа
+    """
+    answer = ""
+    last_shown = ""
+    last_edit = 0.0
+    started = time.perf_counter()
+
+    async for chunk in chunks:
+        if not answer:
+            stage_metrics.record("llm_first_chunk", time.perf_counter() - started)
+        answer += chunk
+
+        now = time.monotonic()
+        if now - last_edit < config.stream_edit_interval:
+            continue
+
+        # Пока ответ генерируется, показываем только то, что влезает в одно сообщение
+        preview = answer[:TELEGRAM_MESSAGE_LIMIT - len(STREAM_CURSOR)] + STREAM_CURSOR
+        if preview != last_shown and await _safe_edit(processing_msg, preview):
+            last_shown = preview
+            last_edit = now
+
+    # Финальный текст: первая часть — в исходное сообщение, остальные — новыми
+    parts = split_message(answer) or ["Пустой ответ. Попробуйте переформулировать задание."]
+    if parts[0] != last_shown and not await _safe_edit(processing_msg, parts[0]):
+        await processing_msg.answer(parts[0])
+    for part in parts[1:]:
+        await processing_msg.answer(part)
+
+    return answer
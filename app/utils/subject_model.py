@@ -0,0 +1,278 @@
+import json
+import math
+import os
+import re
+import time
+import zlib
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from loguru import logger
+from ..config import config
+
+
+# Версия формата файла модели: модель другого формата не загружается
+FORMAT_VERSION = 1
+
+# Длины символьных n-грамм внутри слов (слово дополняется пробелами по краям)
+NGRAM_MIN = 2
+NGRAM_MAX = 4
+
+_WORD = re.compile(r"[^\W\d_]+|\d+|[^\w\s]", re.UNICODE)
+
+
+def extract_features(text: str) -> Dict[int, float]:
+    """
+    Признаки текста: хэши символьных n-грамм -> вес
+
+    Вес — сублинейная частота (1 + log tf), вектор нормируется по L2.
+    Числа заменяются на "0", чтобы модель не запоминала конкретные значения.
+    """
+    counts: Counter = Counter()
+    for word in _WORD.findall(text.lower().replace("ё", "е")):
+        if word.isdigit():
+            word = "0"
+        padded = f" {word} "
+        for n in range(NGRAM_MIN, NGRAM_MAX + 1):
+            for i in range(len(padded) - n + 1):
+                counts[zlib.crc32(padded[i:i + n].encode("utf-8"))] += 1
+
+    features = {h: 1.0 + math.log(c) for h, c in counts.items()}
+    norm = math.sqrt(sum(v * v for v in features.values()))
+    if norm:
+        features = {h: v / norm for h, v in features.items()}
+    return features
+
+
+class SparseRows:
+    """Строки признаков в формате CSR (indptr, indices, data) по словарю модели"""
+
+    def __init__(self, rows: List[Dict[int, float]], vocabulary: np.ndarray):
+        indptr = [0]
+        indices = []
+        data = []
+        for row in rows:
+            ids = np.fromiter(row.keys(), dtype=np.uint32, count=len(row))
+            values = np.fromiter(row.values(), dtype=np.float64, count=len(row))
+            positions = np.searchsorted(vocabulary, ids)
+            positions[positions == len(vocabulary)] = 0
+            known = vocabulary[positions] == ids if len(vocabulary) else np.zeros(len(ids), bool)
+            indices.append(positions[known])
+            data.append(values[known])
+            indptr.append(indptr[-1] + int(known.sum()))
+        self.indptr = np.array(indptr, dtype=np.int64)
+        self.indices = np.concatenate(indices) if indices else np.zeros(0, np.int64)
+        self.data = np.concatenate(data) if data else np.zeros(0)
+        self.rows = np.repeat(np.arange(len(rows)), np.diff(self.indptr))
+        self.n_rows = len(rows)
+
+    def dot(self, weights: np.ndarray) -> np.ndarray:
+        """X @ W"""
+        out = np.zeros((self.n_rows, weights.shape[1]))
+        nonempty = np.diff(self.indptr) > 0
+        if nonempty.any():
+            contributions = self.data[:, None] * weights[self.indices]
+            out[nonempty] = np.add.reduceat(contributions, self.indptr[:-1][nonempty])
+        return out
+
+    def t_dot(self, grad: np.ndarray, n_features: int) -> np.ndarray:
+        """X.T @ G"""
+        out = np.empty((n_features, grad.shape[1]))
+        for c in range(grad.shape[1]):
+            out[:, c] = np.bincount(self.indices, weights=self.data * grad[self.rows, c],
+                                    minlength=n_features)
+        return out
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+class SubjectModel:
+    """Линейная модель (мультиклассовая логистическая регрессия) по символьным n-граммам"""
+
+    def __init__(self, subjects: List[str], vocabulary: np.ndarray,
+                 weights: np.ndarray, bias: np.ndarray, meta: Dict[str, Any]):
+        self.subjects = subjects
+        self.vocabulary = vocabulary
+        self.weights = weights
+        self.bias = bias
+        self.meta = meta
+
+    @property
+    def version(self) -> str:
+        return self.meta.get("model_version", "?")
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """Предмет и вероятность: один разреженный dot product по n-граммам текста"""
+        features = extract_features(text)
+        scores = self.bias.astype(np.float64)
+        if features and len(self.vocabulary):
+            ids = np.fromiter(features.keys(), dtype=np.uint32, count=len(features))
+            values = np.fromiter(features.values(), dtype=np.float64, count=len(features))
+            positions = np.searchsorted(self.vocabulary, ids)
+            positions[positions == len(self.vocabulary)] = 0
+            known = self.vocabulary[positions] == ids
+            scores = scores + values[known] @ self.weights[positions[known]]
+        probabilities = _softmax(scores)
+        best = int(np.argmax(probabilities))
+        return self.subjects[best], float(probabilities[best])
+
+    def save(self, path: str):
+        """Записывает модель атомарно: бот никогда не прочитает недописанный файл"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            subjects=np.array(self.subjects),
+            vocabulary=self.vocabulary,
+            weights=self.weights.astype(np.float32),
+            bias=self.bias.astype(np.float32),
+            meta=np.array(json.dumps(self.meta, ensure_ascii=False)),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "SubjectModel":
+        with np.load(path, allow_pickle=False) as archive:
+            meta = json.loads(str(archive["meta"]))
+            if meta.get("format_version") != FORMAT_VERSION:
+                raise ValueError(f"формат {meta.get('format_version')}, ожидается {FORMAT_VERSION}")
+            return cls(
+                subjects=[str(s) for s in archive["subjects"]],
+                vocabulary=archive["vocabulary"],
+                weights=archive["weights"],
+                bias=archive["bias"],
+                meta=meta,
+            )
+
+
+def train(texts: Sequence[str], labels: Sequence[str], epochs: int = 300,
+          learning_rate: float = 0.05, l2: float = 1e-4, min_df: int = 2,
+          balanced: bool = True) -> SubjectModel:
+    """
+    Обучает модель на текстах задач и их предметах
+
+    Полный батч, Adam, L2-регуляризация. В словарь попадают n-граммы,
+    встретившиеся хотя бы в min_df текстах. При balanced=True редкие
+    предметы получают больший вес, иначе модель все сводит к математике.
+    """
+    subjects = sorted(set(labels))
+    rows = [extract_features(t) for t in texts]
+
+    df: Counter = Counter()
+    for row in rows:
+        df.update(row.keys())
+    vocabulary = np.array(sorted(h for h, c in df.items() if c >= min_df), dtype=np.uint32)
+
+    X = SparseRows(rows, vocabulary)
+    y = np.array([subjects.index(label) for label in labels])
+    targets = np.eye(len(subjects))[y]
+
+    counts = np.bincount(y, minlength=len(subjects))
+    if balanced:
+        sample_weights = (len(y) / (len(subjects) * counts))[y]
+    else:
+        sample_weights = np.ones(len(y))
+    sample_weights = sample_weights / sample_weights.sum()
+
+    weights = np.zeros((len(vocabulary), len(subjects)))
+    bias = np.log((counts + 1) / (counts.sum() + len(subjects)))
+    params = [weights, bias]
+    moments = [np.zeros_like(p) for p in params]
+    velocities = [np.zeros_like(p) for p in params]
+    beta1, beta2, eps = 0.9, 0.999, 1e-8
+
+    for step in range(1, epochs + 1):
+        probabilities = _softmax(X.dot(weights) + bias)
+        grad_logits = (probabilities - targets) * sample_weights[:, None]
+        grads = [X.t_dot(grad_logits, len(vocabulary)) + l2 * weights, grad_logits.sum(axis=0)]
+
+        for param, grad, m, v in zip(params, grads, moments, velocities):
+            m *= beta1
+            m += (1 - beta1) * grad
+            v *= beta2
+            v += (1 - beta2) * grad * grad
+            m_hat = m / (1 - beta1 ** step)
+            v_hat = v / (1 - beta2 ** step)
+            param -= learning_rate * m_hat / (np.sqrt(v_hat) + eps)
+
+    meta = {
+        "format_version": FORMAT_VERSION,
+        "model_version": datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S"),
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "samples": len(texts),
+        "features": int(len(vocabulary)),
+        "ngram_range": [NGRAM_MIN, NGRAM_MAX],
+        "class_counts": {s: int(c) for s, c in zip(subjects, counts)},
+    }
+    return SubjectModel(subjects, vocabulary, weights.astype(np.float32),
+                        bias.astype(np.float32), meta)
+
+
+class SubjectModelStore:
+    """
+    Лениво загружает модель предметов и подхватывает новый файл без перезапуска
+
+    Время изменения файла проверяется не чаще, чем раз в
+    config.subject_model_reload_interval секунд. Если новый файл не читается,
+    продолжает работать прежняя модель.
+    """
+
+    def __init__(self, path: str = None, reload_interval: float = None):
+        self.path = path or config.subject_model_path
+        self.reload_interval = (config.subject_model_reload_interval
+                                if reload_interval is None else reload_interval)
+        self._model: Optional[SubjectModel] = None
+        self._mtime: Optional[int] = None
+        self._checked_at: Optional[float] = None
+
+        # Счетчики
+        self.reloads = 0
+        self.failures = 0
+
+    def get(self) -> Optional[SubjectModel]:
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.reload_interval:
+            return self._model
+        self._checked_at = now
+
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            if self._model is not None:
+                logger.warning(f"Файл модели предметов {self.path} пропал, используем ключевые слова")
+            self._model = None
+            self._mtime = None
+            return None
+
+        if mtime != self._mtime:
+            self._mtime = mtime
+            try:
+                self._model = SubjectModel.load(self.path)
+                self.reloads += 1
+                logger.info(
+                    f"Модель предметов загружена: версия {self._model.version}, "
+                    f"{len(self._model.vocabulary)} признаков"
+                )
+            except Exception as e:
+                self.failures += 1
+                logger.warning(f"Не удалось загрузить модель предметов {self.path}: {e}")
+        return self._model
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "loaded": self._model is not None,
+            "version": self._model.version if self._model else None,
+            "reloads": self.reloads,
+            "failures": self.failures,
+        }
+
+
+# Глобальный экземпляр
+subject_model_store = SubjectModelStore()
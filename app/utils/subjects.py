@@ -1,5 +1,9 @@
-from typing import Tuple
-from rapidfuzz import fuzz
+from collections import deque
+from typing import Dict, List, NamedTuple, Set, Tuple
+import numpy as np
+from rapidfuzz import fuzz, process
+from ..config import config
+from .subject_model import subject_model_store
 
 
 # Ключевые слова для определения предметов
@@ -80,6 +84,176 @@ SUBJECT_KEYWORDS = {
 }
 
 
+# Порог нечеткого совпадения (partial_ratio, 0-100)
+FUZZY_THRESHOLD = 80
+
+# Ключевые слова короче этого ищутся только точным вхождением: у них
+# partial_ratio выше порога возможен лишь на обрывке слова в начале или
+# конце сообщения, а это ложные срабатывания, а не опечатки
+FUZZY_MIN_LENGTH = 6
+
+
+class KeywordAutomaton:
+    """
+    Автомат Ахо-Корасик: все ключевые слова, входящие в текст, за один проход
+
+    Время поиска не зависит от числа ключевых слов — O(длина текста + совпадения).
+    """
+
+    def __init__(self, keywords: List[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+
+        # Бор по ключевым словам
+        for index, keyword in enumerate(keywords):
+            state = 0
+            for char in keyword:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._out[state].append(index)
+
+        # Суффиксные ссылки обходом в ширину
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def find(self, text: str) -> Set[int]:
+        """Индексы ключевых слов, входящих в текст"""
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+class SubjectMatcher:
+    """
+    Классификатор предмета, собираемый один раз при импорте
+
+    Оценка предмета та же, что и раньше: сумма по его ключевым словам
+    (1 за точное вхождение, partial_ratio / 100 за нечеткое выше порога),
+    деленная на число ключевых слов. Точные вхождения ищет автомат
+    Ахо-Корасик, нечеткие оценки считаются одним вызовом process.cdist
+    только для длинных слов без точного вхождения, которые прошли отсев по
+    частотам символов, суммы по предметам — умножением на матрицу.
+    """
+
+    def __init__(self, subject_keywords: Dict[str, List[str]]):
+        self.subjects = list(subject_keywords)
+        self.keywords = sorted({kw for kws in subject_keywords.values() for kw in kws})
+        index = {kw: i for i, kw in enumerate(self.keywords)}
+
+        # weights[предмет, слово] — сколько раз слово встречается в списке предмета
+        self.weights = np.zeros((len(self.subjects), len(self.keywords)), dtype=np.float64)
+        for row, subject in enumerate(self.subjects):
+            for keyword in subject_keywords[subject]:
+                self.weights[row, index[keyword]] += 1
+        self.sizes = np.array([len(subject_keywords[s]) for s in self.subjects], dtype=np.float64)
+
+        self.fuzzy_candidates = np.array(
+            [len(kw) >= FUZZY_MIN_LENGTH for kw in self.keywords], dtype=bool
+        )
+        self.automaton = KeywordAutomaton(self.keywords)
+
+        # Частоты символов ключевых слов для быстрого отсева в keyword_scores
+        self.alphabet = np.array(sorted({ord(c) for kw in self.keywords for c in kw}), dtype=np.uint32)
+        self.char_counts = np.zeros((len(self.keywords), len(self.alphabet)), dtype=np.int32)
+        for row, keyword in enumerate(self.keywords):
+            for char in keyword:
+                self.char_counts[row, np.searchsorted(self.alphabet, ord(char))] += 1
+        self.lengths = np.array([len(kw) for kw in self.keywords], dtype=np.int32)
+
+    def _char_overlap(self, text_lower: str) -> np.ndarray:
+        """Сколько символов каждого ключевого слова есть в тексте (с учетом повторов)"""
+        codes = np.frombuffer(text_lower.encode("utf-32-le"), dtype=np.uint32)
+        positions = np.searchsorted(self.alphabet, codes)
+        positions[positions == len(self.alphabet)] = 0
+        known = positions[self.alphabet[positions] == codes]
+        histogram = np.bincount(known, minlength=len(self.alphabet))
+        return np.minimum(self.char_counts, histogram).sum(axis=1)
+
+    def keyword_scores(self, text_lower: str) -> np.ndarray:
+        """Оценка каждого ключевого слова: 1, partial_ratio / 100 или 0"""
+        scores = np.zeros(len(self.keywords), dtype=np.float64)
+        exact = self.automaton.find(text_lower)
+        if exact:
+            scores[list(exact)] = 1.0
+
+        # partial_ratio > 80 требует, чтобы больше 2/3 символов более короткой
+        # строки нашлись в другой — остальные слова отсеиваем без вызова rapidfuzz
+        shorter = np.minimum(self.lengths, len(text_lower))
+        fuzzy = self.fuzzy_candidates & (scores == 0) & (3 * self._char_overlap(text_lower) > 2 * shorter)
+        positions = np.flatnonzero(fuzzy)
+        if len(positions):
+            ratios = process.cdist(
+                [self.keywords[i] for i in positions], [text_lower],
+                scorer=fuzz.partial_ratio, score_cutoff=FUZZY_THRESHOLD,
+                dtype=np.float64,
+            )[:, 0]
+            ratios[ratios <= FUZZY_THRESHOLD] = 0.0
+            scores[positions] = ratios / 100
+        return scores
+
+    def classify(self, text: str) -> Tuple[str, float]:
+        scores = self.keyword_scores(text.lower())
+        averages = (self.weights @ scores) / self.sizes
+        best = int(np.argmax(averages))
+        return self.subjects[best], float(averages[best])
+
+
+_matcher = SubjectMatcher(SUBJECT_KEYWORDS)
+
+
+# Откуда взялся предмет (requests.subject_source)
+SOURCE_MODEL = "model"          # обученный классификатор
+SOURCE_KEYWORDS = "keywords"    # ключевые слова
+SOURCE_FALLBACK = "fallback"    # ничего не подошло — математика по умолчанию
+
+
+class SubjectLabel(NamedTuple):
+    subject: str
+    confidence: float
+    source: str
+
+
+def label_subject(text: str) -> SubjectLabel:
+    """Предмет задачи вместе с уверенностью и источником метки"""
+    if not text:
+        return SubjectLabel("математика", 0.0, SOURCE_FALLBACK)
+    
+    # Обученная модель (train_subject_model.py), если она есть и уверена
+    model = subject_model_store.get()
+    if model is not None:
+        subject, confidence = model.predict(text)
+        if confidence >= config.subject_model_min_confidence:
+            return SubjectLabel(subject, confidence, SOURCE_MODEL)
+    
+    best_subject, best_score = _matcher.classify(text)
+    
+    # Если уверенность очень низкая, считаем математикой
+    if best_score < 0.1:
+        return SubjectLabel("математика", 0.5, SOURCE_FALLBACK)
+    
+    return SubjectLabel(best_subject, min(best_score, 1.0), SOURCE_KEYWORDS)
+
+
 def detect_subject(text: str) -> Tuple[str, float]:
     """
     Определяет предмет по тексту задачи
@@ -90,42 +264,8 @@ def detect_subject(text: str) -> Tuple[str, float]:
     Returns:
         Tuple[предмет, уверенность] где уверенность от 0 до 1
     """
-    if not text:
-        return "математика", 0.0
-    
-    text_lower = text.lower()
-    best_subject = "математика"
-    best_score = 0.0
-    
-    for subject, keywords in SUBJECT_KEYWORDS.items():
-        total_score = 0
-        matches = 0
-        
-        for keyword in keywords:
-            # Проверяем точное вхождение
-            if keyword in text_lower:
-                total_score += 1.0
-                matches += 1
-            else:
-                # Проверяем нечеткое совпадение
-                fuzzy_score = fuzz.partial_ratio(keyword, text_lower)
-                if fuzzy_score > 80:  # Порог для нечеткого совпадения
-                    total_score += fuzzy_score / 100
-                    matches += 1
-        
-        # Нормализуем оценку
-        if matches > 0:
-            avg_score = total_score / len(keywords)
-            if avg_score > best_score:
-                best_score = avg_score
-                best_subject = subject
-    
-    # Если уверенность очень низкая, считаем математикой
-    if best_score < 0.1:
-        best_subject = "математика"
-        best_score = 0.5
-    
-    return best_subject, min(best_score, 1.0)
+    subject, confidence, _ = label_subject(text)
+    return subject, confidence
 
 
 def get_subject_emoji(subject: str) -> str:
@@ -0,0 +1,30 @@
+import math
+import re
+
+
+# Слова латиницей, слова кириллицей, группы цифр и отдельные прочие символы
+_TOKEN_PIECES = re.compile(r"[A-Za-z]+|[А-Яа-яЁё]+|\d{1,3}|\S")
+
+
+def count_tokens(text: str) -> int:
+    """
+    Приблизительно считает токены текста для моделей семейства GPT-4o
+
+    Точный токенизатор не нужен: оценка используется для бюджета контекста
+    и лимитов, поэтому достаточно, чтобы она была стабильной и слегка
+    завышенной. Латиница ~4 символа на токен, кириллица ~3, каждая группа
+    до трех цифр и каждый прочий символ — отдельный токен.
+    """
+    if not text:
+        return 0
+
+    tokens = 0
+    for piece in _TOKEN_PIECES.findall(text):
+        first = piece[0]
+        if first.isascii() and first.isalpha():
+            tokens += math.ceil(len(piece) / 4)
+        elif first.isalpha():
+            tokens += math.ceil(len(piece) / 3)
+        else:
+            tokens += 1
+    return tokens
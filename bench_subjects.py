@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк определения предмета: время detect_subject в зависимости от длины текста
+
+Сравнивает скомпилированный классификатор (app/utils/subjects.py) с прежним
+перебором fuzz.partial_ratio по каждому ключевому слову и проверяет, что
+предметы совпадают.
+
+Запуск:
+    python bench_subjects.py
+    python bench_subjects.py --lengths 100,1000,10000 --repeat 20
+"""
+
+import argparse
+import os
+import sys
+import time
+
+# Добавляем текущую директорию в путь для импорта
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from rapidfuzz import fuzz
+from app.utils.subjects import SUBJECT_KEYWORDS, detect_subject
+
+
+SAMPLE_TEXTS = [
+    "Тело брошено под углом 30° к горизонту с начальной скоростью 20 м/с. "
+    "Найди максимальную высоту подъема и дальность полета.",
+    "Реши уравнение: 3x + 7 = 25. Найди корень и сделай проверку.",
+    "Уравняй реакцию Fe + O₂ → Fe₂O₃ и посчитай молярную массу оксида.",
+    "Найди в предложении подлежащее и сказуемое, определи падеж существительных.",
+    "Переведи на английский, используя Present Perfect: я уже сделал домашнее задание.",
+    "Напиши программу на Python, которая находит максимум в массиве.",
+]
+
+
+def detect_subject_reference(text: str):
+    """Прежняя реализация: partial_ratio по каждому ключевому слову"""
+    if not text:
+        return "математика", 0.0
+
+    text_lower = text.lower()
+    best_subject = "математика"
+    best_score = 0.0
+
+    for subject, keywords in SUBJECT_KEYWORDS.items():
+        total_score = 0
+        matches = 0
+        for keyword in keywords:
+            if keyword in text_lower:
+                total_score += 1.0
+                matches += 1
+            else:
+                fuzzy_score = fuzz.partial_ratio(keyword, text_lower)
+                if fuzzy_score > 80:
+                    total_score += fuzzy_score / 100
+                    matches += 1
+        if matches > 0:
+            avg_score = total_score / len(keywords)
+            if avg_score > best_score:
+                best_score = avg_score
+                best_subject = subject
+
+    if best_score < 0.1:
+        best_subject = "математика"
+        best_score = 0.5
+
+    return best_subject, min(best_score, 1.0)
+
+
+def make_text(sample: str, length: int) -> str:
+    """Повторяет пример до нужной длины, как длинное вставленное условие"""
+    return (sample + " ") * (length // (len(sample) + 1)) + sample[:length % (len(sample) + 1)]
+
+
+def measure(fn, texts, repeat: int) -> float:
+    """Среднее время вызова, мкс"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            fn(text)
+    return (time.perf_counter() - started) / (repeat * len(texts)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарк detect_subject")
+    parser.add_argument("--lengths", default="50,200,1000,4000",
+                        help="длины текста через запятую")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'Длина':>8}{'прежний, мкс':>16}{'новый, мкс':>14}{'ускорение':>12}{'совпадение':>13}")
+    for length in [int(x) for x in args.lengths.split(",")]:
+        texts = [make_text(sample, length) for sample in SAMPLE_TEXTS]
+        agree = sum(detect_subject(t)[0] == detect_subject_reference(t)[0] for t in texts)
+
+        # Прогрев
+        detect_subject(texts[0])
+
+        old = measure(detect_subject_reference, texts, args.repeat)
+        new = measure(detect_subject, texts, args.repeat)
+        print(f"{length:>8}{old:>16.0f}{new:>14.0f}{old / new:>11.1f}x{agree:>9}/{len(texts)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Проверка планов запросов к базе (EXPLAIN QUERY PLAN)
+
+Выполняет каждый метод DatabaseRepo на временной базе и проверяет, что
+горячие запросы идут по индексам, а не читают таблицу целиком. Новый
+метод репозитория нужно добавить в app/db/query_plans.py, иначе проверка
+не пройдет.
+
+Запуск:
+    python check_query_plans.py
+    python check_query_plans.py --verbose
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+# Добавляем текущую директорию в путь для импорта
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Конфиг читается при импорте app: бот здесь не запускается
+os.environ.setdefault("BOT_TOKEN", "123456:QUERYPLANS")
+os.environ.setdefault("OPENAI_API_KEY", "query-plans")
+
+from app.db.query_plans import REPO_CALLS, check_plans, uncovered_methods
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка планов запросов DatabaseRepo")
+    parser.add_argument("--verbose", action="store_true", help="печатать планы всех запросов")
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix="query_plans_"), "plans.db")
+    plans = check_plans(db_path)
+    notes = {c.method: c.note for c in REPO_CALLS}
+
+    failed = 0
+    print("🔍 Планы запросов DatabaseRepo")
+    print("=" * 72)
+    for plan in plans:
+        if plan.scans and plan.hot:
+            failed += 1
+            mark = "❌"
+        elif plan.scans:
+            mark = "⚠️ "
+        else:
+            mark = "✅"
+        if not args.verbose and mark == "✅":
+            continue
+        print(f"{mark} {plan.method}: {plan.sql[:120]}")
+        for detail in plan.plan:
+            print(f"      {detail}")
+        if plan.scans and not plan.hot:
+            print(f"      допустимо: {notes[plan.method]}")
+
+    missing = uncovered_methods()
+    for method in sorted(missing):
+        print(f"❌ {method}: нет проверки в app/db/query_plans.py")
+
+    print("=" * 72)
+    print(f"📋 Запросов: {len(plans)}, методов: {len(REPO_CALLS)}")
+    if failed or missing:
+        print(f"❌ Горячих запросов с полным проходом: {failed}, методов без проверки: {len(missing)}")
+        return 1
+    print("✅ Горячие запросы идут по индексам")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест бота: синтетические апдейты Telegram через настоящий Dispatcher
+
+Telegram Bot API подменяется локальной сессией (сообщения, редактирование,
+скачивание фото), LLM — mock-сервером из mock_llm_server.py. Все остальное
+(роутер, хендлеры, LLMClient, SQLite) работает как в продакшене.
+
+Пример:
+    python mock_llm_server.py --port 8080 &
+    python loadtest.py --base-url http://127.0.0.1:8080/v1 --messages 500 --concurrency 50
+
+Отчет: пропускная способность и p50/p95/p99 по этапам обработки.
+С --max-p95-ms скрипт завершается с кодом 1 при превышении порога.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Добавляем текущую директорию в путь для импорта
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+TEXT_TASKS = [
+    "Реши уравнение: {a}x + {b} = {c}",
+    "Найди производную функции y = {a}x^3 - {b}x + {c}",
+    "Физика: тело массой {a} кг движется с ускорением {b} м/с². Найди силу",
+    "Химия: сколько граммов соли получится из {a} моль NaOH и {b} моль HCl?",
+    "Переведи на английский: Я делаю домашнее задание уже {a} часа",
+    "Информатика: переведи число {c} в двоичную систему счисления",
+    "История: в каком году началась Северная война? Вариант {a}",
+    "Биология: опиши строение клетки, задание {a}",
+    "Найди площадь треугольника со сторонами {a}, {b} и {c} см",
+    "Русский язык: поставь запятые в предложении, упражнение {c}",
+]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота через Dispatcher")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8080/v1",
+                        help="адрес mock-сервера LLM (см. mock_llm_server.py)")
+    parser.add_argument("--messages", type=int, default=200, help="всего апдейтов")
+    parser.add_argument("--users", type=int, default=50, help="количество пользователей")
+    parser.add_argument("--concurrency", type=int, default=20,
+                        help="одновременно обрабатываемых апдейтов")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="апдейтов в секунду (0 — без ограничения, закрытая модель)")
+    parser.add_argument("--photo-ratio", type=float, default=0.2, help="доля фото")
+    parser.add_argument("--repeat-ratio", type=float, default=0.1,
+                        help="доля повторяющихся задач (проверка кэшей)")
+    parser.add_argument("--telegram-latency", type=float, default=0.03,
+                        help="имитация задержки Bot API, сек")
+    parser.add_argument("--database", default=None,
+                        help="файл SQLite (по умолчанию временный)")
+    parser.add_argument("--json", dest="json_path", default=None,
+                        help="сохранить отчет в JSON")
+    parser.add_argument("--max-p95-ms", type=float, default=None,
+                        help="порог p95 полной обработки апдейта, мс")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def configure_environment(args):
+    """Окружение нужно выставить до импорта app: конфиг читается при импорте"""
+    database = args.database or os.path.join(tempfile.mkdtemp(prefix="loadtest_"), "loadtest.db")
+    os.environ["BOT_TOKEN"] = "123456:LOADTEST"
+    os.environ["OPENAI_API_KEY"] = "loadtest"
+    os.environ["LLM_BASE_URL"] = args.base_url
+    os.environ["DATABASE_URL"] = database
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # Тест меряет пропускную способность, а не лимиты частоты
+    os.environ.setdefault("RATE_LIMIT_PER_HOUR", "0")
+    os.environ.setdefault("RATE_LIMIT_PER_HOUR_SUBSCRIBER", "0")
+    return database
+
+
+def make_photos(count: int = 4):
+    """Синтетические фото листов с заданиями разного размера"""
+    from PIL import Image, ImageDraw
+
+    photos = []
+    for i in range(count):
+        width, height = 1280 + i * 320, 960 + i * 240
+        image = Image.new("RGB", (width, height), (235, 232, 225))
+        draw = ImageDraw.Draw(image)
+        for y in range(80, height - 80, 48):
+            draw.text((80, y), f"Task {i}.{y}: 3x + {i + y % 17} = 25, find x", fill=(30, 30, 30))
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=85)
+        photos.append(output.getvalue())
+    return photos
+
+
+def build_fake_session(telegram_latency: float, photos: list):
+    """Сессия Bot API, которая отвечает локально, не обращаясь к Telegram"""
+    from aiogram.client.session.base import BaseSession
+    from aiogram.methods import (
+        EditMessageText, GetFile, Response, SendMessage,
+    )
+
+    class FakeTelegramSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            self.calls = {}
+            self.error_replies = 0
+            self._message_id = 1000
+
+        async def close(self):
+            pass
+
+        def _message(self, chat_id: int, text: str) -> dict:
+            self._message_id += 1
+            return {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": text,
+            }
+
+        async def make_request(self, bot, method, timeout=None):
+            name = type(method).__name__
+            self.calls[name] = self.calls.get(name, 0) + 1
+            await asyncio.sleep(telegram_latency)
+
+            if isinstance(method, (SendMessage, EditMessageText)):
+                if method.text.startswith("❌"):
+                    self.error_replies += 1
+            if isinstance(method, SendMessage):
+                result = self._message(method.chat_id, method.text)
+            elif isinstance(method, EditMessageText):
+                result = self._message(method.chat_id or 0, method.text)
+            elif isinstance(method, GetFile):
+                result = {
+                    "file_id": method.file_id,
+                    "file_unique_id": method.file_id,
+                    "file_path": f"photos/{method.file_id}.jpg",
+                }
+            else:
+                result = True
+
+            response_type = Response[method.__returning__]
+            response = response_type.model_validate({"ok": True, "result": result},
+                                                     context={"bot": bot})
+            return response.result
+
+        async def stream_content(self, url, headers=None, timeout=30,
+                                 chunk_size=65536, raise_for_status=True):
+            self.calls["download"] = self.calls.get("download", 0) + 1
+            await asyncio.sleep(telegram_latency)
+            # file_path вида photos/photo_<индекс>.jpg
+            index = int(url.rsplit("_", 1)[1].split(".")[0])
+            data = photos[index]
+            for offset in range(0, len(data), chunk_size):
+                yield data[offset:offset + chunk_size]
+
+    return FakeTelegramSession()
+
+
+def build_start_update(user_id: int):
+    """Апдейт с командой /start"""
+    from aiogram.types import Update
+
+    return Update.model_validate({"update_id": user_id, "message": {
+        "message_id": 1,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+        "text": "/start",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+    }})
+
+
+def build_update(update_id: int, user_id: int, rng: random.Random, args, photos: list):
+    """Синтетический апдейт: текст задачи или фото"""
+    from aiogram.types import Update
+
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+    }
+
+    if rng.random() < args.photo_ratio:
+        index = rng.randrange(len(photos))
+        # Telegram присылает несколько размеров одного фото
+        message["photo"] = [
+            {"file_id": f"photo_{index}", "file_unique_id": f"photo_{index}_{side}",
+             "width": side, "height": side * 3 // 4}
+            for side in (320, 800, 1280)
+        ]
+        message["caption"] = rng.choice(["", "Реши задание", "номер 3"])
+        kind = "photo"
+    else:
+        template = rng.choice(TEXT_TASKS)
+        if rng.random() < args.repeat_ratio:
+            values = {"a": 3, "b": 7, "c": 25}
+        else:
+            values = {"a": rng.randint(2, 99), "b": rng.randint(2, 99), "c": rng.randint(2, 999)}
+        message["text"] = template.format(**values)
+        kind = "text"
+
+    return kind, Update.model_validate({"update_id": update_id, "message": message})
+
+
+async def run(args):
+    database = configure_environment(args)
+
+    from loguru import logger
+    from aiogram import Bot
+    from app.config import config
+    from app.db.repo import db_repo
+    from app.llm.client import llm_client
+    from app.main import SchoolBot
+    from app.utils.images import shutdown_executor
+    from app.utils.metrics import stage_metrics
+
+    logger.remove()
+    logger.add(sys.stderr, level=os.environ["LOG_LEVEL"])
+
+    rng = random.Random(args.seed)
+    photos = make_photos()
+    session = build_fake_session(args.telegram_latency, photos)
+
+    # Тот же Dispatcher и роутеры, что и в боте, но с локальной сессией Bot API
+    school_bot = SchoolBot()
+    await school_bot.bot.session.close()
+    school_bot.bot = Bot(token=config.bot_token, session=session)
+
+    await db_repo.init_db()
+    await llm_client.start()
+
+    # Пользователи сначала нажимают /start (регистрация), в замеры это не входит
+    for user_id in range(100000, 100000 + args.users):
+        await school_bot.dp.feed_update(school_bot.bot, build_start_update(user_id))
+    stage_metrics.reset()
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    failures = 0
+
+    async def process(update_id: int):
+        nonlocal failures
+        user_id = 100000 + rng.randrange(args.users)
+        kind, update = build_update(update_id, user_id, rng, args, photos)
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await school_bot.dp.feed_update(school_bot.bot, update)
+            except Exception as e:
+                failures += 1
+                logger.error(f"Апдейт {update_id} упал: {e}")
+            elapsed = time.perf_counter() - started
+            stage_metrics.record("update_total", elapsed)
+            stage_metrics.record(f"{kind}_total", elapsed)
+
+    print(f"🚀 {args.messages} апдейтов, {args.users} пользователей, "
+          f"конкурентность {args.concurrency}, LLM: {args.base_url}")
+    started = time.perf_counter()
+    tasks = []
+    for i in range(args.messages):
+        tasks.append(asyncio.create_task(process(i + 1)))
+        if args.rate > 0:
+            await asyncio.sleep(1 / args.rate)
+    await asyncio.gather(*tasks)
+    duration = time.perf_counter() - started
+
+    report = {
+        "updates": args.messages,
+        "duration_seconds": round(duration, 2),
+        "throughput_per_second": round(args.messages / duration, 2),
+        "failures": failures,
+        "error_replies": session.error_replies,
+        "stages": stage_metrics.get_stats(),
+        "telegram_calls": session.calls,
+        "llm": llm_client.get_stats(),
+        "db": db_repo.get_stats(),
+        "database": database,
+    }
+
+    await llm_client.close()
+    shutdown_executor()
+    await db_repo.close()
+    return report
+
+
+def print_report(report: dict):
+    print("=" * 72)
+    print(f"⏱  Длительность: {report['duration_seconds']} с, "
+          f"пропускная способность: {report['throughput_per_second']} апдейтов/с")
+    print(f"❌ Исключения: {report['failures']}, ответы с ошибкой: {report['error_replies']}")
+    print()
+    print(f"{'Этап':<20}{'кол-во':>8}{'p50, мс':>11}{'p95, мс':>11}{'p99, мс':>11}{'max, мс':>11}")
+    for stage, s in sorted(report["stages"].items()):
+        print(f"{stage:<20}{s['count']:>8}{s['p50_ms']:>11}{s['p95_ms']:>11}"
+              f"{s['p99_ms']:>11}{s['max_ms']:>11}")
+    print()
+    print(f"📡 Вызовы Bot API: {report['telegram_calls']}")
+    llm = report["llm"]
+    print(f"🧠 LLM: пул {llm.get('pool')}")
+    print(f"        кэш {llm.get('cache')}, фото {llm.get('image_cache')}")
+    print(f"        очередь {llm.get('scheduler')}")
+    print(f"        устойчивость {llm.get('resilience')}")
+    print(f"🗄  БД: {report['db']}")
+    print("=" * 72)
+
+
+def main():
+    args = parse_args()
+    report = asyncio.run(run(args))
+    print_report(report)
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+        print(f"💾 Отчет сохранен: {args.json_path}")
+
+    if args.max_p95_ms is not None:
+        p95 = report["stages"].get("update_total", {}).get("p95_ms", 0.0)
+        if report["failures"]:
+            print(f"❌ Упавших апдейтов: {report['failures']}")
+            return 1
+        if p95 > args.max_p95_ms:
+            print(f"❌ p95 {p95} мс превышает порог {args.max_p95_ms} мс")
+            return 1
+        print(f"✅ p95 {p95} мс в пределах порога {args.max_p95_ms} мс")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Локальный mock OpenAI-совместимого API (chat/completions) для нагрузочных тестов
+
+Запуск:
+    python mock_llm_server.py --port 8080 --latency lognormal:0.8:0.5 --error-rate 0.02
+
+Затем в .env бота или окружении load-теста:
+    LLM_BASE_URL=http://127.0.0.1:8080/v1
+
+Распределения задержки до первого токена (--latency):
+    fixed:СЕК
+    uniform:ОТ:ДО
+    lognormal:МЕДИАНА:SIGMA
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import sys
+import time
+from aiohttp import web
+
+
+def parse_latency(spec: str):
+    """Возвращает функцию, генерирующую задержку в секундах по описанию распределения"""
+    kind, *params = spec.split(":")
+    values = [float(p) for p in params]
+    if kind == "fixed" and len(values) == 1:
+        return lambda: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal" and len(values) == 2:
+        mu = math.log(values[0])
+        return lambda: random.lognormvariate(mu, values[1])
+    raise ValueError(f"Неизвестное распределение задержки: {spec}")
+
+
+def build_answer(messages: list, answer_tokens: int) -> str:
+    """Синтетическое решение примерно на answer_tokens токенов"""
+    question = ""
+    for msg in reversed(messages):
+        if msg.get("role") == "user":
+            content = msg.get("content")
+            question = content if isinstance(content, str) else "[фото]"
+            break
+
+    lines = [f"Разберем задание: {question[:80]}", ""]
+    step = 1
+    # ~12 токенов на строку шага
+    while len(lines) * 12 < answer_tokens:
+        lines.append(f"Шаг {step}: преобразуем выражение и подставим значения.")
+        step += 1
+    lines.append("")
+    lines.append("Ответ: x = 6")
+    return "\n".join(lines)
+
+
+class MockLLMServer:
+    """Обработчики mock-сервера и счетчики запросов"""
+
+    def __init__(self, args):
+        self.latency = parse_latency(args.latency)
+        self.tokens_per_second = args.tokens_per_second
+        self.answer_tokens = args.answer_tokens
+        self.error_rate = args.error_rate
+        self.rate_limit_rate = args.rate_limit_rate
+        self.retry_after = args.retry_after
+        self.stream_break_rate = args.stream_break_rate
+
+        # Счетчики
+        self.requests = 0
+        self.streams = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.broken_streams = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.started_at = time.time()
+
+    def _usage(self, messages: list, answer: str) -> dict:
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in messages) // 3
+        completion_tokens = len(answer) // 3
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            body = await request.json()
+            messages = body.get("messages", [])
+            model = body.get("model", "mock")
+
+            # Ошибки отдаем сразу, как перегруженный API
+            roll = random.random()
+            if roll < self.rate_limit_rate:
+                self.rate_limited += 1
+                return web.json_response(
+                    {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                    status=429,
+                    headers={"Retry-After": str(self.retry_after)},
+                )
+            if roll < self.rate_limit_rate + self.error_rate:
+                self.errors += 1
+                await asyncio.sleep(self.latency() / 2)
+                return web.json_response(
+                    {"error": {"message": "The server is overloaded", "type": "server_error"}},
+                    status=random.choice([500, 502, 503]),
+                )
+
+            answer = build_answer(messages, self.answer_tokens)
+            await asyncio.sleep(self.latency())
+
+            if not body.get("stream"):
+                # Без стриминга ответ приходит целиком после генерации
+                await asyncio.sleep(self.answer_tokens / self.tokens_per_second)
+                return web.json_response({
+                    "id": f"chatcmpl-mock-{self.requests}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": answer},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": self._usage(messages, answer),
+                })
+
+            return await self._stream(request, body, model, messages, answer)
+        finally:
+            self.in_flight -= 1
+
+    async def _stream(self, request: web.Request, body: dict, model: str,
+                      messages: list, answer: str) -> web.StreamResponse:
+        self.streams += 1
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+        })
+        await response.prepare(request)
+
+        def event(payload: dict) -> bytes:
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode()
+
+        # Куски по ~4 токена
+        words = answer.split(" ")
+        chunks = [" ".join(words[i:i + 3]) + " " for i in range(0, len(words), 3)]
+        delay = 4 / self.tokens_per_second
+        break_at = len(chunks) // 2 if random.random() < self.stream_break_rate else None
+
+        for i, chunk in enumerate(chunks):
+            if i == break_at:
+                # Обрыв соединения посреди ответа
+                self.broken_streams += 1
+                request.transport.close()
+                return response
+            await response.write(event({
+                "id": f"chatcmpl-mock-{self.requests}",
+                "object": "chat.completion.chunk",
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": chunk}, "finish_reason": None}],
+            }))
+            await asyncio.sleep(delay)
+
+        await response.write(event({
+            "id": f"chatcmpl-mock-{self.requests}",
+            "object": "chat.completion.chunk",
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        }))
+        if body.get("stream_options", {}).get("include_usage"):
+            await response.write(event({
+                "id": f"chatcmpl-mock-{self.requests}",
+                "object": "chat.completion.chunk",
+                "model": model,
+                "choices": [],
+                "usage": self._usage(messages, answer),
+            }))
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def models(self, request: web.Request) -> web.Response:
+        return web.json_response({"object": "list", "data": [{"id": "mock", "object": "model"}]})
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "uptime_seconds": round(time.time() - self.started_at, 1),
+            "requests": self.requests,
+            "streams": self.streams,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "broken_streams": self.broken_streams,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+        })
+
+
+def build_app(args) -> web.Application:
+    server = MockLLMServer(args)
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", server.chat_completions)
+    app.router.add_get("/v1/models", server.models)
+    app.router.add_get("/stats", server.stats)
+    return app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Mock OpenAI-совместимого API для нагрузочных тестов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", default="lognormal:0.8:0.4",
+                        help="задержка до первого токена: fixed:С | uniform:ОТ:ДО | lognormal:МЕДИАНА:SIGMA")
+    parser.add_argument("--tokens-per-second", type=float, default=80.0,
+                        help="скорость генерации ответа")
+    parser.add_argument("--answer-tokens", type=int, default=300,
+                        help="примерная длина ответа в токенах")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="доля ответов 5xx")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0,
+                        help="доля ответов 429")
+    parser.add_argument("--retry-after", type=float, default=1.0,
+                        help="значение заголовка Retry-After для 429")
+    parser.add_argument("--stream-break-rate", type=float, default=0.0,
+                        help="доля стримов, обрываемых посередине")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    try:
+        app = build_app(args)
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    print(f"🧪 Mock LLM API: http://{args.host}:{args.port}/v1 (статистика: /stats)")
+    web.run_app(app, host=args.host, port=args.port, print=None)
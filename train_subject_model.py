@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Обучение классификатора предметов по таблице requests
+
+Читает тексты задач с предметом, обучает линейную модель по символьным
+n-граммам и записывает файл модели (SUBJECT_MODEL_PATH). Работающий бот
+подхватывает новый файл сам, без перезапуска.
+
+Метки — не разметка человеком, а то, что бот определил по ключевым словам
+(requests.subject_source = 'keywords'). Предмет по умолчанию ('fallback') и
+предсказания самой модели ('model') в обучение не берутся, иначе модель
+училась бы на своих же ошибках. Поэтому модель обобщает правила ключевых
+слов, а точность на отложенной выборке — согласие с ними, а не с учителем.
+
+Запуск:
+    python train_subject_model.py
+    python train_subject_model.py --database data/schoolbot.db --holdout 0.2 --dry-run
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+
+# Добавляем текущую директорию в путь для импорта
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.config import config
+from app.db.repo import DatabaseRepo
+from app.utils.subject_model import train
+
+
+async def load_samples(database: str, limit: int, min_confidence: float):
+    repo = DatabaseRepo(database)
+    try:
+        return await repo.get_subject_samples(limit, min_confidence)
+    finally:
+        await repo.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обучение классификатора предметов")
+    parser.add_argument("--database", default=config.database_url)
+    parser.add_argument("--output", default=config.subject_model_path)
+    parser.add_argument("--limit", type=int, default=200000, help="сколько последних запросов брать")
+    parser.add_argument("--min-confidence", type=float, default=0.0,
+                        help="минимальная уверенность метки по ключевым словам")
+    parser.add_argument("--min-class-samples", type=int, default=20,
+                        help="предметы с меньшим числом примеров пропускаются")
+    parser.add_argument("--holdout", type=float, default=0.1, help="доля примеров для проверки")
+    parser.add_argument("--epochs", type=int, default=300)
+    parser.add_argument("--learning-rate", type=float, default=0.05)
+    parser.add_argument("--l2", type=float, default=1e-4)
+    parser.add_argument("--min-df", type=int, default=2)
+    parser.add_argument("--dry-run", action="store_true", help="только обучить и проверить")
+    args = parser.parse_args()
+
+    samples = asyncio.run(load_samples(args.database, args.limit, args.min_confidence))
+    counts = {}
+    for _, subject in samples:
+        counts[subject] = counts.get(subject, 0) + 1
+    kept = {s for s, c in counts.items() if c >= args.min_class_samples}
+    samples = [(t, s) for t, s in samples if s in kept]
+
+    print(f"📚 Примеров: {len(samples)}")
+    for subject, count in sorted(counts.items(), key=lambda x: -x[1]):
+        print(f"   {subject}: {count}{'' if subject in kept else ' (пропущен)'}")
+    if len(kept) < 2:
+        print("❌ Для обучения нужно хотя бы два предмета с достаточным числом примеров")
+        return 1
+
+    random.Random(0).shuffle(samples)
+    split = int(len(samples) * (1 - args.holdout))
+    train_set, test_set = samples[:split], samples[split:]
+
+    model = train(
+        [t for t, _ in train_set], [s for _, s in train_set],
+        epochs=args.epochs, learning_rate=args.learning_rate,
+        l2=args.l2, min_df=args.min_df,
+    )
+
+    if test_set:
+        correct = sum(model.predict(t)[0] == s for t, s in test_set)
+        accuracy = correct / len(test_set)
+        model.meta["holdout_accuracy"] = round(accuracy, 4)
+        print(f"🎯 Согласие с метками на отложенной выборке: {accuracy:.1%} ({correct}/{len(test_set)})")
+
+    print(f"🧠 Модель {model.version}: {len(model.vocabulary)} признаков, "
+          f"{len(model.subjects)} предметов")
+
+    if args.dry_run:
+        return 0
+    model.save(args.output)
+    print(f"💾 Сохранено: {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())